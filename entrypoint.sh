@@ -1,4 +1,4 @@
 #!/usr/bin/env bash
 
 export PYTHONPATH=.  # add current directory to package path
-gunicorn -b 0.0.0.0:8000 api.endpoints:app
+gunicorn -b 0.0.0.0:8000 --threads 8 api.endpoints:app
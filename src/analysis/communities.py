@@ -0,0 +1,137 @@
+"""
+Detect communities in the exported log graph with label propagation over CSR arrays, and
+write a `community` attribute back to every vertex.
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+
+import settings
+from arango_util import ArangoDb
+from graph_export import export_graph
+
+ROOT = Path(__file__).parent.parent.parent
+GRAPH_CACHE_DIR = ROOT / 'models' / 'graph'
+
+UPDATE_COMMUNITIES_AQL = 'FOR d IN @docs UPDATE d IN @@collection OPTIONS { ignoreErrors: true }'
+
+
+def label_propagation(graph, max_iter=50, update_fraction=0.5, tol=1e-3, random_state=None, quiet=False):
+    """
+    Weighted label propagation. Every node starts in its own community and repeatedly adopts the
+    label with the largest total edge weight among its neighbours (its own label breaks ties).
+    Each round scores all nodes at once with sorts and bincounts over the CSR arrays, then
+    updates a random subset of them, which avoids the oscillation of fully synchronous updates
+    on bipartite structure such as logs <-> entities.
+
+    :param graph: (CsrGraph) input graph
+    :param max_iter: (int) maximum number of rounds
+    :param update_fraction: (float) fraction of nodes updated per round
+    :param tol: (float) stop when fewer than this fraction of nodes change label in a round
+    :param random_state: (np.random.RandomState) random number generator
+    :param quiet: (bool) verbosity of logging
+    :return: (ndarray) community label per node, renumbered 0..n_communities - 1
+    """
+    random_state = random_state or np.random.RandomState()
+    n_nodes = graph.n_nodes
+    labels = np.arange(n_nodes, dtype=np.int64)
+    rows = np.repeat(np.arange(n_nodes, dtype=np.int64), graph.degrees())
+    cols = np.asarray(graph.neighbours, dtype=np.int64)
+    weights = np.asarray(graph.weights, dtype=np.float64)
+
+    # a small self-weight keeps the current label on ties
+    rows = np.concatenate([rows, np.arange(n_nodes)])
+    cols = np.concatenate([cols, np.arange(n_nodes)])
+    self_weight = 1e-6 * (weights.max() if len(weights) else 1.)
+    weights = np.concatenate([weights, np.full(n_nodes, self_weight)])
+
+    for i in range(max_iter):
+        # total weight per (node, neighbour label)
+        keys = rows * n_nodes + labels[cols]
+        uniq, inverse = np.unique(keys, return_inverse=True)
+        totals = np.bincount(inverse, weights=weights)
+        key_rows = uniq // n_nodes
+
+        # the best label per node; random jitter breaks remaining ties
+        jitter = random_state.random_sample(len(totals)) * self_weight * 1e-3
+        order = np.lexsort((-(totals + jitter), key_rows))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = key_rows[order][1:] != key_rows[order][:-1]
+        best = np.empty(n_nodes, dtype=np.int64)
+        best[key_rows[order][first]] = uniq[order][first] % n_nodes
+
+        update = random_state.random_sample(n_nodes) < update_fraction
+        changed = update & (best != labels)
+        labels[changed] = best[changed]
+        n_changed = np.count_nonzero(changed)
+        if not quiet:
+            print('Round {}: {} labels changed'.format(i + 1, n_changed))
+
+        if i > 0 and n_changed < tol * n_nodes:
+            break
+
+    return np.unique(labels, return_inverse=True)[1]
+
+
+def modularity(graph, labels):
+    """
+    Newman modularity of a partition
+
+    :param graph: (CsrGraph) input graph
+    :param labels: (ndarray) community label per node
+    :return: (float)
+    """
+    rows = np.repeat(np.arange(graph.n_nodes), graph.degrees())
+    weights = np.asarray(graph.weights, dtype=np.float64)
+    two_m = weights.sum()
+    if two_m == 0:
+        return 0.
+
+    n_communities = labels.max() + 1
+    internal = np.bincount(labels[rows], weights=weights * (labels[rows] == labels[graph.neighbours]),
+                           minlength=n_communities)
+    strength = np.bincount(labels[rows], weights=weights, minlength=n_communities)
+    return float(np.sum(internal / two_m - (strength / two_m) ** 2))
+
+
+def write_communities(db, graph, labels, batch_size=10000):
+    """
+    Bulk update the `community` attribute of every vertex, one AQL query per batch per collection
+
+    :param db: (arango.database.StandardDatabase) database holding the graph
+    :param graph: (CsrGraph) exported graph
+    :param labels: (ndarray) community label per node
+    :param batch_size: (int) number of documents per query
+    """
+    docs_by_collection = {}
+    for _id, label in zip(graph.ids, labels):
+        collection, key = str(_id).split('/', 1)
+        docs_by_collection.setdefault(collection, []).append({'_key': key, 'community': int(label)})
+
+    for collection, docs in docs_by_collection.items():
+        for start in range(0, len(docs), batch_size):
+            db.aql.execute(UPDATE_COMMUNITIES_AQL,
+                           bind_vars={'docs': docs[start:start + batch_size], '@collection': collection})
+
+
+def run(constants):
+    arango = ArangoDb()
+    graph = export_graph(arango.db, 'logs', cache_dir=str(GRAPH_CACHE_DIR), refresh=not constants['cached'])
+    labels = label_propagation(graph, max_iter=constants['max_iter'])
+    print('Found {} communities, modularity: {:.3f}'.format(labels.max() + 1 if len(labels) else 0,
+                                                            modularity(graph, labels)))
+    write_communities(arango.db, graph, labels)
+
+
+if __name__ == '__main__':
+    # read args
+    parser = ArgumentParser(description='Detect communities in the log graph')
+    parser.add_argument('--max-iter', dest='max_iter', type=int, default=50, help='maximum number of rounds')
+    parser.add_argument('--cached', dest='cached', help='reuse the last graph export instead of re-reading ArangoDB',
+                        action='store_true')
+    parser.set_defaults(cached=False)
+    args = parser.parse_args()
+
+    run(vars(args))
@@ -0,0 +1,244 @@
+"""
+Extract the k-hop neighbourhood of indicators (IPs, users, URLs, ...) from the CSR graph
+export in process, with a frontier-at-a-time BFS: every hop gathers the neighbour rows of the
+whole frontier at once, so the cost is proportional to the size of the subgraph, not the graph.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+
+
+class Subgraph(object):
+    """
+    Result of a neighbourhood query. Nodes are ordered by hop distance from the seeds; edges
+    are undirected, stored once, and refer to nodes by their position in `nodes`.
+    """
+
+    def __init__(self, nodes, ids, hops, src, dst, weights, edge_types, edge_type_names, truncated):
+        self.nodes = nodes  # node indices into the full graph
+        self.ids = ids
+        self.hops = hops
+        self.src = src
+        self.dst = dst
+        self.weights = weights
+        self.edge_types = edge_types
+        self.edge_type_names = edge_type_names
+        self.truncated = truncated  # True when the node budget cut the BFS short
+
+    @property
+    def n_nodes(self):
+        return len(self.nodes)
+
+    @property
+    def n_edges(self):
+        return len(self.src)
+
+    def to_dict(self, compact=False):
+        """
+        JSON-serializable form of the subgraph
+
+        :param compact: (bool) parallel arrays instead of a list of objects per node and edge
+        :return: (dict)
+        """
+        if compact:
+            return {
+                'ids': self.ids.tolist(),
+                'hops': self.hops.tolist(),
+                'src': self.src.tolist(),
+                'dst': self.dst.tolist(),
+                'weights': self.weights.tolist(),
+                'types': self.edge_types.tolist(),
+                'type_names': self.edge_type_names,
+                'truncated': self.truncated
+            }
+
+        return {
+            'nodes': [{'id': _id, 'hop': hop} for _id, hop in zip(self.ids.tolist(), self.hops.tolist())],
+            'edges': [{'source': self.ids[i], 'target': self.ids[j], 'weight': w, 'type': self.edge_type_names[t]}
+                      for i, j, w, t in zip(self.src.tolist(), self.dst.tolist(), self.weights.tolist(),
+                                            self.edge_types.tolist())],
+            'truncated': self.truncated
+        }
+
+
+class NeighbourhoodService(object):
+    """
+    Answers k-hop neighbourhood queries over a (typically memory-mapped) `CsrGraph`, keeping
+    the results for the most recently requested seeds in an LRU cache.
+    """
+
+    def __init__(self, graph, cache_size=256):
+        """
+
+        :param graph: (CsrGraph) exported graph
+        :param cache_size: (int) number of query results to keep; 0 disables the cache
+        """
+        self.graph = graph
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = Lock()
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def neighbourhood(self, seeds, hops=2, edge_types=None, max_nodes=10000, max_degree=None):
+        """
+        Subgraph induced by all nodes within `hops` of the seeds
+
+        :param seeds: (list) vertex `_id`s; unknown ids are ignored
+        :param hops: (int) maximum distance from the seeds
+        :param edge_types: (list) edge collection names to follow; all when None
+        :param max_nodes: (int) node budget. When a hop would exceed it, the new nodes most
+               strongly connected (by total edge weight) to the frontier are kept and the BFS stops
+        :param max_degree: (int) nodes with a higher degree are included but not expanded, so
+               that hubs such as a shared gateway IP do not pull in most of the graph
+        :return: (Subgraph)
+        """
+        key = (tuple(sorted(set(str(seed) for seed in seeds))), hops,
+               None if edge_types is None else tuple(sorted(set(edge_types))), max_nodes, max_degree)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.n_hits += 1
+                return self.cache[key]
+
+            self.n_misses += 1
+
+        type_mask = self._type_mask(edge_types)
+        index = self.graph.index
+        seeds = np.array(sorted(index[seed] for seed in key[0] if seed in index), dtype=np.int64)
+        nodes, node_hops, truncated = self._bfs(seeds, hops, type_mask, max_nodes, max_degree)
+        result = self._induced_subgraph(nodes, node_hops, type_mask, truncated)
+        if self.cache_size > 0:
+            with self.lock:
+                self.cache[key] = result
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+
+        return result
+
+    def _type_mask(self, edge_types):
+        """ Boolean mask over edge type indices, or None to follow every type """
+        if edge_types is None:
+            return None
+
+        names = self.graph.edge_type_names
+        unknown = set(edge_types) - set(names)
+        if unknown:
+            raise ValueError('Unknown edge types: {}'.format(', '.join(sorted(unknown))))
+
+        return np.isin(np.arange(len(names)), [names.index(name) for name in edge_types])
+
+    def _bfs(self, seeds, hops, type_mask, max_nodes, max_degree):
+        """
+        :return: (ndarray, ndarray, bool) node indices in hop order, hop per node, truncated
+        """
+        graph = self.graph
+        visited = seeds  # kept sorted for membership tests by binary search
+        levels = [seeds]
+        frontier = seeds
+        truncated = False
+        for _ in range(hops):
+            if max_degree is not None:
+                frontier = frontier[graph.offsets[frontier + 1] - graph.offsets[frontier] <= max_degree]
+
+            pos, _ = _row_positions(graph.offsets, frontier)
+            if type_mask is not None:
+                pos = pos[type_mask[graph.edge_types[pos]]]
+
+            cand = np.asarray(graph.neighbours[pos], dtype=np.int64)
+            new = ~_isin_sorted(cand, visited)
+            found, inverse = np.unique(cand[new], return_inverse=True)
+            if len(found) == 0:
+                break
+
+            budget = max_nodes - len(visited)
+            if len(found) > budget:
+                strength = np.bincount(inverse, weights=graph.weights[pos][new], minlength=len(found))
+                found = np.sort(found[np.argsort(-strength, kind='mergesort')[:max(budget, 0)]])
+                truncated = True
+
+            levels.append(found)
+            visited = np.union1d(visited, found)
+            frontier = found
+            if truncated:
+                break
+
+        return np.concatenate(levels), np.repeat(np.arange(len(levels), dtype=np.int8),
+                                                 [len(x) for x in levels]), truncated
+
+    def _induced_subgraph(self, nodes, node_hops, type_mask, truncated):
+        """
+        Collects the edges between the selected nodes. Rows shorter than the node set are
+        scanned; longer rows (hubs) are binary searched for each selected node instead, so
+        a hub never costs more than the subgraph it belongs to.
+        """
+        graph = self.graph
+        sorter = np.argsort(nodes, kind='mergesort')
+        sorted_nodes = nodes[sorter]
+        degrees = graph.offsets[nodes + 1] - graph.offsets[nodes]
+        small = degrees <= len(nodes)
+
+        pos, rows = _row_positions(graph.offsets, nodes[small])
+        keep = _isin_sorted(np.asarray(graph.neighbours[pos], dtype=np.int64), sorted_nodes)
+        pos, rows = pos[keep], rows[keep]
+
+        hubs = nodes[~small]
+        if len(hubs):
+            hub_rows = np.repeat(hubs, len(nodes))
+            hub_pos = graph.edge_positions(hub_rows, np.tile(sorted_nodes, len(hubs)))
+            found = hub_pos >= 0
+            pos = np.concatenate([pos, hub_pos[found]])
+            rows = np.concatenate([rows, hub_rows[found]])
+
+        if type_mask is not None:
+            keep = type_mask[graph.edge_types[pos]]
+            pos, rows = pos[keep], rows[keep]
+
+        # every edge was found from both ends; keep one copy
+        cols = np.asarray(graph.neighbours[pos], dtype=np.int64)
+        upper = rows <= cols
+        pos, rows, cols = pos[upper], rows[upper], cols[upper]
+        order = np.lexsort((cols, rows))
+        pos, rows, cols = pos[order], rows[order], cols[order]
+
+        return Subgraph(nodes.astype(np.int32), np.array([str(_id) for _id in graph.ids[nodes]]), node_hops,
+                        sorter[np.searchsorted(sorted_nodes, rows)].astype(np.int32),
+                        sorter[np.searchsorted(sorted_nodes, cols)].astype(np.int32),
+                        np.asarray(graph.weights[pos]), np.asarray(graph.edge_types[pos]),
+                        graph.edge_type_names, truncated)
+
+    def clear_cache(self):
+        """ Call after the graph has been re-exported """
+        with self.lock:
+            self.cache.clear()
+
+    def stats(self):
+        return {
+            'cached': len(self.cache),
+            'hits': self.n_hits,
+            'misses': self.n_misses
+        }
+
+
+def _row_positions(offsets, nodes):
+    """
+    Positions in the CSR arrays of all the rows of `nodes`, concatenated
+
+    :return: (ndarray, ndarray) edge positions and the node owning each position
+    """
+    starts = np.asarray(offsets[nodes], dtype=np.int64)
+    degrees = np.asarray(offsets[nodes + 1], dtype=np.int64) - starts
+    ends = np.cumsum(degrees)
+    pos = np.arange(ends[-1] if len(ends) else 0) + np.repeat(starts - (ends - degrees), degrees)
+    return pos, np.repeat(nodes, degrees)
+
+
+def _isin_sorted(x, sorted_values):
+    """ `np.isin` against an already sorted array """
+    if len(sorted_values) == 0:
+        return np.zeros(len(x), dtype=bool)
+
+    pos = np.minimum(np.searchsorted(sorted_values, x), len(sorted_values) - 1)
+    return sorted_values[pos] == x
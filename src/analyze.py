@@ -5,43 +5,64 @@ from argparse import ArgumentParser
 from pathlib import Path
 
 from arango_util import ArangoDb
-from ml.url_classifier.bilstm import BiLstmPredictor
+from ml.url_classifier.bilstm_numpy import load_predictor
+from ml.url_classifier.verdict_cache import UrlVerdictCache
 
 ROOT = Path(__file__).parent.parent
+BATCH_SIZE = 1024
 
 
 def scan_for_malicious_urls(constants):
     model_path = ROOT / os.getenv('MODELS_DIR')
-    predictor = BiLstmPredictor()
-    predictor.load_model(model_path)
+    classifier = UrlVerdictCache.from_models_dir(load_predictor(model_path), model_path)
     if constants['is_stream']:
-        for line in sys.stdin.readlines():
-            log = json.loads(line.strip())
-            for param in log['params']:
-                if param['entity'] == 'url':
-                    pred = predictor.predict(param['value'])
-                    if pred == 1:  # bad
-                        param['meta'] = {'malicious_warning': True}
-                    else:
-                        param['meta'] = {'malicious_warning': False}
+        logs = [json.loads(line.strip()) for line in sys.stdin.readlines()]
+        url_params = [param for log in logs for param in log['params'] if param['entity'] == 'url']
+        preds = classifier.predict_batch([param['value'] for param in url_params])
+        for param, pred in zip(url_params, preds):
+            param['meta'] = {'malicious_warning': bool(pred == 1)}  # 1 is bad
 
+        for log in logs:
             print(json.dumps(log))
 
     else:
         arango = ArangoDb()
         db = arango.db
         aql = db.aql
-        cursor = aql.execute('for doc in urls return doc')
+        cursor = aql.execute('for doc in urls return doc', batch_size=BATCH_SIZE)
         bad_urls = []
+        docs = []
         for doc in cursor:
-            pred = predictor.predict(doc.name)
-            if pred == 1:  # bad
-                doc['malicious_warning'] = True
-                bad_urls.append(doc.name)
-            else:
-                doc['malicious_warning'] = False
-
-            db.update_document(doc)
+            docs.append(doc)
+            if len(docs) == BATCH_SIZE:
+                bad_urls.extend(update_url_docs(db, classifier, docs))
+                docs = []
+
+        bad_urls.extend(update_url_docs(db, classifier, docs))
+
+    classifier.save()
+    print('URL verdicts: {}'.format(classifier.stats()), file=sys.stderr)
+
+
+def update_url_docs(db, classifier, docs):
+    """
+    Classify a batch of URL documents and store the verdicts
+
+    :param db: (arango.database.StandardDatabase) database holding the urls collection
+    :param classifier: (UrlVerdictCache) cached URL classifier
+    :param docs: (list) URL documents
+    :return: (list) malicious URLs
+    """
+    bad_urls = []
+    preds = classifier.predict_batch([doc['name'] for doc in docs])
+    for doc, pred in zip(docs, preds):
+        doc['malicious_warning'] = bool(pred == 1)  # 1 is bad
+        if doc['malicious_warning']:
+            bad_urls.append(doc['name'])
+
+        db.update_document(doc)
+
+    return bad_urls
 
 
 if __name__ == '__main__':
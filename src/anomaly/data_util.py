@@ -1,10 +1,12 @@
-from collections import defaultdict, OrderedDict
+from collections import defaultdict
 import json
+import os
 import numpy as np
 import pandas as pd
-import re
 import sklearn.utils as sk_utils
 
+BLOCK_ID_PATTERN = r'(blk_-?\d+)'
+
 
 def load_event_sequences(data_dir, save_csv=False):
     data_dict = defaultdict(list)
@@ -24,7 +26,8 @@ def load_event_sequences(data_dir, save_csv=False):
     return df['event_sequence'].values
 
 
-def load_hdfs_dataset(log_filename, label_filename=None, window='session', test_ratio=.5, save_csv=False):
+def load_hdfs_dataset(log_filename, label_filename=None, window='session', test_ratio=.5, save_csv=False,
+                      cache=False):
     """
     Load HDFS structured log into train and test datasets
 
@@ -33,6 +36,8 @@ def load_hdfs_dataset(log_filename, label_filename=None, window='session', test_
     :param window: (str) window option; default is 'session'
     :param test_ratio: ratio of test split
     :param save_csv:
+    :param cache: (bool) keep the event sequences of a CSV log in `<log_filename>.seq.npz`, and
+           reload them from there while it is newer than the log
     :return:
         (x_train, y_train) training data
         (x_test, y_test) test data
@@ -58,23 +63,11 @@ def load_hdfs_dataset(log_filename, label_filename=None, window='session', test_
         y_test = np.hstack([y_pos[train_pos:], y_neg[train_neg:]])
     elif log_filename.endswith('.csv'):
         assert window == 'session', 'Only window="session" is supported for the HDFS dataset'
-        struct_log = pd.read_csv(log_filename, engine='c', na_filter=False, memory_map=True)
-        data_dict = OrderedDict()
-        for i, row in struct_log.iterrows():
-            blk_id_list = re.findall(r'(blk_-?\d+)', row['Content'])
-            blk_id_set = set(blk_id_list)
-            for blk_id in blk_id_set:
-                if blk_id not in data_dict:
-                    data_dict[blk_id] = []
-
-                data_dict[blk_id].append(row['EventId'])
-
-        data_df = pd.DataFrame(list(data_dict.items()), columns=['BlockId', 'EventSequence'])
+        data_df = _load_block_sequences(log_filename, cache)
         if label_filename:
-            label_data = data_df[data_df['Label'] == 1].reset_index()
-            label_data = label_data.set_index('BlockId')
-            label_dict = label_data['Label'].to_dict()
-            data_df['Label'] = data_df['BlockId'].apply(lambda x: 1 if label_dict[x] == 'Anomaly' else 0)
+            label_data = pd.read_csv(label_filename, engine='c', na_filter=False, memory_map=True)
+            label_dict = label_data.set_index('BlockId')['Label']
+            data_df['Label'] = (data_df['BlockId'].map(label_dict) == 'Anomaly').astype(int)
 
             # Split train and test data
             pos_data = data_df[data_df['Label'] == 1].reset_index()
@@ -109,3 +102,51 @@ def load_hdfs_dataset(log_filename, label_filename=None, window='session', test_
     print('Test: {} instances, {} anomalies, {} normal'.format(n_test, n_test_pos, n_test - n_test_pos))
 
     return (x_train, y_train), (x_test, y_test)
+
+
+def _load_block_sequences(log_filename, cache=False):
+    """
+    Event sequences per HDFS block ID, in order of first mention
+
+    :param log_filename: (str) filename of structured log file
+    :param cache: (bool) read and write `<log_filename>.seq.npz`
+    :return: (pandas.DataFrame) with columns 'BlockId' and 'EventSequence'
+    """
+    cache_filename = log_filename + '.seq.npz'
+    if cache and os.path.exists(cache_filename) and os.path.getmtime(cache_filename) >= os.path.getmtime(log_filename):
+        with np.load(cache_filename) as data:
+            blocks, events, codes, offsets = data['blocks'], data['events'], data['codes'], data['offsets']
+    else:
+        struct_log = pd.read_csv(log_filename, engine='c', na_filter=False, memory_map=True,
+                                 usecols=['Content', 'EventId'], dtype=str)
+        blocks, events, codes, offsets = block_sequences(struct_log['Content'], struct_log['EventId'])
+        if cache:
+            np.savez(cache_filename, blocks=blocks, events=events, codes=codes, offsets=offsets)
+
+    sequences = np.split(events[codes], offsets[1:-1]) if len(blocks) else []
+    return pd.DataFrame({'BlockId': blocks, 'EventSequence': [seq.tolist() for seq in sequences]},
+                        columns=['BlockId', 'EventSequence'])
+
+
+def block_sequences(content, event_ids):
+    """
+    Group the events of a structured HDFS log by the block IDs mentioned in each line. A line
+    mentioning a block more than once counts once for it.
+
+    :param content: (pandas.Series) log message per line
+    :param event_ids: (pandas.Series) event ID per line
+    :return: (ndarray, ndarray, ndarray, ndarray) block IDs in order of first mention, distinct
+             event IDs, the event codes of all sequences concatenated (`events[codes]`), and the
+             offsets of each block's sequence in them, shape [n_blocks + 1, ]
+    """
+    matches = content.reset_index(drop=True).str.extractall(BLOCK_ID_PATTERN)[0]
+    mentions = pd.DataFrame({'row': np.asarray(matches.index.get_level_values(0), dtype=np.int64),
+                             'block': matches.values}).drop_duplicates()
+    event_codes, events = pd.factorize(event_ids)
+    block_codes, blocks = pd.factorize(mentions['block'])
+
+    # mentions are in line order, so a stable sort by block keeps each sequence in line order
+    order = np.argsort(block_codes, kind='stable')
+    codes = event_codes[mentions['row'].values[order]].astype(np.int32)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(block_codes, minlength=len(blocks)))]).astype(np.int64)
+    return np.asarray(blocks, dtype=str), np.asarray(events, dtype=str), codes, offsets
@@ -1,4 +1,3 @@
-from sklearn.tree import DecisionTreeClassifier
 from util import metrics
 
 
@@ -12,6 +11,8 @@ class DecisionTree(object):
             on Autonomic Computing (ICAC), 2004.
     """
     def __init__(self, criterion='gini', max_depth=None, max_features=None, class_weight=None):
+        from sklearn.tree import DecisionTreeClassifier
+
         self.classifier = DecisionTreeClassifier(criterion=criterion, max_depth=max_depth,
                                                  max_features=max_features, class_weight=class_weight)
 
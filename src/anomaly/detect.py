@@ -2,6 +2,8 @@ from argparse import ArgumentParser
 from anomaly.data_util import load_event_sequences, load_hdfs_dataset
 from anomaly.feature_extractor import FeatureExtractor
 from anomaly.invariants_miner import InvariantsMiner
+from anomaly.model_bundle import BUNDLE_DIRNAME, ModelBundle
+import os
 from pathlib import Path
 
 ROOT_DIR = Path(__file__).parent.parent
@@ -18,11 +20,14 @@ def run(constants):
     print('Training')
 
     # Initialize one of the unsupervised models: PCA, LogClustering, or InvariantsMiner
-    model = InvariantsMiner()
+    model = InvariantsMiner(n_jobs=-1)
 
     # Model hyperparameters may be sensitive to log data
     model.fit(x_train)
 
+    # Save the fitted feature extractor and model for online scoring (`anomaly/online_scoring.py`)
+    ModelBundle(feature_extractor, model).save(ROOT_DIR.parent / os.getenv('MODELS_DIR', 'models') / BUNDLE_DIRNAME)
+
     # Make predictions and manually check for correctness
     y_pred = model.predict(x_train)
 
@@ -30,7 +35,7 @@ def run(constants):
     print('Testing')
 
     # Load another new log file. Here we use `STRUCT_LOG` for demo only.
-    (x_test, _), (_, _) = load_hdfs_dataset(str(STRUCT_LOG), window='session')
+    (x_test, _), (_, _) = load_hdfs_dataset(str(STRUCT_LOG), window='session', cache=True)
 
     # Use same feature extraction process as training - using `transform` instead
     x_test = feature_extractor.transform(x_test)
@@ -1,21 +1,81 @@
-from collections import Counter
+from itertools import chain
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 # noinspection PyUnresolvedReferences
 from scipy.special import expit
 
 
+class CenteredMatrix(object):
+    """
+    A sparse matrix minus a dense row vector, `x - mean`, kept implicit so that zero-mean
+    features stay sparse. Products are computed as `x @ v - mean @ v`.
+    """
+
+    def __init__(self, x, mean):
+        """
+
+        :param x: (scipy.sparse.csr_matrix) uncentered matrix, shape [n_instances, n_events]
+        :param mean: (ndarray) vector subtracted from every row, shape [n_events, ]
+        """
+        self.x = x
+        self.mean = np.asarray(mean, dtype=np.float64).ravel()
+
+    @property
+    def shape(self):
+        return self.x.shape
+
+    def dot(self, v):
+        """
+        :param v: (ndarray) vector or matrix with `n_events` rows
+        :return: (ndarray) `(x - mean) @ v`
+        """
+        if sp.issparse(v):
+            v = v.toarray()
+
+        return self.x @ v - self.mean @ v
+
+    def __matmul__(self, v):
+        return self.dot(v)
+
+    def gram(self):
+        """
+        :return: (ndarray) `(x - mean).T @ (x - mean)`, shape [n_events, n_events]
+        """
+        col_sums = np.asarray(self.x.sum(axis=0)).ravel()
+        gram = (self.x.T @ self.x).toarray()
+        gram -= np.outer(col_sums, self.mean) + np.outer(self.mean, col_sums)
+        gram += self.x.shape[0] * np.outer(self.mean, self.mean)
+        return gram
+
+    def columns(self, cols):
+        """
+        :param cols: (list) column indices
+        :return: (ndarray) dense centered sub-matrix, shape [n_instances, len(cols)]
+        """
+        return self.x[:, cols].toarray() - self.mean[cols]
+
+    def __getitem__(self, rows):
+        """ Select rows, keeping the centering implicit """
+        x = self.x[rows]
+        return CenteredMatrix(x if sp.issparse(x) else sp.csr_matrix(x), self.mean)
+
+    def toarray(self):
+        return self.x.toarray() - self.mean
+
+
 class FeatureExtractor(object):
 
     def __init__(self):
         self.idf_vec = None
         self.mean_vec = None
         self.events = None
+        self.vocab = None  # event -> column index
         self.term_weighting = None
         self.normalization = None
         self.oov = None
 
-    def fit_transform(self, x_seq, term_weighting=None, normalization=None, oov=False, min_count=1):
+    def fit_transform(self, x_seq, term_weighting=None, normalization=None, oov=False, min_count=1, sparse=False):
         """
         Fit and transform the data matrix.
 
@@ -24,81 +84,132 @@ class FeatureExtractor(object):
         :param normalization: (str) 'zero-mean', 'sigmoid', or None
         :param oov: (bool) flag to use OOV event
         :param min_count: (int) minimum number of events (default: 1), valid only when oov=True
+        :param sparse: (bool) return a `scipy.sparse.csr_matrix`, or a `CenteredMatrix` with
+               'zero-mean' normalization, instead of a dense array
         :return: x_new: transformed data matrix
         """
         self.term_weighting = term_weighting
         self.normalization = normalization
         self.oov = oov
-        x_counts = []
-        for i in range(x_seq.shape[0]):
-            event_counts = Counter(x_seq[i])
-            x_counts.append(event_counts)
-
-        x_df = pd.DataFrame(x_counts)
-        x_df = x_df.fillna(0)
-        self.events = x_df.columns
-        x = x_df.values
+
+        # columns in order of first appearance
+        codes, events = pd.factorize(np.array(list(chain.from_iterable(x_seq)), dtype=object))
+        x = _count_matrix(codes, [len(seq) for seq in x_seq], len(events))
+        self.events = list(events)
         if self.oov:
             oov_vec = np.zeros(x.shape[0])
             if min_count > 1:
-                idx = np.sum(x > 0, axis=0) >= min_count
-                oov_vec = np.sum(x[:, ~idx] > 0, axis=1)
+                idx = np.asarray((x > 0).sum(axis=0)).ravel() >= min_count
+                oov_vec = np.asarray((x[:, ~idx] > 0).sum(axis=1)).ravel()
                 x = x[:, idx]
-                self.events = np.array(x_df.columns)[idx].tolist()
+                self.events = np.array(self.events, dtype=object)[idx].tolist()
 
-            x = np.hstack([x, oov_vec.reshape(x.shape[0], 1)])
+            x = sp.hstack([x, sp.csr_matrix(oov_vec.reshape(x.shape[0], 1))], format='csr')
 
+        self.vocab = {event: i for i, event in enumerate(self.events)}
         n_instances, n_events = x.shape
         if self.term_weighting == 'tf-idf':
-            df_vec = np.sum(x > 0, axis=0)
+            df_vec = np.asarray((x > 0).sum(axis=0)).ravel()
             self.idf_vec = np.log(n_instances / (df_vec + 1e-8))
-            idf_mat = x * np.tile(self.idf_vec, (n_instances, 1))
-            x = idf_mat
+            x = x @ sp.diags(self.idf_vec)
 
+        x = sp.csr_matrix(x)
         if self.normalization == 'zero-mean':
-            mean_vec = x.mean(axis=0)
-            self.mean_vec = mean_vec.reshape(1, n_events)
-            x = x - np.tile(self.mean_vec, (n_instances, 1))
-        elif self.normalization == 'sigmoid':
-            x[x != 0] = expit(x[x != 0])
+            self.mean_vec = np.asarray(x.mean(axis=0)).reshape(1, n_events)
 
-        x_new = x
+        x_new = self._normalize(x, sparse)
         print('Train data shape: {}-by-{}\n'.format(x_new.shape[0], x_new.shape[1]))
         return x_new
 
-    def transform(self, x_seq):
+    def transform(self, x_seq, sparse=False):
         """
         Transform the data matrix using trained parameters.
 
         :param x_seq: log sequences matrix
+        :param sparse: (bool) return a sparse matrix (see `fit_transform`)
         :return: x_new: transformed data matrix
         """
-        x_counts = []
-        for i in range(x_seq.shape[0]):
-            event_counts = Counter(x_seq[i])
-            x_counts.append(event_counts)
-
-        x_df = pd.DataFrame(x_counts)
-        x_df = x_df.fillna(0)
-        empty_events = set(self.events) - set(x_df.columns)
-        for event in empty_events:
-            x_df[event] = [0] * len(x_df)
-
-        x = x_df[self.events].values
+        vocab = self.vocab
+        flat = np.array(list(chain.from_iterable(x_seq)), dtype=object)
+        codes = np.fromiter((vocab.get(event, -1) for event in flat), dtype=np.int64, count=len(flat))
+        n_instances = len(x_seq)
+        rows = np.repeat(np.arange(n_instances), [len(seq) for seq in x_seq])
+        known = codes >= 0
+        x = _count_matrix(codes[known], np.bincount(rows[known], minlength=n_instances), len(self.events))
         if self.oov:
-            oov_vec = np.sum(x_df[x_df.columns.difference(self.events)].values > 0, axis=1)
-            x = np.hstack([x, oov_vec.reshape([x.shape[0], 1])])
+            # number of distinct unseen events per sequence
+            unseen = pd.DataFrame({'row': rows[~known], 'event': flat[~known]})
+            oov_vec = np.bincount(unseen.drop_duplicates()['row'].values, minlength=n_instances)
+            x = sp.hstack([x, sp.csr_matrix(oov_vec.reshape(n_instances, 1))], format='csr')
 
-        n_instances, n_events = x.shape
+        x_new = self._weight(x, sparse)
+        print('Test data shape: {}-by-{}\n'.format(x_new.shape[0], x_new.shape[1]))
+        return x_new
+
+    def transform_counts(self, counters, sparse=True):
+        """
+        Transform already counted sequences using trained parameters, e.g. sessions whose
+        event counts were accumulated online. Events are matched by their string form, as
+        counts that went through JSON have string keys whatever the type of the trained events.
+
+        :param counters: (list) of dicts of event -> count, one per sequence
+        :param sparse: (bool) return a sparse matrix (see `fit_transform`)
+        :return: x_new: transformed data matrix
+        """
+        vocab = {str(event): i for event, i in self.vocab.items()}
+        n_instances = len(counters)
+        rows = []
+        cols = []
+        counts = []
+        oov_vec = np.zeros(n_instances)
+        for i, counter in enumerate(counters):
+            for event, count in counter.items():
+                col = vocab.get(str(event))
+                if col is not None:
+                    rows.append(i)
+                    cols.append(col)
+                    counts.append(count)
+                elif count > 0:
+                    oov_vec[i] += 1
+
+        x = sp.csr_matrix((np.array(counts, dtype=np.float64), (rows, cols)), shape=(n_instances, len(self.events)))
+        if self.oov:
+            x = sp.hstack([x, sp.csr_matrix(oov_vec.reshape(n_instances, 1))], format='csr')
+
+        return self._weight(x, sparse)
+
+    def _weight(self, x, sparse):
+        """ Apply the fitted term weighting and normalization to a count matrix """
         if self.term_weighting == 'tf-idf':
-            idf_mat = x * np.tile(self.idf_vec, (n_instances, 1))
-            x = idf_mat
+            x = sp.csr_matrix(x @ sp.diags(self.idf_vec))
 
-        if self.normalization == 'zero_mean':
-            x = x - np.tile(self.mean_vec, (n_instances, 1))
-        elif self.normalization == 'sigmoid':
-            x[x != 0] = expit(x[x != 0])
+        return self._normalize(x, sparse)
 
-        x_new = x
-        print('Test data shape: {}-by-{}\n'.format(x_new.shape[0], x_new.shape[1]))
-        return x_new
+    def _normalize(self, x, sparse):
+        if self.normalization == 'zero-mean':
+            if sparse:
+                return CenteredMatrix(x, self.mean_vec)
+
+            return x.toarray() - self.mean_vec
+
+        if self.normalization == 'sigmoid':
+            x.eliminate_zeros()
+            x.data = expit(x.data)
+
+        return x if sparse else x.toarray()
+
+
+def _count_matrix(codes, lengths, n_events):
+    """
+    Event count matrix from flattened column codes
+
+    :param codes: (ndarray) column index of every event, sequences concatenated
+    :param lengths: (list) number of events per sequence
+    :param n_events: (int) number of columns
+    :return: (scipy.sparse.csr_matrix) shape [len(lengths), n_events]
+    """
+    indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    x = sp.csr_matrix((np.ones(len(codes)), np.asarray(codes, dtype=np.int64), indptr),
+                      shape=(len(lengths), n_events))
+    x.sum_duplicates()
+    return x
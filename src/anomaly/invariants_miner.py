@@ -1,5 +1,6 @@
-from itertools import combinations
+from itertools import combinations, islice
 import numpy as np
+import scipy.sparse as sp
 from util import metrics
 
 
@@ -12,7 +13,8 @@ class InvariantsMiner(object):
             from Console Logs for System Problem Detection. USENIX Annual Technical
             Conference (ATC), 2010.
     """
-    def __init__(self, percentage=0.98, epsilon=0.5, longest_invariant=None, scale_list=None):
+    def __init__(self, percentage=0.98, epsilon=0.5, longest_invariant=None, scale_list=None, n_jobs=1,
+                 batch_size=4096, svd_solver='full', n_components=100, block_size=32):
         """
 
         :param percentage: (float) percentage of samples satisfying the condition that |X_j * V_i| < epsilon
@@ -20,6 +22,13 @@ class InvariantsMiner(object):
         :param longest_invariant: (int) maximum length of the invariant. Default is None.
                Stop searching when the invariant length is greater than this argument.
         :param scale_list: (list) used to scale theta of float into integer
+        :param n_jobs: (int) number of processes checking candidate invariants; -1 for all CPUs
+        :param batch_size: (int) number of candidates checked ahead in parallel
+        :param svd_solver: (str) 'full', or 'truncated' to compute only the `n_components`
+               smallest singular vectors when estimating the invariant space of wide matrices
+        :param n_components: (int) number of singular vectors for the truncated solver, which
+               also bounds the estimated dimension of the invariant space
+        :param block_size: (int) number of singular vectors projected at a time
         """
         if scale_list is None:
             scale_list = [1, 2, 3]
@@ -28,10 +37,16 @@ class InvariantsMiner(object):
         self.epsilon = epsilon
         self.longest_invariant = longest_invariant
         self.scale_list = scale_list
+        self.n_jobs = n_jobs
+        self.batch_size = batch_size
+        self.svd_solver = svd_solver
+        self.n_components = n_components
+        self.block_size = block_size
 
         # dictionary of invariants where key is the selected columns and value is the
         # weights of the invariant
         self.invariants = None
+        self.theta = None  # the invariants as a sparse matrix, built on first use
 
     def fit(self, x):
         """
@@ -49,11 +64,43 @@ class InvariantsMiner(object):
         :param x: (ndarray) the input event count matrix
         :return: y_pred: (ndarray) the predicted label vector, shape [n_instances, ]
         """
-        y_sum = np.zeros(x.shape[0])
-        for cols, theta in self.invariants.items():
-            y_sum += np.fabs(np.dot(x[:, cols], np.array(theta)))
+        return (self.score(x) > 1e-6).astype(int)
 
-        return (y_sum > 1e-6).astype(int)
+    def score(self, x):
+        """
+        Total violation of the mined invariants, computed for all invariants at once as
+        `|x @ theta|` summed over the columns of the invariant matrix
+
+        :param x: (ndarray) the input event count matrix; may also be sparse or a `CenteredMatrix`
+        :return: (ndarray) violation per instance, shape [n_instances, ]
+        """
+        if self.theta is None or self.theta.shape[0] != x.shape[1]:
+            self.theta = self.invariant_matrix(x.shape[1])
+
+        y = x @ self.theta
+        if sp.issparse(y):
+            y = y.toarray()
+
+        return np.fabs(np.asarray(y)).sum(axis=1)
+
+    def invariant_matrix(self, n_events):
+        """
+        All invariants as one sparse matrix, with column `j` holding the weights of
+        invariant `j` in the rows of its selected events
+
+        :param n_events: (int) number of events (columns of the event count matrix)
+        :return: (scipy.sparse.csc_matrix) shape [n_events, n_invariants]
+        """
+        rows = []
+        cols = []
+        weights = []
+        for j, (events, theta) in enumerate(self.invariants.items()):
+            rows.extend(events)
+            cols.extend([j] * len(events))
+            weights.extend(theta)
+
+        return sp.csc_matrix((np.array(weights, dtype=np.float64), (rows, cols)),
+                             shape=(n_events, len(self.invariants)))
 
     def evaluate(self, x, y_true):
         print('-------- Evaluation summary --------')
@@ -69,23 +116,48 @@ class InvariantsMiner(object):
         :param x: (ndarray) the event count matrix, shape [n_instances, n_events]
         :return: r: dimension of invariant space
         """
-        covariance_mat = np.dot(x.T, x)
-        u, sigma, v = np.linalg.svd(covariance_mat)  # SVD decomposition
+        n_instances, n_events = x.shape
+        covariance_mat = _gram(x)
+        if self.svd_solver == 'truncated' and self.n_components < n_events:
+            u = self._smallest_singular_vectors(covariance_mat)
+        else:
+            u, sigma, v = np.linalg.svd(covariance_mat)  # SVD decomposition
 
         # start from the right-most column of matrix V
-        # singular values are in ascending order
-        n_instances, n_events = x.shape
+        # singular values are in ascending order. Columns are projected a block at a time,
+        # stopping at the first block holding a column that is not an invariant direction
         r = 0
-        for i in range(n_events - 1, -1, -1):
-            zero_count = sum(abs(np.dot(x, u[:, i])) < self.epsilon)
-            if zero_count / float(n_instances) < self.percentage:
+        for end in range(u.shape[1], 0, -self.block_size):
+            cols = np.arange(end - 1, max(end - self.block_size, 0) - 1, -1)
+            zero_fraction = np.count_nonzero(np.fabs(x @ u[:, cols]) < self.epsilon, axis=0) / float(n_instances)
+            below = np.flatnonzero(zero_fraction < self.percentage)
+            if len(below):
+                r += below[0]
                 break
 
-            r += 1
+            r += len(cols)
 
         print('Invariant space dimension: {}'.format(r))
         return r
 
+    def _smallest_singular_vectors(self, covariance_mat):
+        """
+        The `n_components` smallest singular vectors of a covariance matrix, from a symmetric
+        eigensolver that only computes the requested eigenpairs
+
+        :param covariance_mat: (ndarray) symmetric positive semi-definite matrix
+        :return: (ndarray) singular vectors as columns, in descending order of singular value
+        """
+        from scipy.linalg import eigh
+
+        try:
+            _, u = eigh(covariance_mat, subset_by_index=[0, self.n_components - 1])
+        except TypeError:
+            # SciPy < 1.5
+            _, u = eigh(covariance_mat, eigvals=(0, self.n_components - 1))
+
+        return u[:, ::-1]
+
     def _invariants_search(self, x, r):
         """
         Mine invariant relationships from X
@@ -94,68 +166,86 @@ class InvariantsMiner(object):
         :param r: dimension of invariant space
         :return:
         """
+        # needed for training only, so that loading a fitted model stays light
+        from joblib import Parallel, delayed, effective_n_jobs
+
         n_instances, n_events = x.shape
+        x = _column_major(x)
         invariants = {}  # save the mined invariants (value) and its corresponding columns (key)
-        search_space = []  # only invariant candidates in this list are valid
+        search_space = set()  # only invariant candidates (sorted tuples of columns) in this set are valid
 
         # invariant of only one column (all zero columns)
-        init_cols = [[x] for x in range(n_events)]
-        for col in init_cols:
-            search_space.append(col)
-
-        init_col_list = init_cols[:]
-        for col in init_cols:
-            if np.count_nonzero(x[:, col]) == 0:
-                invariants[tuple(col)] = [1]
-                search_space.remove(col)
-                init_col_list.remove(col)
-
-        item_list = init_col_list
+        item_list = []
+        zero_columns = _zero_columns(x)
+        for col in range(n_events):
+            if zero_columns[col]:
+                invariants[(col,)] = [1]
+            else:
+                search_space.add((col,))
+                item_list.append((col,))
+
         length = 2
         break_loop_flag = False
 
         # check invariant of more columns
-        while len(item_list) != 0:
-            if self.longest_invariant and len(item_list[0]) >= self.longest_invariant:
-                break
-
-            joined_item_list = self._join_set(item_list, length)  # generate new invariant candidates
-            for items in joined_item_list:
-                if self._check_valid_candidates(items, length, search_space):
-                    search_space.append(items)
-
-            item_list = []
-            for item in joined_item_list:
-                if tuple(item) in invariants:
-                    continue
-
-                if item not in search_space:
-                    continue
-
-                # an item must be a superset of all other sub-items in search_space, else skip
-                if not self._check_valid_candidates(tuple(item), length, search_space) and length > 2:
-                    search_space.remove(item)
-                    continue
-
-                validity, scaled_theta = self._check_invar_validity(x, item)
-                if validity:
-                    self._prune(invariants.keys(), set(item), search_space)
-                    invariants[tuple(item)] = scaled_theta.tolist()
-                    search_space.remove(item)
-                else:
-                    item_list.append(item)
-
-                if len(invariants) >= r:
-                    break_loop_flag = True
+        with Parallel(n_jobs=self.n_jobs) as parallel:
+            while len(item_list) != 0:
+                if self.longest_invariant and len(item_list[0]) >= self.longest_invariant:
                     break
 
-            if break_loop_flag:
-                break
+                # generate new invariant candidates, all of whose sub-items are in `search_space`
+                joined_item_list = [item for item in self._join_set(item_list, length)
+                                    if self._check_valid_candidates(item, length, search_space)]
+                search_space.update(joined_item_list)
+
+                # validity checks are independent of the search state, so they run ahead in
+                # parallel batches; the results are consumed in candidate order as before
+                results = {}
+                item_list = []
+                for i, item in enumerate(joined_item_list):
+                    if item not in search_space:
+                        continue
+
+                    # an item must be a superset of all other sub-items in search_space, else skip
+                    if not self._check_valid_candidates(item, length, search_space) and length > 2:
+                        search_space.remove(item)
+                        continue
+
+                    if self.n_jobs == 1:
+                        validity, scaled_theta = self._check_invar_validity(x, list(item))
+                    else:
+                        if item not in results:
+                            batch = list(islice((joined_item_list[j] for j in range(i, len(joined_item_list))
+                                                 if joined_item_list[j] in search_space), self.batch_size))
+                            # one task per worker, sending only the selected columns
+                            n_chunks = effective_n_jobs(self.n_jobs)
+                            chunks = [batch[j::n_chunks] for j in range(n_chunks)]
+                            checked = parallel(delayed(_check_candidates)(self, [x[:, list(it)] for it in chunk])
+                                               for chunk in chunks if chunk)
+                            for chunk, chunk_checked in zip(chunks, checked):
+                                results.update(zip(chunk, chunk_checked))
+
+                        validity, scaled_theta = results.pop(item)
+
+                    if validity:
+                        self._prune(invariants.keys(), set(item), search_space)
+                        invariants[item] = scaled_theta.tolist()
+                        search_space.remove(item)
+                    else:
+                        item_list.append(item)
+
+                    if len(invariants) >= r:
+                        break_loop_flag = True
+                        break
+
+                if break_loop_flag:
+                    break
 
-            length += 1
+                length += 1
 
         print('Mined {} invariants: {}\n'.format(len(invariants), invariants))
         self.invariants = invariants
+        self.theta = None
 
     @staticmethod
     def _compute_eigenvector(x):
@@ -169,20 +259,16 @@ class InvariantsMiner(object):
             min_vec: the eigenvector of the corresponding minimum eigen value
             contain_zero_flag: whether min_vec contains zero (very small value)
         """
-        contain_zero_flag = False
         dot_result = np.dot(x.T, x)
         u, s, v = np.linalg.svd(dot_result)
         min_vec = u[:, -1]
-        count_zero = sum(np.fabs(min_vec) < 1e-6)
-        if count_zero != 0:
-            contain_zero_flag = True
-
+        contain_zero_flag = bool(np.any(np.fabs(min_vec) < 1e-6))
         return min_vec, contain_zero_flag
 
     def _check_invar_validity(self, x, selected_columns):
         """
         Scale the eigenvector of float into integer and check whether the scaled
-        number is valid
+        number is valid. All scales are checked with a single product.
 
         :param x: the event count matrix (each row is a log sequence vector;
                each column represents an event)
@@ -191,36 +277,23 @@ class InvariantsMiner(object):
             validity: whether the selected columns are valid
             scaled_theta: the scaled theta vector
         """
-        sub_matrix = x[:, selected_columns]
+        sub_matrix = _columns(x, selected_columns)
         inst_num = x.shape[0]
-        validity = False
-        scaled_theta = None
         min_theta, contain_zero_flag = self._compute_eigenvector(sub_matrix)
-        abs_min_theta = [np.fabs(x) for x in min_theta]
         if contain_zero_flag:
-            return validity, []
-        else:
-            for i in self.scale_list:
-                min_index = np.argmin(abs_min_theta)
-                scale = float(i) / min_theta[min_index]
-                scaled_theta = np.array([round(x * scale) for x in min_theta])
-                scaled_theta[min_index] = i
-                scaled_theta = scaled_theta.T
-                if 0 in np.fabs(scaled_theta):
-                    continue
-
-                dot_submat_theta = np.dot(sub_matrix, scaled_theta)
-                count_zero = 0
-                for j in dot_submat_theta:
-                    if np.fabs(j) < 1e-8:
-                        count_zero += 1
-
-                if count_zero >= self.percentage * inst_num:
-                    validity = True
-                    # print('A valid invariant is found:', scaled_theta, selected_columns)
-                    break
+            return False, []
+
+        # one column of scaled thetas per scale
+        min_index = np.argmin(np.fabs(min_theta))
+        scales = np.asarray(self.scale_list, dtype=np.float64)
+        scaled_thetas = np.round(np.outer(min_theta, scales / min_theta[min_index])).astype(np.int64)
+        scaled_thetas[min_index] = self.scale_list
+        count_zero = np.count_nonzero(np.fabs(sub_matrix @ scaled_thetas) < 1e-8, axis=0)
+        valid = np.all(scaled_thetas != 0, axis=0) & (count_zero >= self.percentage * inst_num)
+        if np.any(valid):
+            return True, scaled_thetas[:, np.argmax(valid)]
 
-            return validity, scaled_theta
+        return False, scaled_thetas[:, -1]
 
     @staticmethod
     def _prune(valid_cols, new_item_set, search_space):
@@ -232,39 +305,36 @@ class InvariantsMiner(object):
         :param search_space: the search space that stores possible candidates
         :return:
         """
-        if len(valid_cols) == 0:
-            return
-
         for se in valid_cols:
             intersection = set(se) & new_item_set
             if len(intersection) == 0:
                 continue
 
             union = set(se) | new_item_set
-            for it in list(intersection):
-                diff = sorted(list(union - {it}))
-                if diff in search_space:
-                    search_space.remove(diff)
+            for it in intersection:
+                search_space.discard(tuple(sorted(union - {it})))
 
     @staticmethod
     def _join_set(item_list, length):
         """
-        Join a set with itself and return the n-element (length) itemsets
+        Join a set with itself and return the n-element (length) itemsets. Apriori join: items
+        are grouped by their first `length - 2` columns, and only items within a group are
+        joined, which yields every candidate whose sub-items are all in `item_list`
 
-        :param item_list: current list of columns
+        :param item_list: current list of columns (sorted tuples of `length - 1` columns)
         :param length: generate new items of length
-        :return: return_list: list of items of length-element
+        :return: return_list: sorted list of items of length-element
         """
-        set_len = len(item_list)
+        groups = {}
+        for item in item_list:
+            groups.setdefault(item[:-1], []).append(item[-1])
+
         return_list = []
-        for i in range(set_len):
-            for j in range(i + 1, set_len):
-                i_set = set(item_list[i])
-                j_set = set(item_list[j])
-                if len(i_set.union(j_set)) == length:
-                    joined = sorted(list(i_set.union(j_set)))
-                    if joined not in return_list:
-                        return_list.append(joined)
+        for prefix, lasts in groups.items():
+            lasts = sorted(set(lasts))
+            for i in range(len(lasts)):
+                for j in range(i + 1, len(lasts)):
+                    return_list.append(prefix + (lasts[i], lasts[j]))
 
         return sorted(return_list)
 
@@ -273,13 +343,56 @@ class InvariantsMiner(object):
         """
         Check if an item's sub-items are in `search_space`
 
-        :param item: item to be checked
+        :param item: item to be checked (sorted tuple of columns)
         :param length: length of item
         :param search_space: the search space that holds possible candidates
         :return: (bool)
         """
         for sub_item in combinations(item, length - 1):
-            if sorted(list(sub_item)) not in search_space:
+            if sub_item not in search_space:
                 return False
 
         return True
+
+
+def _gram(x):
+    """ `x.T @ x` as a dense array, for dense, sparse and `CenteredMatrix` inputs """
+    if hasattr(x, 'gram'):
+        return x.gram()
+
+    gram = x.T @ x
+    return gram.toarray() if sp.issparse(gram) else gram
+
+
+def _columns(x, cols):
+    """ Dense sub-matrix of the selected columns """
+    if hasattr(x, 'columns'):
+        return x.columns(cols)
+
+    sub_matrix = x[:, cols]
+    return sub_matrix.toarray() if sp.issparse(sub_matrix) else sub_matrix
+
+
+def _column_major(x):
+    """ Sparse inputs in CSC format, for fast column slicing """
+    if hasattr(x, 'gram') and sp.issparse(x.x):
+        return type(x)(x.x.tocsc(), x.mean)
+
+    return x.tocsc() if sp.issparse(x) else x
+
+
+def _zero_columns(x):
+    """ (ndarray) boolean mask of the all-zero columns """
+    if hasattr(x, 'gram'):
+        # a centered column is zero when its sum of squares is
+        return np.diag(x.gram()) <= 1e-12
+
+    if sp.issparse(x):
+        return np.asarray((x != 0).sum(axis=0)).ravel() == 0
+
+    return ~np.any(x != 0, axis=0)
+
+
+def _check_candidates(miner, sub_matrices):
+    """ Validity checks of a chunk of candidates, each given by its columns of the event count matrix """
+    return [miner._check_invar_validity(sub_matrix, list(range(sub_matrix.shape[1]))) for sub_matrix in sub_matrices]
@@ -0,0 +1,227 @@
+import numpy as np
+from scipy.cluster.hierarchy import fcluster, linkage
+from scipy.spatial.distance import squareform
+from util import metrics
+
+
+class LogClustering(object):
+    """
+    Implementation of the Log Clustering Model for anomaly detection. Sessions are clustered
+    by cosine distance; a session further than `anomaly_threshold` from every cluster
+    representative is an anomaly.
+
+    Representatives are kept as the rows of one matrix with their norms, so assignment is a
+    single matrix product per batch of sessions.
+
+    References:
+        [1] Qingwei Lin, Hongyu Zhang, Jian-Guang Lou, Yu Zhang, Xuewei Chen. Log Clustering
+            based Problem Identification for Online Service Systems. International Conference
+            on Software Engineering (ICSE), 2016.
+    """
+    def __init__(self, max_dist=0.3, anomaly_threshold=0.3, mode='online', num_bootstrap_samples=1000,
+                 batch_size=1024):
+        """
+
+        :param max_dist: (float) maximum cosine distance between a session and the representative
+               of its cluster
+        :param anomaly_threshold: (float) sessions further than this from every representative
+               are anomalies
+        :param mode: (str) 'offline' clusters all sessions agglomeratively, which needs memory
+               quadratic in the number of sessions; 'online' clusters the first
+               `num_bootstrap_samples` agglomeratively and assigns the rest incrementally
+        :param num_bootstrap_samples: (int) number of sessions clustered offline in 'online' mode
+        :param batch_size: (int) number of sessions assigned per matrix product. Sessions of a
+               batch are assigned against the representatives as they were at the start of
+               the batch; 1 reproduces strictly sequential online clustering
+        """
+        self.max_dist = max_dist
+        self.anomaly_threshold = anomaly_threshold
+        self.mode = mode
+        self.num_bootstrap_samples = num_bootstrap_samples
+        self.batch_size = batch_size
+        self.n_clusters = 0
+        self._centers = None
+        self._norms = None
+        self._sizes = None
+        self._reset()
+
+    def _reset(self):
+        self.n_clusters = 0
+        # buffers grown by doubling, so that starting a cluster is amortized O(n_events)
+        self._centers = np.zeros((0, 0))
+        self._norms = np.zeros(0)
+        self._sizes = np.zeros(0, dtype=np.int64)
+
+    @property
+    def representatives(self):
+        """ Cluster centers, shape [n_clusters, n_events] """
+        return self._centers[:self.n_clusters]
+
+    @property
+    def norms(self):
+        return self._norms[:self.n_clusters]
+
+    @property
+    def cluster_sizes(self):
+        return self._sizes[:self.n_clusters]
+
+    def fit(self, x):
+        """
+        Cluster the sessions from scratch, discarding clusters of an earlier fit
+
+        :param x: (ndarray) the event count matrix, shape [n_instances, n_events]; may also be
+               sparse or a `CenteredMatrix`
+        :return:
+        """
+        self._reset()
+        if self.mode == 'offline':
+            self._offline_clustering(_dense(x))
+        elif self.mode == 'online':
+            if self.num_bootstrap_samples > 0:
+                self._offline_clustering(_dense(x[:self.num_bootstrap_samples]))
+
+            if x.shape[0] > self.num_bootstrap_samples:
+                self.partial_fit(x[self.num_bootstrap_samples:])
+
+        print('Number of clusters: {}'.format(self.n_clusters))
+
+    def partial_fit(self, x):
+        """
+        Online clustering: assign sessions to their nearest representative, updating it as a
+        running mean, or start a new cluster when none is within `max_dist`. Continues from the
+        current clusters, so `x` must have the same events (columns) as earlier sessions
+
+        :param x: (ndarray) the event count matrix
+        :return: (ndarray) cluster index per session
+        """
+        labels = np.empty(x.shape[0], dtype=np.int64)
+        for start in range(0, x.shape[0], self.batch_size):
+            batch = _dense(x[start:start + self.batch_size])
+            dist, nearest = self._nearest(batch)
+            assigned = dist <= self.max_dist
+            if np.any(assigned):
+                clusters = nearest[assigned]
+                counts = np.bincount(clusters, minlength=self.n_clusters)
+                sums = np.zeros_like(self.representatives)
+                np.add.at(sums, clusters, batch[assigned])
+                updated = np.flatnonzero(counts)
+                new_sizes = self.cluster_sizes[updated] + counts[updated]
+                self.representatives[updated] += (sums[updated] - counts[updated, np.newaxis] *
+                                                  self.representatives[updated]) / new_sizes[:, np.newaxis]
+                self.norms[updated] = np.linalg.norm(self.representatives[updated], axis=1)
+                self.cluster_sizes[updated] = new_sizes
+
+            labels[start + np.flatnonzero(assigned)] = nearest[assigned]
+            for i in np.flatnonzero(~assigned):
+                labels[start + i] = self._add_or_assign(batch[i])
+
+        return labels
+
+    def _add_or_assign(self, row):
+        """ Sequentially place a session that was not within `max_dist` at the start of its batch """
+        dist, nearest = self._nearest(row[np.newaxis, :])
+        if self.n_clusters and dist[0] <= self.max_dist:
+            c = nearest[0]
+            self.cluster_sizes[c] += 1
+            self.representatives[c] += (row - self.representatives[c]) / self.cluster_sizes[c]
+            self.norms[c] = np.linalg.norm(self.representatives[c])
+            return c
+
+        self._append_clusters(row[np.newaxis, :], np.ones(1, dtype=np.int64))
+        return self.n_clusters - 1
+
+    def _offline_clustering(self, x):
+        """ Complete-linkage agglomerative clustering, cut at `max_dist` """
+        if x.shape[0] == 0:
+            return
+
+        if x.shape[0] == 1:
+            self._append_clusters(x, np.ones(1, dtype=np.int64))
+            return
+
+        normalized = x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-8)
+        dist = np.maximum(1 - normalized @ normalized.T, 0)
+        np.fill_diagonal(dist, 0)
+        z = linkage(squareform(dist, checks=False), 'complete')
+        cluster_index = fcluster(z, self.max_dist, criterion='distance') - 1
+        counts = np.bincount(cluster_index)
+        sums = np.zeros((len(counts), x.shape[1]))
+        np.add.at(sums, cluster_index, x)
+        self._append_clusters(sums / counts[:, np.newaxis], counts)
+
+    def _append_clusters(self, centers, sizes):
+        n = self.n_clusters + len(centers)
+        if self._centers.shape[1] != centers.shape[1]:
+            if self.n_clusters:
+                raise ValueError('Expected {} events per session, got {}'.format(self._centers.shape[1],
+                                                                                 centers.shape[1]))
+
+            self._reset()
+            self._centers = np.zeros((0, centers.shape[1]))
+
+        if n > len(self._sizes):
+            capacity = max(n, 2 * len(self._sizes), 16)
+            self._centers = np.vstack([self.representatives, np.zeros((capacity - self.n_clusters, centers.shape[1]))])
+            self._norms = np.concatenate([self.norms, np.zeros(capacity - self.n_clusters)])
+            self._sizes = np.concatenate([self.cluster_sizes, np.zeros(capacity - self.n_clusters, dtype=np.int64)])
+
+        self._centers[self.n_clusters:n] = centers
+        self._norms[self.n_clusters:n] = np.linalg.norm(centers, axis=1)
+        self._sizes[self.n_clusters:n] = sizes
+        self.n_clusters = n
+
+    def _nearest(self, x):
+        """
+        Cosine distance to the nearest representative, for a dense batch
+
+        :return: (ndarray, ndarray) distances and cluster indices; distance 1 when there are no clusters
+        """
+        if self.n_clusters == 0:
+            return np.ones(len(x)), np.zeros(len(x), dtype=np.int64)
+
+        sims = (x @ self.representatives.T) / (np.linalg.norm(x, axis=1)[:, np.newaxis] * self.norms + 1e-8)
+        nearest = np.argmax(sims, axis=1)
+        dist = 1 - sims[np.arange(len(x)), nearest]
+        dist[dist < 1e-8] = 0
+        return dist, nearest
+
+    def assign(self, x):
+        """
+        Nearest cluster of each session, without updating the clusters
+
+        :param x: (ndarray) the event count matrix
+        :return: (ndarray, ndarray) cosine distances and cluster indices
+        """
+        dists = []
+        labels = []
+        for start in range(0, x.shape[0], self.batch_size):
+            dist, nearest = self._nearest(_dense(x[start:start + self.batch_size]))
+            dists.append(dist)
+            labels.append(nearest)
+
+        return np.concatenate(dists or [np.zeros(0)]), np.concatenate(labels or [np.zeros(0, dtype=np.int64)])
+
+    def predict(self, x):
+        """
+        Predict anomalies
+
+        :param x: the input event count matrix
+        :return: y_pred: (ndarray) the predicted label vector, shape [n_instances, ]
+        """
+        dist, _ = self.assign(x)
+        return (dist > self.anomaly_threshold).astype(int)
+
+    def evaluate(self, x, y_true):
+        print('-------- Evaluation summary --------')
+        y_pred = self.predict(x)
+        precision, recall, f1 = metrics(y_pred, y_true)
+        print('Precision: {:.3f}, Recall: {:.3f}, F1-score: {:.3f}\n'.format(precision, recall, f1))
+        return precision, recall, f1
+
+
+def _dense(x):
+    """ Dense rows of an ndarray, sparse matrix or `CenteredMatrix` """
+    if hasattr(x, 'toarray'):
+        return x.toarray()
+
+    return np.asarray(x, dtype=np.float64)
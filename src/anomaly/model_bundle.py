@@ -0,0 +1,328 @@
+"""
+Save fitted anomaly models as a bundle directory: the arrays of the feature extractor and the
+model in an uncompressed `arrays.npz`, whose members are memory-mapped on load, and everything
+else in a small `manifest.json`. Loading a bundle needs NumPy and SciPy only, so scoring
+workers start without importing the training dependencies (scikit-learn, joblib).
+
+Bundles are versioned; a bundle written by a newer format version than `BUNDLE_VERSION` is
+refused rather than misread.
+
+Each save writes a new `v-*` subdirectory and then atomically replaces the `CURRENT` file
+naming it, so a bundle is never changed in place under a scorer that has its arrays
+memory-mapped, and a reader sees either the previous bundle or the new one.
+"""
+
+import json
+import os
+from pathlib import Path
+import shutil
+import struct
+import tempfile
+import time
+import zipfile
+
+import numpy as np
+import scipy.sparse as sp
+
+from anomaly.decision_tree import DecisionTree
+from anomaly.feature_extractor import FeatureExtractor
+from anomaly.invariants_miner import InvariantsMiner
+from anomaly.log_clustering import LogClustering
+from anomaly.pca import PCA
+
+BUNDLE_VERSION = 1
+BUNDLE_DIRNAME = 'anomaly_model'
+MANIFEST_FILENAME = 'manifest.json'
+ARRAYS_FILENAME = 'arrays.npz'
+CURRENT_FILENAME = 'CURRENT'
+
+# saved versions kept, including the current one, for readers that resolved `CURRENT` just
+# before it was replaced
+KEEP_VERSIONS = 2
+
+
+class ModelBundle(object):
+
+    def __init__(self, feature_extractor, model, manifest=None):
+        """
+
+        :param feature_extractor: (FeatureExtractor) fitted on the training sequences
+        :param model: fitted InvariantsMiner, PCA, LogClustering or DecisionTree
+        :param manifest: (dict) manifest the bundle was loaded from
+        """
+        self.feature_extractor = feature_extractor
+        self.model = model
+        self.manifest = manifest
+
+    def save(self, dirname):
+        """
+        Write the bundle as a new version of `dirname` and make it current
+
+        :param dirname: (str) bundle directory
+        """
+        path = Path(dirname)
+        path.mkdir(parents=True, exist_ok=True)
+        version_path = path / 'v-{:019d}'.format(time.time_ns())
+        version_path.mkdir()
+        arrays = {}
+        fe = self.feature_extractor
+        for name in ('idf_vec', 'mean_vec'):
+            if getattr(fe, name) is not None:
+                arrays['feature_extractor.' + name] = np.asarray(getattr(fe, name), dtype=np.float64)
+
+        model_type = type(self.model).__name__
+        if model_type not in MODEL_TYPES:
+            raise ValueError('Unsupported model type: {}'.format(model_type))
+
+        save_model, _ = MODEL_TYPES[model_type]
+        params, model_arrays = save_model(self.model, len(fe.events) + int(bool(fe.oov)))
+        arrays.update(('model.' + name, value) for name, value in model_arrays.items())
+        np.savez(str(version_path / ARRAYS_FILENAME), **arrays)
+        self.manifest = {
+            'version': BUNDLE_VERSION,
+            'feature_extractor': {
+                'events': [_json_value(event) for event in fe.events],
+                'term_weighting': fe.term_weighting,
+                'normalization': fe.normalization,
+                'oov': bool(fe.oov)
+            },
+            'model': {
+                'type': model_type,
+                'params': params
+            },
+            'arrays': sorted(arrays)
+        }
+        with (version_path / MANIFEST_FILENAME).open('w') as f:
+            json.dump(self.manifest, f)
+
+        # switched last, so that a partially written version is never current
+        with tempfile.NamedTemporaryFile('w', dir=str(path), prefix=CURRENT_FILENAME + '.', delete=False) as f:
+            f.write(version_path.name)
+
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, str(path / CURRENT_FILENAME))
+        _remove_old_versions(path, version_path.name)
+
+    @classmethod
+    def load(cls, dirname, mmap_mode='r'):
+        """
+
+        :param dirname: (str) bundle directory
+        :param mmap_mode: (str) memory-map the arrays with this mode, or read them into memory when None
+        :return: (ModelBundle)
+        """
+        path = _current_path(dirname)
+        with (path / MANIFEST_FILENAME).open('r') as f:
+            manifest = json.load(f)
+
+        if manifest.get('version', 0) > BUNDLE_VERSION:
+            raise ValueError('Bundle format version {} is newer than the supported version {}'
+                             .format(manifest['version'], BUNDLE_VERSION))
+
+        arrays = load_npz(str(path / ARRAYS_FILENAME), mmap_mode)
+        fe = FeatureExtractor()
+        fe_manifest = manifest['feature_extractor']
+        fe.events = fe_manifest['events']
+        fe.vocab = {event: i for i, event in enumerate(fe.events)}
+        fe.term_weighting = fe_manifest['term_weighting']
+        fe.normalization = fe_manifest['normalization']
+        fe.oov = fe_manifest['oov']
+        fe.idf_vec = arrays.get('feature_extractor.idf_vec')
+        fe.mean_vec = arrays.get('feature_extractor.mean_vec')
+
+        model_manifest = manifest['model']
+        if model_manifest['type'] not in MODEL_TYPES:
+            raise ValueError('Unsupported model type: {}'.format(model_manifest['type']))
+
+        _, load_model = MODEL_TYPES[model_manifest['type']]
+        prefix = 'model.'
+        model_arrays = {name[len(prefix):]: value for name, value in arrays.items() if name.startswith(prefix)}
+        return cls(fe, load_model(model_manifest['params'], model_arrays), manifest)
+
+    @staticmethod
+    def exists(dirname):
+        return (_current_path(dirname) / MANIFEST_FILENAME).exists()
+
+
+def _current_path(dirname):
+    """ Folder of the current version of a bundle; the bundle folder itself for a bundle saved unversioned """
+    path = Path(dirname)
+    try:
+        with (path / CURRENT_FILENAME).open('r') as f:
+            return path / f.read().strip()
+    except FileNotFoundError:
+        return path
+
+
+def _remove_old_versions(path, current):
+    """
+    Remove all but the newest `KEEP_VERSIONS` versions, and the files of an unversioned bundle.
+    Scorers that have the removed arrays memory-mapped keep reading them until they reload.
+    """
+    versions = sorted((p.name for p in path.iterdir() if p.is_dir() and p.name.startswith('v-')), reverse=True)
+    old = [name for name in versions if name != current][KEEP_VERSIONS - 1:]
+    for name in old:
+        shutil.rmtree(str(path / name), ignore_errors=True)
+
+    for filename in (MANIFEST_FILENAME, ARRAYS_FILENAME):
+        if (path / filename).exists():
+            (path / filename).unlink()
+
+
+def load_npz(filename, mmap_mode='r'):
+    """
+    Read the arrays of an `.npz` file, memory-mapping the members that are stored uncompressed
+    (as written by `np.savez`) instead of reading them into memory
+
+    :param filename: (str) `.npz` file
+    :param mmap_mode: (str) memory-map mode, e.g. 'r'; None reads every array into memory
+    :return: (dict) name -> ndarray
+    """
+    if mmap_mode is None:
+        with np.load(filename) as data:
+            return {name: data[name] for name in data.files}
+
+    arrays = {}
+    with zipfile.ZipFile(filename) as zf, open(filename, 'rb') as f:
+        for info in zf.infolist():
+            name = info.filename[:-len('.npy')] if info.filename.endswith('.npy') else info.filename
+            if info.compress_type != zipfile.ZIP_STORED:
+                arrays[name] = np.load(zf.open(info))
+                continue
+
+            # skip the local file header to the start of the .npy data
+            f.seek(info.header_offset)
+            name_length, extra_length = struct.unpack('<HH', f.read(30)[26:30])
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+            if dtype.hasobject or int(np.prod(shape)) == 0:
+                arrays[name] = np.load(zf.open(info))
+            else:
+                arrays[name] = np.memmap(filename, dtype=dtype, mode=mmap_mode, offset=f.tell(), shape=shape,
+                                         order='F' if fortran_order else 'C')
+
+    return arrays
+
+
+class TreeClassifier(object):
+    """
+    Predicts with the arrays of a fitted scikit-learn decision tree, descending all instances
+    one level at a time, so that a bundled `DecisionTree` scores without scikit-learn
+    """
+
+    def __init__(self, children_left, children_right, feature, threshold, leaf_class, classes):
+        self.children_left = children_left
+        self.children_right = children_right
+        self.feature = feature
+        self.threshold = threshold
+        self.leaf_class = leaf_class  # index into `classes` of the majority class of each node
+        self.classes = classes
+
+    def predict(self, x):
+        # scikit-learn compares float32 features against the thresholds
+        x = x.astype(np.float32) if sp.issparse(x) else np.asarray(x, dtype=np.float32)
+        rows = np.arange(x.shape[0])
+        nodes = np.zeros(x.shape[0], dtype=np.int64)
+        while True:
+            left = self.children_left[nodes]
+            inner = left >= 0
+            if not np.any(inner):
+                break
+
+            values = x[rows[inner], self.feature[nodes[inner]]]
+            values = np.asarray(values, dtype=np.float32).ravel()
+            nodes[inner] = np.where(values <= self.threshold[nodes[inner]], left[inner],
+                                    self.children_right[nodes[inner]])
+
+        return self.classes[self.leaf_class[nodes]]
+
+
+def _save_invariants_miner(model, n_features):
+    theta = sp.csc_matrix(model.invariant_matrix(n_features))
+    params = {'percentage': model.percentage, 'epsilon': model.epsilon, 'longest_invariant': model.longest_invariant,
+              'scale_list': list(model.scale_list), 'n_features': n_features}
+    return params, {'theta_data': theta.data, 'theta_indices': theta.indices, 'theta_indptr': theta.indptr}
+
+
+def _load_invariants_miner(params, arrays):
+    model = InvariantsMiner(percentage=params['percentage'], epsilon=params['epsilon'],
+                            longest_invariant=params['longest_invariant'], scale_list=params['scale_list'])
+    indptr = arrays['theta_indptr']
+    model.theta = sp.csc_matrix((arrays['theta_data'], arrays['theta_indices'], indptr),
+                                shape=(params['n_features'], len(indptr) - 1))
+    indices = model.theta.indices.tolist()
+    data = model.theta.data.tolist()
+    model.invariants = {tuple(indices[start:end]): data[start:end]
+                        for start, end in zip(indptr[:-1].tolist(), indptr[1:].tolist())}
+    return model
+
+
+def _save_pca(model, n_features):
+    if model.stale or model.components is None:
+        model._fit_components()
+
+    params = {'n_components': model.n_components, 'threshold': float(model.threshold),
+              'fixed_threshold': model.fixed_threshold, 'c_alpha': model.c_alpha, 'n_instances': model.n_instances}
+    return params, {'mean': model.mean, 'components': model.components}
+
+
+def _load_pca(params, arrays):
+    model = PCA(n_components=params['n_components'], threshold=params['threshold'], c_alpha=params['c_alpha'])
+    model.fixed_threshold = params['fixed_threshold']
+    model.n_instances = params['n_instances']
+    model.mean = arrays['mean']
+    model.components = arrays['components']
+    return model
+
+
+def _save_log_clustering(model, n_features):
+    params = {'max_dist': model.max_dist, 'anomaly_threshold': model.anomaly_threshold, 'mode': model.mode,
+              'num_bootstrap_samples': model.num_bootstrap_samples, 'batch_size': model.batch_size}
+    return params, {'representatives': model.representatives, 'cluster_sizes': model.cluster_sizes}
+
+
+def _load_log_clustering(params, arrays):
+    model = LogClustering(**params)
+    # copied, as online clustering updates the representatives in place
+    model._append_clusters(np.array(arrays['representatives']), np.array(arrays['cluster_sizes']))
+    return model
+
+
+def _save_decision_tree(model, n_features):
+    classifier = model.classifier
+    tree = classifier.tree_
+    params = {'classes': [_json_value(c) for c in classifier.classes_]}
+    return params, {
+        'children_left': tree.children_left,
+        'children_right': tree.children_right,
+        'feature': tree.feature,
+        'threshold': tree.threshold,
+        'leaf_class': np.argmax(tree.value[:, 0, :], axis=1)
+    }
+
+
+def _load_decision_tree(params, arrays):
+    # skip `__init__`, which builds an unfitted scikit-learn classifier
+    model = DecisionTree.__new__(DecisionTree)
+    model.classifier = TreeClassifier(arrays['children_left'], arrays['children_right'], arrays['feature'],
+                                      arrays['threshold'], arrays['leaf_class'], np.array(params['classes']))
+    return model
+
+
+# model type -> (save function, load function)
+MODEL_TYPES = {
+    'InvariantsMiner': (_save_invariants_miner, _load_invariants_miner),
+    'PCA': (_save_pca, _load_pca),
+    'LogClustering': (_save_log_clustering, _load_log_clustering),
+    'DecisionTree': (_save_decision_tree, _load_decision_tree)
+}
+
+
+def _json_value(value):
+    """ Convert NumPy scalars to their Python equivalents """
+    return value.item() if isinstance(value, np.generic) else value
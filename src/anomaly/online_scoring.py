@@ -0,0 +1,87 @@
+"""
+Score sessions against mined invariants while logs stream in. Event counts per (session,
+window) are kept in a Faust table; once event time passes the end of a window, all its sessions
+are scored together with one sparse product against the invariant matrix, and violations are
+published to the `anomalies` topic.
+
+Train with `python anomaly/detect.py`, which saves the fitted feature extractor and miner as a
+model bundle (see `anomaly/model_bundle.py`), then run with `faust -A anomaly.online_scoring worker`
+from `src`.
+"""
+
+import json
+import os
+from pathlib import Path
+
+import settings
+from anomaly.model_bundle import BUNDLE_DIRNAME, ModelBundle
+from anomaly.sessions import SessionTable
+from streaming_app import anomalies_topic, app, parsed_logs_topic
+
+ROOT = Path(__file__).parent.parent.parent
+
+SESSION_ENTITY = 'ip_address'
+TIME_FIELD = 'metadata.timestamp'
+WINDOW_SECS = 60.
+LATENESS_SECS = 5.
+
+
+class InvariantScorer(object):
+
+    def __init__(self, feature_extractor, miner):
+        """
+
+        :param feature_extractor: (FeatureExtractor) fitted on the training sessions
+        :param miner: (InvariantsMiner) fitted on the extracted features
+        """
+        self.feature_extractor = feature_extractor
+        self.miner = miner
+
+    @classmethod
+    def load(cls, dirname):
+        bundle = ModelBundle.load(str(dirname))
+        return cls(bundle.feature_extractor, bundle.model)
+
+    def score(self, counters):
+        """
+        :param counters: (list) of dicts of event -> count, one per session
+        :return: (ndarray) invariant violation per session; anomalous above 1e-6
+        """
+        x = self.feature_extractor.transform_counts(counters, sparse=True)
+        return self.miner.score(x)
+
+
+# JSON [session key, window start] -> JSON {event ID: count}
+session_events = app.Table('session_events', default=None)
+sessions = SessionTable(session_events, WINDOW_SECS, LATENESS_SECS, TIME_FIELD)
+scorer = None
+
+
+def get_scorer():
+    global scorer
+    if scorer is None:
+        scorer = InvariantScorer.load(ROOT / os.getenv('MODELS_DIR') / BUNDLE_DIRNAME)
+
+    return scorer
+
+
+@app.agent(parsed_logs_topic)
+async def score_sessions(parsed_logs):
+    # windows close as event time advances, within the agent, since a table may only be
+    # changed while processing an event; a quiet stream closes its windows on the next log
+    async for jsonstr in parsed_logs:
+        log = json.loads(jsonstr)
+        closed = sessions.add(log, {p['value'] for p in log['params'] if p['entity'] == SESSION_ENTITY})
+        if not closed:
+            continue
+
+        scores = get_scorer().score([counts for _, _, counts in closed])
+        for (key, start, _), score in zip(closed, scores):
+            if score > 1e-6:
+                await anomalies_topic.send(value=json.dumps({
+                    'session': key,
+                    'entity': SESSION_ENTITY,
+                    'window_start': start,
+                    'window_end': start + WINDOW_SECS,
+                    'score': float(score)
+                }))
@@ -0,0 +1,160 @@
+import numpy as np
+import scipy.sparse as sp
+from util import metrics
+
+
+class PCA(object):
+    """
+    Implementation of the PCA Model for anomaly detection. Sessions whose squared prediction
+    error (SPE), the squared norm of their projection onto the residual subspace, exceeds the
+    Q-statistic threshold are anomalies.
+
+    The model is fitted out of core: `partial_fit` accumulates the mean and covariance of
+    any number of (sparse) chunks, and the components are computed from them on first use.
+
+    References:
+        [1] Wei Xu, Ling Huang, Armando Fox, David Patterson, Michael Jordan. Large-Scale
+            System Problems Detection by Mining Console Logs. ACM Symposium on Operating
+            Systems Principles (SOSP), 2009.
+    """
+    def __init__(self, n_components=0.95, threshold=None, c_alpha=3.2905):
+        """
+
+        :param n_components: (float or int) number of principal components, or the fraction of
+               variance they should explain when less than 1
+        :param threshold: (float) SPE threshold; estimated with the Q-statistic when None
+        :param c_alpha: (float) normal quantile of the Q-statistic confidence level;
+               3.2905 for 99.9%
+        """
+        self.n_components = n_components
+        self.threshold = threshold
+        self.fixed_threshold = threshold is not None
+        self.c_alpha = c_alpha
+        self.n_instances = 0
+        self.col_sums = None
+        self.gram = None  # uncentered `x.T @ x`, summed over chunks
+        self.mean = None
+        self.components = None  # principal directions as columns, shape [n_events, n_components]
+        self.stale = False
+
+    def fit(self, x):
+        """
+
+        :param x: (ndarray) the event count matrix, shape [n_instances, n_events]; may also be
+               sparse or a `CenteredMatrix`
+        :return:
+        """
+        self.n_instances = 0
+        self.col_sums = None
+        self.gram = None
+        self.partial_fit(x)
+        self._fit_components()
+
+    def partial_fit(self, x):
+        """
+        Add a chunk of instances
+
+        :param x: (ndarray) chunk of the event count matrix, shape [n_chunk_instances, n_events]
+        :return:
+        """
+        col_sums, gram = _moments(x)
+        if self.gram is None:
+            self.col_sums = col_sums
+            self.gram = gram
+        else:
+            self.col_sums += col_sums
+            self.gram += gram
+
+        self.n_instances += x.shape[0]
+        self.stale = True
+
+    def _fit_components(self):
+        n = float(self.n_instances)
+        self.mean = self.col_sums / n
+        covariance = self.gram / n - np.outer(self.mean, self.mean)
+        sigma, u = np.linalg.eigh(covariance)
+        sigma, u = np.maximum(sigma[::-1], 0), u[:, ::-1]
+
+        n_components = self.n_components
+        if n_components < 1:
+            variance = np.cumsum(sigma) / max(sigma.sum(), 1e-12)
+            n_components = int(np.searchsorted(variance, n_components) + 1)
+
+        n_components = min(n_components, len(sigma))
+        self.components = u[:, :n_components]
+        if not self.fixed_threshold:
+            self.threshold = self._q_statistic(sigma[n_components:])
+
+        self.stale = False
+        print('PCA: {} components, SPE threshold: {:.6f}'.format(n_components, self.threshold))
+
+    def _q_statistic(self, residual_sigma):
+        """
+        Q-statistic threshold of the SPE, from the eigenvalues of the residual subspace
+        """
+        phi = np.array([np.sum(residual_sigma ** (i + 1)) for i in range(3)])
+        if phi[0] <= 0:
+            return 0.
+
+        h0 = 1.0 - 2 * phi[0] * phi[2] / (3.0 * phi[1] * phi[1])
+        return phi[0] * np.power(self.c_alpha * np.sqrt(2 * phi[1] * h0 * h0) / phi[0] + 1.0 +
+                                 phi[1] * h0 * (h0 - 1.0) / (phi[0] * phi[0]), 1.0 / h0)
+
+    def spe(self, x):
+        """
+        Squared prediction error of each instance, computed with one batched projection as
+        `|x - mean|^2 - |(x - mean) @ components|^2` without densifying sparse inputs
+
+        :param x: (ndarray) the input event count matrix
+        :return: (ndarray) shape [n_instances, ]
+        """
+        if self.stale or self.components is None:
+            self._fit_components()
+
+        x, mean = _uncentered(x, self.mean)
+        proj = np.asarray(x @ self.components) - mean @ self.components
+        sq_norms = np.asarray(x.multiply(x).sum(axis=1)).ravel() if sp.issparse(x) else np.sum(x * x, axis=1)
+        sq_norms = sq_norms - 2 * np.asarray(x @ mean).ravel() + mean @ mean
+        return np.maximum(sq_norms - np.sum(proj * proj, axis=1), 0)
+
+    def predict(self, x):
+        """
+        Predict anomalies
+
+        :param x: the input event count matrix
+        :return: y_pred: (ndarray) the predicted label vector, shape [n_instances, ]
+        """
+        return (self.spe(x) > self.threshold).astype(int)
+
+    def evaluate(self, x, y_true):
+        print('-------- Evaluation summary --------')
+        y_pred = self.predict(x)
+        precision, recall, f1 = metrics(y_pred, y_true)
+        print('Precision: {:.3f}, Recall: {:.3f}, F1-score: {:.3f}\n'.format(precision, recall, f1))
+        return precision, recall, f1
+
+
+def _uncentered(x, mean):
+    """
+    Express `x - mean` as a plain (sparse) matrix and an offset, folding in the implicit
+    mean of a `CenteredMatrix`
+    """
+    if hasattr(x, 'gram'):
+        return x.x, mean + x.mean
+
+    return x, mean
+
+
+def _moments(x):
+    """ Column sums and `x.T @ x` of a chunk """
+    x, offset = _uncentered(x, 0)
+    col_sums = np.asarray(x.sum(axis=0), dtype=np.float64).ravel()
+    gram = x.T @ x
+    gram = gram.toarray() if sp.issparse(gram) else np.asarray(gram, dtype=np.float64)
+    if np.any(offset):
+        # moments of `x - offset`
+        n = x.shape[0]
+        gram = gram - np.outer(col_sums, offset) - np.outer(offset, col_sums) + n * np.outer(offset, offset)
+        col_sums = col_sums - n * offset
+
+    return col_sums, gram
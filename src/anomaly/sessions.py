@@ -0,0 +1,414 @@
+"""
+Build event-count sessions from parsed logs as a stream. Logs are grouped by a session key
+(an IP address, a user, an HDFS block ID, ...) into tumbling or sliding event-time windows,
+and each window is emitted as a sparse count vector once the stream has moved past its end,
+so memory is bounded by the windows that are still open rather than the full history.
+"""
+
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import heapq
+import json
+import os
+import re
+import time
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+BLOCK_ID_REGEX = re.compile(r'(blk_-?\d+)')
+
+
+def block_ids(log):
+    """ Session key function for HDFS logs: every block ID mentioned in the line """
+    return set(BLOCK_ID_REGEX.findall(log['line']))
+
+
+class SessionBatch(object):
+    """ Sessions emitted together; row `i` of `x` counts the events of session `keys[i]` """
+
+    def __init__(self, keys, starts, ends, x):
+        self.keys = keys
+        self.starts = starts
+        self.ends = ends
+        self.x = x
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class SessionBuilder(object):
+    """
+    Incrementally groups events into (session key, window) counters. Windows are aligned to
+    multiples of `slide_secs`: with tumbling windows (the default) each event falls in exactly
+    one window, and with sliding windows in `window_secs / slide_secs` overlapping ones.
+    """
+
+    def __init__(self, window_secs=300., slide_secs=None, lateness_secs=0., vocab=None):
+        """
+
+        :param window_secs: (float) window length
+        :param slide_secs: (float) interval between window starts; defaults to `window_secs`
+               (tumbling windows)
+        :param lateness_secs: (float) how far behind the latest timestamp an event may arrive
+               before its windows are closed
+        :param vocab: (dict) fixed event -> column mapping, e.g. `FeatureExtractor.vocab`; events
+               outside it are dropped. When None, columns are assigned as events are first seen
+        """
+        self.window_secs = window_secs
+        self.slide_secs = slide_secs or window_secs
+        self.lateness_secs = lateness_secs
+        self.fixed_vocab = vocab is not None
+        self.vocab = dict(vocab) if vocab is not None else {}
+        self.windows = {}  # window start -> {session key: Counter of columns}
+        self.max_time = None
+        self.n_late = 0
+        self.n_oov = 0
+        self.n_invalid_time = 0  # events whose time could not be parsed, counted by the reader
+        self.n_emitted = 0
+
+    @property
+    def watermark(self):
+        """ Windows ending at or before this time are complete """
+        return None if self.max_time is None else self.max_time - self.lateness_secs
+
+    def add(self, timestamp, keys, event):
+        """
+        :param timestamp: (float) event time in seconds
+        :param keys: (iterable) session keys of the event
+        :param event: event ID
+        """
+        col = self.vocab.get(event)
+        if col is None:
+            if self.fixed_vocab:
+                self.n_oov += 1
+                return
+
+            col = self.vocab[event] = len(self.vocab)
+
+        watermark = self.watermark
+        last_start = np.floor(timestamp / self.slide_secs) * self.slide_secs
+        start = last_start
+        while start > timestamp - self.window_secs:
+            if watermark is not None and start + self.window_secs <= watermark:
+                self.n_late += 1
+                break
+
+            sessions = self.windows.get(start)
+            if sessions is None:
+                sessions = self.windows[start] = {}
+
+            for key in keys:
+                counts = sessions.get(key)
+                if counts is None:
+                    counts = sessions[key] = Counter()
+
+                counts[col] += 1
+
+            start -= self.slide_secs
+
+        if self.max_time is None or timestamp > self.max_time:
+            self.max_time = timestamp
+
+    def flush(self, final=False):
+        """
+        Emit the windows that have closed
+
+        :param final: (bool) emit every open window, at the end of the stream
+        :return: (SessionBatch) or None when no window has closed
+        """
+        watermark = self.watermark
+        closed = sorted(start for start in self.windows
+                        if final or (watermark is not None and start + self.window_secs <= watermark))
+        if not closed:
+            return None
+
+        keys = []
+        starts = []
+        cols = []
+        counts = []
+        lengths = []
+        for start in closed:
+            for key, counter in self.windows.pop(start).items():
+                keys.append(key)
+                starts.append(start)
+                cols.extend(counter.keys())
+                counts.extend(counter.values())
+                lengths.append(len(counter))
+
+        indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        x = sp.csr_matrix((np.array(counts, dtype=np.float64), np.array(cols, dtype=np.int64), indptr),
+                          shape=(len(keys), len(self.vocab)))
+        x.sort_indices()
+        starts = np.array(starts)
+        self.n_emitted += len(keys)
+        return SessionBatch(keys, starts, starts + self.window_secs, x)
+
+    def stats(self):
+        return {
+            'open_windows': len(self.windows),
+            'open_sessions': sum(len(sessions) for sessions in self.windows.values()),
+            'emitted': self.n_emitted,
+            'late': self.n_late,
+            'oov': self.n_oov,
+            'invalid_time': self.n_invalid_time
+        }
+
+
+class SessionTable(object):
+    """
+    Event counts per (session key, window) kept in a key-value table, e.g. a Faust table, for
+    tumbling windows in event time. Windows are closed by the events themselves: each `add`
+    advances the watermark and removes the windows that ended before it, so a table that may
+    only be changed while processing an event is never changed elsewhere, and each window is
+    returned exactly once. Events without a time are stamped on arrival.
+    """
+
+    def __init__(self, table, window_secs=60., lateness_secs=0., time_field='metadata.timestamp'):
+        """
+
+        :param table: (MutableMapping) JSON [session key, window start] -> JSON {event ID: count}
+        :param window_secs: (float) window length
+        :param lateness_secs: (float) how far behind the latest timestamp an event may arrive
+               before its window is closed; later events are dropped and counted as late
+        :param time_field: (str) dotted path of the event time (see `event_time`)
+        """
+        self.table = table
+        self.window_secs = window_secs
+        self.lateness_secs = lateness_secs
+        self.time_field = time_field
+        self.open_windows = None  # window start -> table keys, indexed from the table on first use
+        self.max_time = None
+        self.n_late = 0
+        self.n_closed = 0
+
+    @property
+    def watermark(self):
+        """ Windows ending at or before this time are complete """
+        return None if self.max_time is None else self.max_time - self.lateness_secs
+
+    def add(self, log, keys):
+        """
+        Count a log in the windows of its sessions and close the windows it leaves behind
+
+        :param log: (dict) parsed log
+        :param keys: (iterable) session keys of the log
+        :return: (list) of (session key, window start, {event ID: count}) of the closed windows
+        """
+        if self.open_windows is None:
+            # windows restored from the table's changelog after a restart
+            self.open_windows = {}
+            for table_key in list(self.table.keys()):
+                self.open_windows.setdefault(json.loads(table_key)[1], set()).add(table_key)
+
+        timestamp = event_time(log, self.time_field)
+        if timestamp is None:
+            timestamp = time.time()
+
+        start = timestamp - timestamp % self.window_secs
+        watermark = self.watermark
+        if watermark is not None and start + self.window_secs <= watermark:
+            self.n_late += 1
+        else:
+            event = str(log['event_id'])
+            for key in keys:
+                table_key = json.dumps([key, start])
+                value = self.table.get(table_key)
+                counts = json.loads(value) if value else {}
+                counts[event] = counts.get(event, 0) + 1
+
+                # reassign so that the update is written to the changelog
+                self.table[table_key] = json.dumps(counts)
+                self.open_windows.setdefault(start, set()).add(table_key)
+
+        if self.max_time is None or timestamp > self.max_time:
+            self.max_time = timestamp
+
+        return self.close()
+
+    def close(self):
+        """
+        Remove the windows that ended before the watermark
+
+        :return: (list) of (session key, window start, {event ID: count})
+        """
+        watermark = self.watermark
+        closed = []
+        if watermark is None or self.open_windows is None:
+            return closed
+
+        for start in sorted(start for start in self.open_windows if start + self.window_secs <= watermark):
+            for table_key in sorted(self.open_windows.pop(start)):
+                value = self.table.get(table_key)
+                if value:
+                    closed.append((json.loads(table_key)[0], start, json.loads(value)))
+                    del self.table[table_key]
+
+        self.n_closed += len(closed)
+        return closed
+
+    def stats(self):
+        return {
+            'open_windows': len(self.open_windows or ()),
+            'closed': self.n_closed,
+            'late': self.n_late
+        }
+
+
+def stream_sessions(paths, key='ip_address', time_field='metadata.timestamp', window_secs=300., slide_secs=None,
+                    lateness_secs=0., vocab=None, n_jobs=None, chunk_bytes=1 << 22, flush_every=10000,
+                    builder=None):
+    """
+    Read parsed log files (`.jsonl`, one file per source, each in time order) in parallel and
+    yield sessions as their windows close. Files are split into chunks that are decoded in a
+    process pool, and the per-file records are merged by timestamp.
+
+    :param paths: (list) parsed log files
+    :param key: (str) entity type whose values key the sessions, e.g. 'ip_address' or 'user',
+           or a picklable function of the log returning its session keys, e.g. `block_ids`
+    :param time_field: (str) dotted path of the event time, in epoch seconds or ISO 8601.
+           Logs without it, or with a time that cannot be parsed, take the time of the previous
+           log of the same file
+    :param window_secs: (float) window length
+    :param slide_secs: (float) interval between window starts; None for tumbling windows
+    :param lateness_secs: (float) allowed lateness of events (see `SessionBuilder`)
+    :param vocab: (dict) fixed event -> column mapping (see `SessionBuilder`)
+    :param n_jobs: (int) number of worker processes; defaults to the number of CPUs
+    :param chunk_bytes: (int) approximate size of the file chunks decoded per task
+    :param flush_every: (int) number of logs between checks for closed windows
+    :param builder: (SessionBuilder) to group the events with, e.g. to read its `stats()`;
+           by default, one is created from the window settings above
+    :return: (generator) of SessionBatch
+    """
+    if builder is None:
+        builder = SessionBuilder(window_secs, slide_secs, lateness_secs, vocab)
+
+    with ProcessPoolExecutor(max_workers=n_jobs or os.cpu_count()) as executor:
+        files = [_file_records(executor, str(path), chunk_bytes, key, time_field, builder) for path in paths]
+        for i, (timestamp, keys, event) in enumerate(heapq.merge(*files, key=lambda r: r[0]), 1):
+            builder.add(timestamp, keys, event)
+            if i % flush_every == 0:
+                batch = builder.flush()
+                if batch is not None:
+                    yield batch
+
+    batch = builder.flush(final=True)
+    if batch is not None:
+        yield batch
+
+
+def _file_records(executor, path, chunk_bytes, key, time_field, builder):
+    """
+    Records of one file in order, decoding the next chunk while the current one is consumed.
+    Logs with an invalid time are counted in `builder`.
+    """
+    chunks = _chunk_offsets(path, chunk_bytes)
+    if not chunks:
+        return
+
+    future = executor.submit(_read_chunk, path, chunks[0][0], chunks[0][1], key, time_field)
+    last_time = 0.
+    for i in range(len(chunks)):
+        records, n_invalid_time = future.result()
+        builder.n_invalid_time += n_invalid_time
+        if i + 1 < len(chunks):
+            future = executor.submit(_read_chunk, path, chunks[i + 1][0], chunks[i + 1][1], key, time_field)
+
+        for timestamp, keys, event in records:
+            if timestamp is None:
+                timestamp = last_time
+
+            last_time = timestamp
+            if keys:
+                yield timestamp, keys, event
+
+
+def _chunk_offsets(path, chunk_bytes):
+    """ (start, end) byte ranges of about `chunk_bytes`, ending on line boundaries """
+    size = os.path.getsize(path)
+    offsets = [0]
+    with open(path, 'rb') as f:
+        while offsets[-1] < size:
+            f.seek(min(offsets[-1] + chunk_bytes, size))
+            f.readline()
+            offsets.append(min(f.tell(), size))
+
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def _read_chunk(path, start, end, key, time_field):
+    """
+    Decode the logs in a byte range of a file
+
+    :return: (list, int) of (timestamp or None, session keys, event ID), and the number of logs
+             with a time that could not be parsed
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).splitlines()
+
+    records = []
+    n_invalid_time = 0
+    for line in lines:
+        if not line.strip():
+            continue
+
+        log = json.loads(line)
+        if callable(key):
+            keys = key(log)
+        else:
+            keys = {p['value'] for p in log['params'] if p['entity'] == key}
+
+        value = field_value(log, time_field)
+        timestamp = parse_time(value)
+        if timestamp is None and value is not None:
+            n_invalid_time += 1
+
+        records.append((timestamp, keys, log['event_id']))
+
+    return records, n_invalid_time
+
+
+def event_time(log, time_field='metadata.timestamp'):
+    """
+    :param log: (dict) parsed log
+    :param time_field: (str) dotted path of the event time, in epoch seconds or ISO 8601
+    :return: (float) epoch seconds, or None when the log has no time or it cannot be parsed
+    """
+    return parse_time(field_value(log, time_field))
+
+
+def field_value(log, field):
+    """
+    :param log: (dict) parsed log
+    :param field: (str) dotted path of the field
+    :return: the value, or None when the log has no such field
+    """
+    value = log
+    for name in field.split('.'):
+        if not isinstance(value, dict) or name not in value:
+            return None
+
+        value = value[name]
+
+    return value
+
+
+def parse_time(value):
+    """
+    :param value: time in epoch seconds or ISO 8601
+    :return: (float) epoch seconds, or None when `value` is missing or cannot be parsed
+    """
+    if value is None:
+        return None
+
+    try:
+        timestamp = float(value)
+    except (TypeError, ValueError):
+        try:
+            timestamp = pd.Timestamp(value).timestamp()
+        except (TypeError, ValueError):
+            return None
+
+    return timestamp if np.isfinite(timestamp) else None
@@ -0,0 +1,115 @@
+import time
+from concurrent.futures import Future
+from queue import Empty, Queue
+from threading import Lock, Thread
+
+import numpy as np
+
+
+class BatchCoalescer(object):
+    """
+    Coalesces concurrent prediction requests into batches. Requests from any number of threads
+    are queued; a single worker thread collects them for up to `max_wait_ms` after the first,
+    or until `max_batch_size` items, runs one batched prediction and hands each request its
+    slice of the results. The model is only ever called from the worker thread.
+    """
+
+    def __init__(self, predict_batch, max_batch_size=256, max_wait_ms=2.):
+        """
+
+        :param predict_batch: (callable) list of items -> array of results, one per item
+        :param max_batch_size: (int) number of items after which a batch is run without waiting
+        :param max_wait_ms: (float) how long the first request of a batch waits for others
+        """
+        self._predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.queue = Queue()
+        self.lock = Lock()
+        self.n_batches = 0
+        self.n_requests = 0
+        self.n_items = 0
+        self.thread = Thread(target=self._run, name='batch-coalescer', daemon=True)
+        self.thread.start()
+
+    def predict_batch(self, items):
+        """
+        Blocks until the batch holding these items has run
+
+        :param items: (list) items to predict
+        :return: (ndarray) results, one per item
+        """
+        if len(items) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        future = Future()
+        self.queue.put((list(items), future))
+        return future.result()
+
+    def predict(self, item):
+        return self.predict_batch([item])[0]
+
+    def close(self):
+        """ Stop the worker thread once the queued requests have run """
+        self.queue.put(None)
+        self.thread.join()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'batches': self.n_batches,
+                'requests': self.n_requests,
+                'items': self.n_items,
+                'mean_batch_size': self.n_items / self.n_batches if self.n_batches else 0.
+            }
+
+    def _run(self):
+        while True:
+            request = self.queue.get()
+            if request is None:
+                return
+
+            requests = [request]
+            n_items = len(request[0])
+            deadline = time.monotonic() + self.max_wait_ms / 1000.
+            closed = False
+            while n_items < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+
+                try:
+                    request = self.queue.get(timeout=timeout)
+                except Empty:
+                    break
+
+                if request is None:
+                    closed = True
+                    break
+
+                requests.append(request)
+                n_items += len(request[0])
+
+            self._run_batch(requests)
+            if closed:
+                return
+
+    def _run_batch(self, requests):
+        items = [item for request_items, _ in requests for item in request_items]
+        try:
+            results = self._predict_batch(items)
+        except Exception as e:
+            for _, future in requests:
+                future.set_exception(e)
+
+            return
+
+        with self.lock:
+            self.n_batches += 1
+            self.n_requests += len(requests)
+            self.n_items += len(items)
+
+        start = 0
+        for request_items, future in requests:
+            future.set_result(results[start:start + len(request_items)])
+            start += len(request_items)
@@ -4,6 +4,8 @@ import falcon
 
 from api.config import LOGGING_CONFIG
 from api.logs_endpoint import LogsResource
+from api.neighbourhood_endpoint import NeighbourhoodResource
+from api.similar_endpoint import SimilarResource
 from api.urls_prediction_endpoint import UrlsResource
 
 dictConfig(LOGGING_CONFIG)
@@ -11,6 +13,11 @@ dictConfig(LOGGING_CONFIG)
 app = falcon.API()
 logs = LogsResource()
 urls = UrlsResource()
+similar = SimilarResource()
+neighbourhood = NeighbourhoodResource()
 
 app.add_route('/logs', logs)
 app.add_route('/urls', urls)
+app.add_route('/urls/bulk', urls, suffix='bulk')
+app.add_route('/similar', similar)
+app.add_route('/neighbourhood', neighbourhood)
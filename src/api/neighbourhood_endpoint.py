@@ -0,0 +1,81 @@
+import json
+import logging
+import os
+from pathlib import Path
+from threading import Lock
+
+import falcon
+
+from analysis.neighbourhood import NeighbourhoodService
+from api.params import node_list, positive_int, read_json_object
+from graph_export import CsrGraph
+
+ROOT = Path(__file__).parent.parent.parent
+
+GRAPH_NAME = 'graph'
+
+MAX_HOPS = 10
+MAX_NODES = 100000
+
+# seconds a client is asked to wait while the graph has not been exported
+RETRY_AFTER = 60
+
+
+class NeighbourhoodResource(object):
+
+    def __init__(self, graph_path=None):
+        """
+
+        :param graph_path: (str) folder of the CSR export written by `graph_export.export_graph`
+               (default: `MODELS_DIR/graph`)
+        """
+        self.graph_path = str(graph_path or ROOT / os.getenv('MODELS_DIR') / GRAPH_NAME)
+        self.service = None
+        self.lock = Lock()
+
+    def get_service(self):
+        """ Loaded on first use, so that the API starts before the graph has been exported """
+        with self.lock:
+            if self.service is None:
+                if not CsrGraph.exists(self.graph_path):
+                    raise falcon.HTTPServiceUnavailable(
+                        'Graph not exported',
+                        'The log graph has not been exported yet (`python analysis/communities.py`).',
+                        RETRY_AFTER)
+
+                # memory-mapped read-only
+                self.service = NeighbourhoodService(CsrGraph.load(self.graph_path, mmap_mode='r'))
+                logging.info('Neighbourhood service initialized!')
+
+            return self.service
+
+    def on_get(self, req, resp):
+        logging.debug('-> ' + self.on_get.__name__)
+        params = dict(req.params)
+        params['nodes'] = req.get_param_as_list('node')
+        params['types'] = req.get_param_as_list('type')
+        params['compact'] = req.get_param_as_bool('compact')
+        self._neighbourhood(resp, params)
+
+    def on_post(self, req, resp):
+        logging.debug('-> ' + self.on_post.__name__)
+        self._neighbourhood(resp, read_json_object(req))
+
+    def _neighbourhood(self, resp, params):
+        nodes = node_list(params.get('nodes'))
+        hops = positive_int(params, 'hops', 2, MAX_HOPS)
+        max_nodes = positive_int(params, 'max_nodes', 10000, MAX_NODES)
+        max_degree = positive_int(params, 'max_degree')
+        types = params.get('types')
+        if types is not None and (not isinstance(types, list) or not all(isinstance(t, str) for t in types)):
+            raise falcon.HTTPBadRequest('Invalid edge type', '`types` must be a list of edge collection names.')
+
+        try:
+            subgraph = self.get_service().neighbourhood(nodes, hops=hops, edge_types=types, max_nodes=max_nodes,
+                                                        max_degree=max_degree)
+        except ValueError as e:
+            raise falcon.HTTPBadRequest('Invalid edge type', str(e))
+
+        resp.status = falcon.HTTP_200
+        resp.content_type = falcon.MEDIA_JSON
+        resp.body = json.dumps(subgraph.to_dict(compact=bool(params.get('compact'))))
@@ -0,0 +1,64 @@
+import json
+
+import falcon
+
+
+def read_json_object(req):
+    """
+    :param req: (falcon.Request) request with a JSON object body
+    :return: (dict) the parsed body
+    """
+    try:
+        body = json.loads(req.bounded_stream.read().decode('utf-8'))
+    except ValueError:
+        body = None
+
+    if not isinstance(body, dict):
+        raise falcon.HTTPBadRequest('Invalid JSON', 'The request body must be a JSON object.')
+
+    return body
+
+
+def positive_int(params, name, default=None, max_value=None):
+    """
+    A positive integer parameter, given as a query string or a JSON value
+
+    :param params: (dict) request parameters
+    :param name: (str) parameter name
+    :param default: (int) value of a missing parameter
+    :param max_value: (int) largest value accepted
+    :return: (int) the parameter value, or `default`
+    """
+    value = params.get(name)
+    if value is None:
+        return default
+
+    if isinstance(value, str):
+        try:
+            value = int(value)
+        except ValueError:
+            pass
+
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise falcon.HTTPBadRequest('Invalid parameter', '`{}` must be a positive integer.'.format(name))
+
+    if max_value is not None and value > max_value:
+        raise falcon.HTTPBadRequest('Invalid parameter', '`{}` must be at most {}.'.format(name, max_value))
+
+    return value
+
+
+def node_list(nodes):
+    """
+    :param nodes: (list) graph node IDs from the request
+    :return: (list) the node IDs
+    """
+    if not nodes:
+        raise falcon.HTTPBadRequest(
+            'Missing nodes',
+            'One or more graph node IDs must be submitted, e.g. `?node=ip_addrs/1a2b3c4d`.')
+
+    if not isinstance(nodes, list) or not all(isinstance(node, str) for node in nodes):
+        raise falcon.HTTPBadRequest('Invalid nodes', '`nodes` must be a list of graph node IDs.')
+
+    return nodes
@@ -0,0 +1,81 @@
+import json
+import logging
+import os
+from pathlib import Path
+from threading import Lock
+
+import falcon
+
+from api.params import node_list, positive_int, read_json_object
+from ml.node2vec.ann import META_FILENAME, LshIndex
+
+ROOT = Path(__file__).parent.parent.parent
+
+INDEX_NAME = 'node2vec-index'
+
+MAX_K = 1000
+
+# seconds a client is asked to wait while the index has not been built
+RETRY_AFTER = 60
+
+
+class SimilarResource(object):
+
+    def __init__(self, index_path=None):
+        """
+
+        :param index_path: (str) folder of the saved `LshIndex` (default: `MODELS_DIR/node2vec-index`)
+        """
+        self.index_path = str(index_path or ROOT / os.getenv('MODELS_DIR') / INDEX_NAME)
+        self.index = None
+        self.index_stamp = None  # identity of the meta file the index was loaded from
+        self.lock = Lock()
+
+    def get_index(self):
+        """
+        Loaded on first use, so that the API starts before embeddings have been trained.
+        Memory-mapped read-only, so loading does not depend on the number of embeddings and
+        all gunicorn workers share the same pages of the OS page cache. Reloaded when a retrain
+        replaces the meta file.
+        """
+        meta_path = os.path.join(self.index_path, META_FILENAME)
+        with self.lock:
+            try:
+                st = os.stat(meta_path)
+            except FileNotFoundError:
+                st = None
+
+            if st is None and self.index is None:
+                raise falcon.HTTPServiceUnavailable(
+                    'Index not built',
+                    'Node embeddings have not been trained yet (`python ml/node2vec/cluster_search.py`).',
+                    RETRY_AFTER)
+
+            stamp = None if st is None else (st.st_ino, st.st_mtime_ns, st.st_size)
+            if stamp is not None and stamp != self.index_stamp:
+                self.index = LshIndex.load(self.index_path, mmap_mode='r')
+                self.index_stamp = stamp
+                logging.info('Similarity index initialized!')
+
+            return self.index
+
+    def on_get(self, req, resp):
+        logging.debug('-> ' + self.on_get.__name__)
+        self._similar(resp, req.get_param_as_list('node'), req.params)
+
+    def on_post(self, req, resp):
+        logging.debug('-> ' + self.on_post.__name__)
+        body = read_json_object(req)
+        self._similar(resp, body.get('nodes'), body)
+
+    def _similar(self, resp, nodes, params):
+        nodes = node_list(nodes)
+        k = positive_int(params, 'k', 10, MAX_K)
+        n_probes = positive_int(params, 'probes', 4)
+        results = self.get_index().most_similar(nodes, k=k, n_probes=n_probes)
+        resp.status = falcon.HTTP_200
+        resp.content_type = falcon.MEDIA_JSON
+        resp.body = json.dumps({
+            node: None if neighbours is None else [{'node': n, 'similarity': s} for n, s in neighbours]
+            for node, neighbours in zip(nodes, results)
+        })
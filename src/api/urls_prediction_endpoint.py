@@ -1,22 +1,43 @@
+import json
 import logging
 import os
 from pathlib import Path
 
 import falcon
 
-from ml.url_classifier.bilstm import BiLstmPredictor
+from api.coalescer import BatchCoalescer
+from ml.url_classifier.bilstm_numpy import load_predictor
+from ml.url_classifier.verdict_cache import UrlVerdictCache
 
 ROOT = Path(__file__).parent.parent.parent
 
+# model calls from concurrent requests are coalesced into batches of up to this many URLs,
+# waiting at most this long for other requests to join
+MAX_BATCH_SIZE = 256
+MAX_WAIT_MS = 2.
+
+MEDIA_NDJSON = 'application/x-ndjson'
+
 
 class UrlsResource(object):
 
     def __init__(self):
         model_path = ROOT / os.getenv('MODELS_DIR')
-        self.predictor = BiLstmPredictor()
-        self.predictor.load_model(model_path)
+        predictor = load_predictor(model_path)
+        self.coalescer = BatchCoalescer(predictor.predict_batch, MAX_BATCH_SIZE, MAX_WAIT_MS)
+
+        # cache hits are answered at once; only misses wait for a batch
+        self.classifier = UrlVerdictCache.from_models_dir(self.coalescer, model_path)
         logging.info('Model initialized!')
 
+    def on_get(self, req, resp):
+        """ Verdict cache and batching statistics """
+        stats = self.classifier.stats()
+        stats['batching'] = self.coalescer.stats()
+        resp.status = falcon.HTTP_200
+        resp.content_type = falcon.MEDIA_JSON
+        resp.body = json.dumps(stats)
+
     def on_post(self, req, resp):
         logging.debug('-> ' + self.on_post.__name__)
         url = req.stream.read().decode('utf-8')
@@ -26,6 +47,36 @@ class UrlsResource(object):
                 'Missing URL',
                 'A URL must be submitted in the request body.')
 
-        pred = self.predictor.predict(url)
+        pred = self.classifier.predict(url)
         resp.status = falcon.HTTP_200
         resp.body = 'bad' if pred == 1 else 'good'
+
+    def on_post_bulk(self, req, resp):
+        """
+        Classify newline-delimited JSON, one URL string or `{"url": ...}` object per line,
+        answering with one `{"url": ..., "verdict": "bad" | "good"}` line per URL
+        """
+        logging.debug('-> ' + self.on_post_bulk.__name__)
+        urls = []
+        for i, line in enumerate(req.stream.read().decode('utf-8').splitlines(), 1):
+            if not line.strip():
+                continue
+
+            try:
+                value = json.loads(line)
+            except ValueError:
+                value = None
+
+            url = value.get('url') if isinstance(value, dict) else value
+            if not isinstance(url, str) or len(url) == 0:
+                raise falcon.HTTPBadRequest(
+                    'Invalid URL',
+                    'Line {} must be a JSON string or an object with a "url" string.'.format(i))
+
+            urls.append(url)
+
+        preds = self.classifier.predict_batch(urls)
+        resp.status = falcon.HTTP_200
+        resp.content_type = MEDIA_NDJSON
+        resp.body = ''.join(json.dumps({'url': url, 'verdict': 'bad' if pred == 1 else 'good'}) + '\n'
+                            for url, pred in zip(urls, preds))
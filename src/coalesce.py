@@ -0,0 +1,167 @@
+"""
+Coalesce entity occurrences emitted by `load.py` into one merged vertex update per
+entity per window, instead of rewriting the vertex on every occurrence. The edges to
+those vertices are held in the same window and written after them, since an edge may
+not be inserted before its `_to` vertex exists.
+"""
+
+import time
+
+# Merge a window's aggregates into existing vertices in a single round trip per collection.
+# AQL arithmetic treats a missing attribute (null) as 0, and MIN/MAX ignore nulls, so the
+# same statement works for new vertices and for vertices written before coalescing.
+UPSERT_ENTITIES_AQL = '''
+FOR e IN @entities
+    UPSERT { _key: e._key }
+    INSERT e
+    UPDATE {
+        name: e.name,
+        count: OLD.count + e.count,
+        n_logs: OLD.n_logs + e.n_logs,
+        first_seen: MIN([OLD.first_seen, e.first_seen]),
+        last_seen: MAX([OLD.last_seen, e.last_seen])
+    }
+    IN @@collection
+'''
+
+UPSERT_EDGES_AQL = '''
+FOR e IN @edges
+    UPSERT { _key: e._key }
+    INSERT e
+    UPDATE e
+    IN @@collection
+'''
+
+
+class EntityAggregate(object):
+
+    __slots__ = ('name', 'count', 'first_seen', 'last_seen', 'log_ids')
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.first_seen = None
+        self.last_seen = None
+        self.log_ids = set()
+
+    def add(self, log_id, timestamp):
+        self.count += 1
+        self.log_ids.add(log_id)
+        if self.first_seen is None or timestamp < self.first_seen:
+            self.first_seen = timestamp
+
+        if self.last_seen is None or timestamp > self.last_seen:
+            self.last_seen = timestamp
+
+    def as_document(self, key):
+        return {
+            '_key': key,
+            'name': self.name,
+            'count': self.count,
+            'n_logs': len(self.log_ids),
+            'first_seen': self.first_seen,
+            'last_seen': self.last_seen
+        }
+
+
+class EntityCoalescer(object):
+    """
+    Buffers entity occurrences per vertex collection and writes one merged update per
+    entity when the window closes, either because `window_secs` has elapsed since the
+    first buffered occurrence or because `max_entities` distinct entities are pending.
+    Edges added with an occurrence are written once all pending vertices have been.
+
+    Distinct-log counts are exact across windows because a log is only loaded once, so
+    the per-window `n_logs` values can simply be summed.
+    """
+
+    def __init__(self, db, window_secs=5.0, max_entities=10000):
+        """
+
+        :param db: (arango.database.StandardDatabase) database holding the vertex collections
+        :param window_secs: (float) maximum age of a window before it is flushed
+        :param max_entities: (int) maximum number of pending entities before a flush
+        """
+        self.db = db
+        self.window_secs = window_secs
+        self.max_entities = max_entities
+        self.pending = {}  # collection name -> {key: EntityAggregate}
+        self.pending_edges = {}  # edge collection name -> {key: edge document}
+        self.n_pending = 0
+        self.window_start = None
+        self.n_occurrences = 0
+        self.n_writes = 0
+
+    def add(self, collection_name, key, name, log_id, timestamp=None, edge_collection_name=None, edge=None):
+        """
+        Record an occurrence of an entity, with the edge that links it to its log
+
+        :param collection_name: (str) vertex collection of the entity
+        :param key: (str) vertex key
+        :param name: (str) entity value
+        :param log_id: (str) log in which the entity occurs
+        :param timestamp: (float) time of the occurrence, now by default
+        :param edge_collection_name: (str) edge collection of `edge`
+        :param edge: (dict) edge document to write after the vertex
+        """
+        if timestamp is None:
+            timestamp = time.time()
+
+        if self.window_start is None:
+            self.window_start = time.time()
+
+        entities = self.pending.setdefault(collection_name, {})
+        agg = entities.get(key)
+        if agg is None:
+            agg = entities[key] = EntityAggregate(name)
+            self.n_pending += 1
+
+        agg.add(log_id, timestamp)
+        if edge is not None:
+            self.pending_edges.setdefault(edge_collection_name, {})[edge['_key']] = edge
+
+        self.n_occurrences += 1
+        if self.should_flush():
+            self.flush()
+
+    def should_flush(self):
+        if self.window_start is None:
+            return False
+
+        return (self.n_pending >= self.max_entities or
+                time.time() - self.window_start >= self.window_secs)
+
+    def flush(self):
+        """
+        Write one merged update per pending entity, then the pending edges.
+
+        :return: (int) number of entities written
+        """
+        n_written = 0
+        for collection_name, entities in self.pending.items():
+            if not entities:
+                continue
+
+            docs = [agg.as_document(key) for key, agg in entities.items()]
+            self.db.aql.execute(UPSERT_ENTITIES_AQL,
+                                bind_vars={'entities': docs, '@collection': collection_name})
+            n_written += len(docs)
+
+        for collection_name, edges in self.pending_edges.items():
+            if edges:
+                self.db.aql.execute(UPSERT_EDGES_AQL,
+                                    bind_vars={'edges': list(edges.values()), '@collection': collection_name})
+
+        self.pending = {}
+        self.pending_edges = {}
+        self.n_pending = 0
+        self.window_start = None
+        self.n_writes += n_written
+        return n_written
+
+    def stats(self):
+        return {
+            'occurrences': self.n_occurrences,
+            'writes': self.n_writes,
+            'pending': self.n_pending
+        }
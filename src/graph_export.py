@@ -0,0 +1,265 @@
+"""
+Export the ArangoDB log graph into compact, integer-indexed CSR (compressed sparse row)
+arrays. Each edge collection is streamed once through an AQL cursor, and the result can be
+cached as `.npy` files that are memory-mapped on reload.
+"""
+
+import json
+import os
+from array import array
+from pathlib import Path
+
+import numpy as np
+
+META_FILENAME = 'meta.json'
+
+VERTEX_IDS_AQL = 'FOR v IN @@collection RETURN v._id'
+EDGES_AQL = 'FOR e IN @@collection RETURN [e._from, e._to, e[@weight_key]]'
+
+
+class CsrGraph(object):
+    """
+    Undirected graph stored as CSR arrays. The neighbours of node `i` are
+    `neighbours[offsets[i]:offsets[i + 1]]`, sorted ascending, with matching `weights`
+    and `edge_types` (index into `edge_type_names`). `ids` maps node index to vertex `_id`.
+    """
+
+    ARRAY_NAMES = ('offsets', 'neighbours', 'weights', 'edge_types', 'ids')
+
+    def __init__(self, offsets, neighbours, weights, edge_types, ids, edge_type_names):
+        self.offsets = offsets
+        self.neighbours = neighbours
+        self.weights = weights
+        self.edge_types = edge_types
+        self.ids = ids
+        self.edge_type_names = list(edge_type_names)
+        self.path = None  # folder the arrays were loaded from, if any
+        self._index = None
+
+    @property
+    def n_nodes(self):
+        return len(self.offsets) - 1
+
+    @property
+    def n_edges(self):
+        """ Number of directed (half) edges; each undirected edge is stored in both rows """
+        return len(self.neighbours)
+
+    @property
+    def index(self):
+        """ (dict) vertex `_id` -> node index, built on first use """
+        if self._index is None:
+            self._index = {str(_id): i for i, _id in enumerate(self.ids)}
+
+        return self._index
+
+    def degrees(self):
+        return np.diff(self.offsets)
+
+    def neighbours_of(self, i):
+        return self.neighbours[self.offsets[i]:self.offsets[i + 1]]
+
+    def weights_of(self, i):
+        return self.weights[self.offsets[i]:self.offsets[i + 1]]
+
+    def has_edge(self, i, j):
+        row = self.neighbours_of(i)
+        k = np.searchsorted(row, j)
+        return k < len(row) and row[k] == j
+
+    def has_edges(self, rows, cols):
+        """
+        Vectorized edge membership test, by binary search within each (sorted) row
+
+        :param rows: (ndarray) source node indices
+        :param cols: (ndarray) destination node indices
+        :return: (ndarray) boolean mask
+        """
+        return self.edge_positions(rows, cols) >= 0
+
+    def edge_positions(self, rows, cols):
+        """
+        Vectorized edge lookup, by binary search within each (sorted) row
+
+        :param rows: (ndarray) source node indices
+        :param cols: (ndarray) destination node indices
+        :return: (ndarray) position of each edge in the CSR arrays, -1 where there is no edge
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols)
+        lo = self.offsets[rows].astype(np.int64)
+        end = self.offsets[rows + 1].astype(np.int64)
+        hi = end.copy()
+        searching = lo < hi
+        while searching.any():
+            mid = np.where(searching, (lo + hi) // 2, 0)
+            less = self.neighbours[mid] < cols
+            lo = np.where(searching & less, mid + 1, lo)
+            hi = np.where(searching & ~less, mid, hi)
+            searching = lo < hi
+
+        found = lo < end
+        found[found] = self.neighbours[lo[found]] == cols[found]
+        return np.where(found, lo, -1)
+
+    @classmethod
+    def from_edges(cls, src, dst, weights, edge_types, ids, edge_type_names):
+        """
+        Build a symmetric CSR graph from an edge list. Parallel edges are merged, keeping the
+        weight and type of the first.
+
+        :param src: (ndarray) source node indices
+        :param dst: (ndarray) destination node indices
+        :param weights: (ndarray) edge weights
+        :param edge_types: (ndarray) edge type indices into `edge_type_names`
+        :param ids: (ndarray) vertex `_id` per node index
+        :param edge_type_names: (list) edge collection names
+        :return: (CsrGraph)
+        """
+        n_nodes = len(ids)
+        src = np.asarray(src, dtype=np.int32)
+        dst = np.asarray(dst, dtype=np.int32)
+        weights = np.asarray(weights, dtype=np.float32)
+        edge_types = np.asarray(edge_types, dtype=np.int16)
+
+        # parallel edges, e.g. the same pair in both directions or in two edge collections, are
+        # merged into the first so that they don't add up in the transition weights
+        lo, hi = np.minimum(src, dst), np.maximum(src, dst)
+        order = np.lexsort((hi, lo))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (lo[order][1:] != lo[order][:-1]) | (hi[order][1:] != hi[order][:-1])
+        keep = np.sort(order[first])
+        src, dst, weights, edge_types = src[keep], dst[keep], weights[keep], edge_types[keep]
+
+        # add the reverse of every edge except self-loops
+        rev = src != dst
+        rows = np.concatenate([src, dst[rev]])
+        cols = np.concatenate([dst, src[rev]])
+        weights = np.concatenate([weights, weights[rev]])
+        edge_types = np.concatenate([edge_types, edge_types[rev]])
+
+        order = np.lexsort((cols, rows))
+        offsets = np.zeros(n_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n_nodes), out=offsets[1:])
+        return cls(offsets, cols[order], weights[order], edge_types[order], np.asarray(ids),
+                   edge_type_names)
+
+    @classmethod
+    def from_networkx(cls, g, weight_key='weight'):
+        """
+        Build a CSR graph from a NetworkX graph; node labels become string ids
+
+        :param g: (networkx.Graph) input graph
+        :param weight_key: (str) key for the weight attribute; missing weights default to 1
+        :return: (CsrGraph)
+        """
+        index = {node: i for i, node in enumerate(g.nodes())}
+        edges = list(g.edges(data=weight_key, default=1))
+        src = [index[u] for u, _, _ in edges]
+        dst = [index[v] for _, v, _ in edges]
+        weights = [w for _, _, w in edges]
+        ids = np.array([str(node) for node in g.nodes()])
+        return cls.from_edges(src, dst, weights, np.zeros(len(edges)), ids, ['edges'])
+
+    def save(self, dirname):
+        path = Path(dirname)
+        path.mkdir(parents=True, exist_ok=True)
+        for name in self.ARRAY_NAMES:
+            # replace rather than overwrite, so that processes with the previous export
+            # memory-mapped keep reading the old file
+            tmp_filename = str(path / (name + '.tmp.npy'))
+            np.save(tmp_filename, getattr(self, name))
+            os.replace(tmp_filename, str(path / (name + '.npy')))
+
+        # written last so that a partially written cache is never considered complete
+        with (path / META_FILENAME).open('w') as f:
+            json.dump({
+                'n_nodes': self.n_nodes,
+                'n_edges': self.n_edges,
+                'edge_type_names': self.edge_type_names
+            }, f)
+
+    @classmethod
+    def load(cls, dirname, mmap_mode='r'):
+        path = Path(dirname)
+        with (path / META_FILENAME).open('r') as f:
+            meta = json.load(f)
+
+        arrays = [np.load(str(path / (name + '.npy')), mmap_mode=mmap_mode) for name in cls.ARRAY_NAMES]
+        g = cls(*arrays, edge_type_names=meta['edge_type_names'])
+        g.path = str(path)
+        return g
+
+    @staticmethod
+    def exists(dirname):
+        return (Path(dirname) / META_FILENAME).exists()
+
+    def to_networkx(self):
+        import networkx as nx
+
+        g = nx.Graph()
+        g.add_nodes_from(str(_id) for _id in self.ids)
+        rows = np.repeat(np.arange(self.n_nodes), self.degrees())
+        upper = rows <= self.neighbours
+        for i, j, w, t in zip(rows[upper], self.neighbours[upper], self.weights[upper], self.edge_types[upper]):
+            g.add_edge(str(self.ids[i]), str(self.ids[j]), weight=float(w),
+                       type=self.edge_type_names[t])
+
+        return g
+
+
+def export_graph(db, graph_name='logs', cache_dir=None, refresh=False, weight_key='weight', batch_size=10000):
+    """
+    Export a named graph to CSR arrays, streaming each collection once
+
+    :param db: (arango.database.StandardDatabase) database holding the graph
+    :param graph_name: (str) name of the graph
+    :param cache_dir: (str) directory to cache the arrays; reloaded memory-mapped when present
+    :param refresh: (bool) ignore an existing cache, which is never invalidated otherwise
+    :param weight_key: (str) edge attribute holding the weight; missing weights default to 1
+    :param batch_size: (int) number of documents per cursor batch
+    :return: (CsrGraph)
+    """
+    if cache_dir and not refresh and CsrGraph.exists(cache_dir):
+        return CsrGraph.load(cache_dir)
+
+    graph = db.graph(graph_name)
+    index = {}
+    ids = []
+
+    def node_index(_id):
+        i = index.get(_id)
+        if i is None:
+            i = index[_id] = len(ids)
+            ids.append(_id)
+
+        return i
+
+    # include isolated vertices
+    for name in graph.vertex_collections():
+        cursor = db.aql.execute(VERTEX_IDS_AQL, bind_vars={'@collection': name}, batch_size=batch_size)
+        for _id in cursor:
+            node_index(_id)
+
+    edge_type_names = [x['edge_collection'] for x in graph.edge_definitions()]
+    src = array('i')
+    dst = array('i')
+    weights = array('f')
+    edge_types = array('h')
+    for edge_type, name in enumerate(edge_type_names):
+        cursor = db.aql.execute(EDGES_AQL, bind_vars={'@collection': name, 'weight_key': weight_key},
+                                batch_size=batch_size)
+        for _from, _to, weight in cursor:
+            src.append(node_index(_from))
+            dst.append(node_index(_to))
+            weights.append(1. if weight is None else weight)
+            edge_types.append(edge_type)
+
+    g = CsrGraph.from_edges(np.frombuffer(src, dtype=np.int32), np.frombuffer(dst, dtype=np.int32),
+                            np.frombuffer(weights, dtype=np.float32), np.frombuffer(edge_types, dtype=np.int16),
+                            np.array(ids), edge_type_names)
+    if cache_dir:
+        g.save(cache_dir)
+        return CsrGraph.load(cache_dir)
+
+    return g
@@ -8,17 +8,29 @@ import os
 import sys
 from argparse import ArgumentParser
 
+import mode
+
+from anomaly.sessions import event_time
 from arango_util import ArangoDb
+from coalesce import EntityCoalescer
 import settings
 from streaming_app import app, parsed_logs_topic
 
 
 class GraphLoader(object):
 
-    def __init__(self):
+    def __init__(self, coalesce=True, window_secs=5.0, max_entities=10000):
+        """
+
+        :param coalesce: (bool) aggregate entity occurrences and write one merged vertex
+               update per entity per window, instead of one write per occurrence
+        :param window_secs: (float) maximum age of a coalescing window
+        :param max_entities: (int) maximum number of pending entities before a flush
+        """
         arango = ArangoDb(test=True)
         dbname = os.getenv('TEST_ARANGODB_NAME') or 'cslogs'
         arango.create_database(dbname)
+        self.coalescer = EntityCoalescer(arango.db, window_secs, max_entities) if coalesce else None
         # logs = db.create_collection('logs')
         # logs.add_hash_index(fields=['log_id'], unique=True)
         graph = arango.create_graph('logs')
@@ -94,6 +106,7 @@ class GraphLoader(object):
             source_id = log['id']
             metadata = log['metadata']
             metadata['source_id'] = source_id
+            timestamp = event_time(log)
             collkey = hashlib.md5(source_collection.encode('utf-8')).hexdigest()[0:8]
             if not self.collections.has(collkey):
                 self.collections.insert({
@@ -131,35 +144,48 @@ class GraphLoader(object):
             last_user = None
             for param in log['params']:
                 if param['entity'] == 'ip_address':
-                    upsert_param(param, log_id, 'logs', self.ip_addrs, self.has_ip_addr)
+                    upsert_param(param, log_id, 'logs', self.ip_addrs, self.has_ip_addr,
+                                 self.coalescer, timestamp)
                 elif param['entity'] == 'file':
-                    upsert_param(param, log_id, 'logs', self.filenames, self.has_filename)
+                    upsert_param(param, log_id, 'logs', self.filenames, self.has_filename,
+                                 self.coalescer, timestamp)
                 elif param['entity'] == 'uri':
-                    upsert_param(param, log_id, 'logs', self.uris, self.has_uri)
+                    upsert_param(param, log_id, 'logs', self.uris, self.has_uri,
+                                 self.coalescer, timestamp)
                 elif param['entity'] == 'url':
-                    upsert_param(param, log_id, 'logs', self.urls, self.has_url)
+                    upsert_param(param, log_id, 'logs', self.urls, self.has_url,
+                                 self.coalescer, timestamp)
                 elif param['entity'] == 'email':
-                    upsert_param(param, log_id, 'logs', self.emails, self.has_email)
+                    upsert_param(param, log_id, 'logs', self.emails, self.has_email,
+                                 self.coalescer, timestamp)
                 elif param['entity'] == 'device':
-                    upsert_param(param, log_id, 'logs', self.devices, self.has_device)
+                    upsert_param(param, log_id, 'logs', self.devices, self.has_device,
+                                 self.coalescer, timestamp)
                 elif param['entity'] == 'process':
-                    upsert_param(param, log_id, 'logs', self.procs, self.has_proc)
+                    upsert_param(param, log_id, 'logs', self.procs, self.has_proc,
+                                 self.coalescer, timestamp)
                 elif param['entity'] == 'memory_address':
-                    upsert_param(param, log_id, 'logs', self.mem_addrs, self.has_mem_addr)
+                    upsert_param(param, log_id, 'logs', self.mem_addrs, self.has_mem_addr,
+                                 self.coalescer, timestamp)
                 elif param['entity'] == 'uuid':
-                    upsert_param(param, log_id, 'logs', self.uuids, self.has_uuid)
+                    upsert_param(param, log_id, 'logs', self.uuids, self.has_uuid,
+                                 self.coalescer, timestamp)
                 elif param['entity'] == 'user':
-                    upsert_param(param, log_id, 'logs', self.users, self.has_user)
+                    upsert_param(param, log_id, 'logs', self.users, self.has_user,
+                                 self.coalescer, timestamp)
                     last_user = hashlib.md5(param['value'].encode('utf-8')).hexdigest()[0:8]
                 elif param['entity'] == 'password':
                     if last_user is not None:
                         upsert(self.users, {'_key': last_user, 'password': param['value']})
                 elif param['entity'] == 'PERSON':
-                    upsert_param(param, log_id, 'logs', self.people, self.has_person)
+                    upsert_param(param, log_id, 'logs', self.people, self.has_person,
+                                 self.coalescer, timestamp)
                 elif param['entity'] == 'ORG':
-                    upsert_param(param, log_id, 'logs', self.organizations, self.has_organization)
+                    upsert_param(param, log_id, 'logs', self.organizations, self.has_organization,
+                                 self.coalescer, timestamp)
                 elif param['entity'] in ['GPE', 'LOC']:
-                    upsert_param(param, log_id, 'logs', self.locations, self.has_location)
+                    upsert_param(param, log_id, 'logs', self.locations, self.has_location,
+                                 self.coalescer, timestamp)
 
             return log
 
@@ -171,22 +197,34 @@ class GraphLoader(object):
             log = self.load(jsonstr)
             print(log)
 
+        self.flush()
+
+    def flush(self):
+        if self.coalescer is not None:
+            self.coalescer.flush()
 
-def upsert_param(param, root_id, root_name, vertex_coll, edge_coll):
+
+def upsert_param(param, root_id, root_name, vertex_coll, edge_coll, coalescer=None, timestamp=None):
     entity = param['value']
     entity_hash = hashlib.md5(entity.encode('utf-8')).hexdigest()[0:8]
-    upsert(vertex_coll, {
-        '_key': entity_hash,
-        'name': entity,
-        'span': [param['char_start'], param['char_end']],
-        'token': param['token_start']
-    })
-    upsert(edge_coll, {
+    edge = {
         '_key': '{}-{}'.format(root_id, entity_hash),
         'name': '{}-{}'.format(root_id, entity),
         '_from': '{}/{}'.format(root_name, root_id),
         '_to': '{}/{}'.format(vertex_coll.name, entity_hash)
-    })
+    }
+    if coalescer is None:
+        upsert(vertex_coll, {
+            '_key': entity_hash,
+            'name': entity,
+            'span': [param['char_start'], param['char_end']],
+            'token': param['token_start']
+        })
+        upsert(edge_coll, edge)
+    else:
+        # vertex and edge writes are deferred to the end of the window, the edge after its vertex
+        coalescer.add(vertex_coll.name, entity_hash, entity, root_id, timestamp,
+                      edge_collection_name=edge_coll.name, edge=edge)
 
 
 def create_or_fetch_edge_collection(graph, collection_name, **kwargs):
@@ -224,6 +262,21 @@ async def load(parsed_logs):
         loader.load(jsonstr)
 
 
+@app.timer(interval=1.0)
+async def flush_entities():
+    # close windows on quiet streams, where no further `add` would trigger the flush
+    if loader.coalescer is not None and loader.coalescer.should_flush():
+        loader.coalescer.flush()
+
+
+@app.service
+class EntityFlusher(mode.Service):
+
+    async def on_stop(self):
+        # write the last window when the worker stops
+        loader.flush()
+
+
 def run(constants):
     if constants['is_stream']:
         loader.process_stdin()
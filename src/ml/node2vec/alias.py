@@ -0,0 +1,255 @@
+"""
+Alias tables (Vose's method) for O(1) sampling of Node2vec transitions over a `CsrGraph`.
+
+First-order tables are aligned with the CSR arrays: the table for node `c` occupies
+`offsets[c]:offsets[c + 1]`. Second-order tables are keyed by directed edge: the table for
+the step `s -> c`, stored at CSR position `e`, occupies
+`second_offsets[e]:second_offsets[e] + degree(c)` and indexes into the neighbours of `c`.
+"""
+
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+
+def alias_setup(probs):
+    """
+    Build an alias table for a discrete distribution
+
+    :param probs: (ndarray) unnormalized, non-negative weights
+    :return: (ndarray, ndarray) alias indices and acceptance probabilities
+    """
+    n = len(probs)
+    scaled = (np.asarray(probs, dtype=np.float64) * n / np.sum(probs)).tolist()
+    alias = [0] * n
+    accept = [1.] * n
+    small = [i for i, x in enumerate(scaled) if x < 1.]
+    large = [i for i, x in enumerate(scaled) if x >= 1.]
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        accept[s] = scaled[s]
+        alias[s] = l
+        scaled[l] += scaled[s] - 1.
+        if scaled[l] < 1.:
+            small.append(l)
+        else:
+            large.append(l)
+
+    # leftovers are 1 up to rounding error
+    for i in small + large:
+        accept[i] = 1.
+        alias[i] = i
+
+    return np.array(alias, dtype=np.int32), np.array(accept, dtype=np.float32)
+
+
+def alias_draw(alias, accept, base, n, u):
+    """
+    Vectorized draw from many alias tables at once, using one uniform number per draw
+
+    :param alias: (ndarray) flattened alias indices
+    :param accept: (ndarray) flattened acceptance probabilities
+    :param base: (ndarray) start of each table in the flattened arrays
+    :param n: (ndarray) size of each table
+    :param u: (ndarray) uniform random numbers in [0, 1)
+    :return: (ndarray) sampled positions within each table
+    """
+    scaled = u * n
+    k = np.minimum(scaled.astype(np.int64), n - 1)
+    take = base + k
+    return np.where(scaled - k < accept[take], k, alias[take])
+
+
+class AliasTables(object):
+
+    ARRAY_NAMES = ('first_alias', 'first_accept', 'second_offsets', 'second_alias', 'second_accept')
+
+    def __init__(self, first_alias, first_accept, second_offsets, second_alias, second_accept):
+        self.first_alias = first_alias
+        self.first_accept = first_accept
+        self.second_offsets = second_offsets
+        self.second_alias = second_alias
+        self.second_accept = second_accept
+
+    @classmethod
+    def build(cls, graph, p=1, q=1, node_p=None, node_q=None, second_order=True, quiet=False):
+        """
+        Precompute first-travel and, optionally, second-order alias tables
+
+        :param graph: (CsrGraph) input graph
+        :param p: (float) return hyperparameter
+        :param q: (float) input hyperparameter
+        :param node_p: (ndarray) optional per-node `p` of the current node, overrides `p`
+        :param node_q: (ndarray) optional per-node `q` of the current node, overrides `q`
+        :param second_order: (bool) build second-order tables, which cost O(sum of squared
+               degrees); without them only `rejection_walks` can be used
+        :param quiet: (bool) verbosity of logging
+        :return: (AliasTables)
+        """
+        offsets = graph.offsets
+        neighbours = graph.neighbours
+        weights = graph.weights
+        n_edges = graph.n_edges
+        degrees = graph.degrees()
+
+        first_alias = np.zeros(n_edges, dtype=np.int32)
+        first_accept = np.ones(n_edges, dtype=np.float32)
+        second_offsets = np.zeros(n_edges + 1, dtype=np.int64)
+        if second_order:
+            np.cumsum(degrees[neighbours], out=second_offsets[1:])
+
+        second_alias = np.zeros(second_offsets[-1], dtype=np.int32)
+        second_accept = np.ones(second_offsets[-1], dtype=np.float32)
+
+        # rows with equal weights are uniform: accept every draw, and only the other rows need
+        # Vose's method, so first-order tables of unweighted graphs are built without a Python loop
+        nodes = np.flatnonzero(degrees > 0)
+        if not second_order:
+            starts = offsets[nodes]
+            uniform = np.minimum.reduceat(weights, starts) == np.maximum.reduceat(weights, starts) \
+                if n_edges else np.ones(0, dtype=bool)
+            nodes = nodes[~uniform]
+
+        first_alias[:] = np.arange(n_edges) - np.repeat(offsets[:-1], degrees)
+        if not quiet:
+            nodes = tqdm(nodes, desc='Computing alias tables')
+
+        for source in nodes:
+            start, end = offsets[source], offsets[source + 1]
+            first_alias[start:end], first_accept[start:end] = alias_setup(weights[start:end])
+            if not second_order:
+                continue
+
+            source_neighbours = neighbours[start:end]
+            for e in range(start, end):
+                current = neighbours[e]
+                c_start, c_end = offsets[current], offsets[current + 1]
+                dests = neighbours[c_start:c_end]
+                cur_p = p if node_p is None else node_p[current]
+                cur_q = q if node_q is None else node_q[current]
+                alpha = np.where(np.isin(dests, source_neighbours), 1., 1. / cur_q)
+                alpha[dests == source] = 1. / cur_p
+                t_start, t_end = second_offsets[e], second_offsets[e + 1]
+                second_alias[t_start:t_end], second_accept[t_start:t_end] = \
+                    alias_setup(weights[c_start:c_end] * alpha)
+
+        return cls(first_alias, first_accept, second_offsets, second_alias, second_accept)
+
+    def save(self, dirname):
+        path = Path(dirname)
+        path.mkdir(parents=True, exist_ok=True)
+        for name in self.ARRAY_NAMES:
+            np.save(str(path / (name + '.npy')), getattr(self, name))
+
+    @classmethod
+    def load(cls, dirname, mmap_mode='r'):
+        path = Path(dirname)
+        return cls(*[np.load(str(path / (name + '.npy')), mmap_mode=mmap_mode) for name in cls.ARRAY_NAMES])
+
+
+def _first_travel(graph, tables, sources, u):
+    """ First step of a batch of walks, skipping dead-end nodes """
+    offsets = graph.offsets
+    cur = np.asarray(sources, dtype=np.int64)
+    deg = offsets[cur + 1] - offsets[cur]
+    active = np.flatnonzero(deg > 0)
+    cur, deg = cur[active], deg[active]
+    base = offsets[cur]
+    edge = base + alias_draw(tables.first_alias, tables.first_accept, base, deg, u[active])
+    return active, graph.neighbours[edge].astype(np.int64), edge
+
+
+def alias_walks(graph, tables, sources, walk_length, random_state):
+    """
+    Generate one walk per source, advancing all walks of the batch together. Random numbers
+    are drawn in a single block for the whole batch.
+
+    :param graph: (CsrGraph) input graph
+    :param tables: (AliasTables) precomputed alias tables for `graph`
+    :param sources: (ndarray) start node indices
+    :param walk_length: (int) number of nodes in each walk
+    :param random_state: (np.random.RandomState) random number generator
+    :return: (ndarray) int32 matrix of shape [n_sources, walk_length]; walks that hit a
+             dead end are padded with -1
+    """
+    offsets = graph.offsets
+    neighbours = graph.neighbours
+    n = len(sources)
+    walks = np.full((n, walk_length), -1, dtype=np.int32)
+    walks[:, 0] = sources
+    if walk_length < 2 or n == 0:
+        return walks
+
+    rand = random_state.random_sample((walk_length - 1, n))
+    active, cur, edge = _first_travel(graph, tables, sources, rand[0])
+    walks[active, 1] = cur
+
+    # the graph is symmetric, so every node reached has at least one neighbour
+    for t in range(2, walk_length):
+        deg = offsets[cur + 1] - offsets[cur]
+        k = alias_draw(tables.second_alias, tables.second_accept, tables.second_offsets[edge], deg,
+                       rand[t - 1, active])
+        edge = offsets[cur] + k
+        cur = neighbours[edge].astype(np.int64)
+        walks[active, t] = cur
+
+    return walks
+
+
+def rejection_walks(graph, tables, sources, walk_length, random_state, p=1, q=1, node_p=None, node_q=None):
+    """
+    Generate one walk per source without second-order tables. Each step proposes a neighbour
+    from the first-order (edge weight) alias table of the current node and accepts it with
+    probability `alpha / max(alpha)`, where `alpha` is `1 / p` for returning to the previous
+    node, 1 for a neighbour of the previous node and `1 / q` otherwise. Accepted samples follow
+    the exact Node2vec transition distribution.
+
+    :param graph: (CsrGraph) input graph
+    :param tables: (AliasTables) first-order alias tables for `graph`
+    :param sources: (ndarray) start node indices
+    :param walk_length: (int) number of nodes in each walk
+    :param random_state: (np.random.RandomState) random number generator
+    :param p: (float) return hyperparameter
+    :param q: (float) input hyperparameter
+    :param node_p: (ndarray) optional per-node `p` of the current node, overrides `p`
+    :param node_q: (ndarray) optional per-node `q` of the current node, overrides `q`
+    :return: (ndarray) int32 matrix of shape [n_sources, walk_length]; walks that hit a
+             dead end are padded with -1
+    """
+    offsets = graph.offsets
+    neighbours = graph.neighbours
+    n = len(sources)
+    walks = np.full((n, walk_length), -1, dtype=np.int32)
+    walks[:, 0] = sources
+    if walk_length < 2 or n == 0:
+        return walks
+
+    active, cur, _ = _first_travel(graph, tables, sources, random_state.random_sample(n))
+    prev = np.asarray(sources, dtype=np.int64)[active]
+    walks[active, 1] = cur
+    for t in range(2, walk_length):
+        base = offsets[cur]
+        deg = offsets[cur + 1] - base
+        inv_p = 1. / (np.full(len(cur), p, dtype=np.float64) if node_p is None else node_p[cur])
+        inv_q = 1. / (np.full(len(cur), q, dtype=np.float64) if node_q is None else node_q[cur])
+        alpha_max = np.maximum(np.maximum(inv_p, 1.), inv_q)
+        nxt = np.empty_like(cur)
+        pending = np.arange(len(cur))
+        while len(pending):
+            u = random_state.random_sample((2, len(pending)))
+            b = base[pending]
+            x = neighbours[b + alias_draw(tables.first_alias, tables.first_accept, b, deg[pending], u[0])]
+            x = x.astype(np.int64)
+            s = prev[pending]
+            alpha = np.where(graph.has_edges(s, x), 1., inv_q[pending])
+            alpha = np.where(x == s, inv_p[pending], alpha)
+            accepted = u[1] * alpha_max[pending] < alpha
+            nxt[pending[accepted]] = x[accepted]
+            pending = pending[~accepted]
+
+        prev, cur = cur, nxt
+        walks[active, t] = cur
+
+    return walks
@@ -0,0 +1,228 @@
+"""
+Approximate nearest-neighbour index over node embeddings, using random-projection LSH
+(signed random hyperplanes, i.e. cosine similarity) with multi-probe lookups and exact
+re-ranking of the candidates. Pure NumPy, and saved as `.npy` files that can be memory-mapped.
+"""
+
+import json
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+META_FILENAME = 'meta.json'
+
+# saved versions kept, so that readers of the previous index can finish before it is removed
+KEEP_VERSIONS = 2
+
+
+class LshIndex(object):
+
+    ARRAY_NAMES = ('vectors', 'ids', 'sorted_ids', 'id_order', 'planes', 'order', 'sorted_codes')
+
+    def __init__(self, n_tables=8, n_bits=12, seed=42):
+        """
+
+        :param n_tables: (int) number of hash tables; more tables give higher recall at the cost of
+               memory and query time
+        :param n_bits: (int) hyperplanes per table (at most 62); more bits give smaller buckets
+        :param seed: (int) random seed for the hyperplanes
+        """
+        if n_bits > 62:
+            raise ValueError('n_bits must be at most 62')
+
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.seed = seed
+        self.vectors = None  # unit-normalized embeddings, shape [n_nodes, dim]
+        self.ids = None
+        self.sorted_ids = None  # ids and their rows in id order, to look up ids by binary
+        self.id_order = None  # search instead of building a dict
+        self.planes = None  # shape [n_tables, dim, n_bits]
+        self.order = None  # node indices sorted by code, per table
+        self.sorted_codes = None  # codes in `order`, per table
+
+    def rows_of(self, ids):
+        """
+        Look up rows by binary search over the ids, which works directly on memory-mapped arrays
+
+        :param ids: (list) node ids
+        :return: (ndarray) row per id, -1 for unknown ids
+        """
+        ids = np.asarray([str(_id) for _id in ids])
+        rows = np.full(len(ids), -1, dtype=np.int64)
+        if len(self.ids) == 0 or len(ids) == 0:
+            return rows
+
+        pos = np.minimum(np.searchsorted(self.sorted_ids, ids), len(self.sorted_ids) - 1)
+        found = self.sorted_ids[pos] == ids
+        rows[found] = self.id_order[pos[found]]
+        return rows
+
+    def build(self, vectors, ids):
+        """
+        Index a set of vectors
+
+        :param vectors: (ndarray) embeddings, shape [n_nodes, dim]
+        :param ids: (list) node id per row
+        :return: (LshIndex) self
+        """
+        self.vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+        self.ids = np.asarray([str(_id) for _id in ids])
+        self.id_order = np.argsort(self.ids, kind='mergesort')
+        self.sorted_ids = self.ids[self.id_order]
+        random_state = np.random.RandomState(self.seed)
+        dim = self.vectors.shape[1]
+        self.planes = random_state.standard_normal((self.n_tables, dim, self.n_bits)).astype(np.float32)
+        self.order = np.empty((self.n_tables, len(self.vectors)), dtype=np.int64)
+        self.sorted_codes = np.empty((self.n_tables, len(self.vectors)), dtype=np.int64)
+        for t in range(self.n_tables):
+            codes = self._codes(self.vectors @ self.planes[t])
+            self.order[t] = np.argsort(codes, kind='mergesort')
+            self.sorted_codes[t] = codes[self.order[t]]
+
+        return self
+
+    @classmethod
+    def from_keyed_vectors(cls, keyed_vectors, **kwargs):
+        """
+        :param keyed_vectors: (gensim.models.KeyedVectors) trained embeddings
+        :return: (LshIndex)
+        """
+        return cls(**kwargs).build(keyed_vectors.vectors, keyed_vectors.index2word)
+
+    def query(self, queries, k=10, n_probes=4, exclude=None):
+        """
+        Batched top-k query
+
+        :param queries: (ndarray) query vectors, shape [n_queries, dim]
+        :param k: (int) number of neighbours per query
+        :param n_probes: (int) buckets probed per table: the query's own bucket plus those reached
+               by flipping its least certain bits. The recall/latency knob; more probes find more
+               candidates to re-rank
+        :param exclude: (list) optional row to leave out of each query's results, e.g. the query node
+        :return: (ndarray, ndarray) neighbour rows and cosine similarities, shape [n_queries, k],
+                 padded with -1 and NaN when fewer than `k` candidates are found
+        """
+        queries = _normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        n_queries = len(queries)
+        n_probes = max(1, min(n_probes, self.n_bits + 1))
+        candidates = [[] for _ in range(n_queries)]
+        for t in range(self.n_tables):
+            proj = queries @ self.planes[t]
+            codes = self._codes(proj)
+            flips = np.argsort(np.abs(proj), axis=1)[:, :n_probes - 1]
+            probes = np.concatenate([codes[:, np.newaxis], codes[:, np.newaxis] ^ (1 << flips)], axis=1)
+            lo = np.searchsorted(self.sorted_codes[t], probes, side='left')
+            hi = np.searchsorted(self.sorted_codes[t], probes, side='right')
+            for i in range(n_queries):
+                for a, b in zip(lo[i], hi[i]):
+                    if a < b:
+                        candidates[i].append(self.order[t][a:b])
+
+        rows = np.full((n_queries, k), -1, dtype=np.int64)
+        scores = np.full((n_queries, k), np.nan, dtype=np.float32)
+        for i in range(n_queries):
+            if not candidates[i]:
+                continue
+
+            cand = np.unique(np.concatenate(candidates[i]))
+            if exclude is not None:
+                cand = cand[cand != exclude[i]]
+
+            sims = self.vectors[cand] @ queries[i]
+            top = np.argpartition(-sims, k - 1)[:k] if len(cand) > k else np.arange(len(cand))
+            top = top[np.argsort(-sims[top])]
+            rows[i, :len(top)] = cand[top]
+            scores[i, :len(top)] = sims[top]
+
+        return rows, scores
+
+    def most_similar(self, ids, k=10, n_probes=4):
+        """
+        Batched neighbours of indexed nodes, like `KeyedVectors.most_similar` for many nodes at once
+
+        :param ids: (list) node ids
+        :param k: (int) number of neighbours per node
+        :param n_probes: (int) buckets probed per table (see `query`)
+        :return: (list) of lists of (node id, similarity), one per node; None for unknown nodes
+        """
+        query_rows = self.rows_of(ids)
+        known = np.flatnonzero(query_rows >= 0)
+        results = [None] * len(query_rows)
+        if len(known) == 0:
+            return results
+
+        rows, scores = self.query(self.vectors[query_rows[known]], k, n_probes, exclude=query_rows[known])
+        for i, row, score in zip(known, rows, scores):
+            results[i] = [(str(self.ids[r]), float(s)) for r, s in zip(row, score) if r >= 0]
+
+        return results
+
+    def _codes(self, proj):
+        """ Pack the signs of the projections into one integer code per row """
+        return (proj > 0).astype(np.int64) @ (1 << np.arange(self.n_bits, dtype=np.int64))
+
+    def save(self, dirname):
+        """
+        Write the arrays to a new version folder, then switch the meta file to it. Arrays that
+        readers have memory-mapped are never overwritten in place.
+
+        :param dirname: (str) index folder
+        """
+        path = Path(dirname)
+        path.mkdir(parents=True, exist_ok=True)
+        version_path = path / 'v-{:019d}'.format(time.time_ns())
+        version_path.mkdir()
+        for name in self.ARRAY_NAMES:
+            np.save(str(version_path / (name + '.npy')), getattr(self, name))
+
+        # switched last, so that a partially written index is never loaded
+        meta = {'n_tables': self.n_tables, 'n_bits': self.n_bits, 'seed': self.seed, 'version': version_path.name}
+        with tempfile.NamedTemporaryFile('w', dir=str(path), prefix=META_FILENAME + '.', delete=False) as f:
+            json.dump(meta, f)
+
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, str(path / META_FILENAME))
+        _remove_old_versions(path, version_path.name)
+
+    @classmethod
+    def load(cls, dirname, mmap_mode='r'):
+        path = Path(dirname)
+        with (path / META_FILENAME).open('r') as f:
+            meta = json.load(f)
+
+        # indexes saved before versioning keep their arrays next to the meta file
+        version = meta.pop('version', None)
+        if version is not None:
+            path = path / version
+
+        index = cls(**meta)
+        for name in cls.ARRAY_NAMES:
+            setattr(index, name, np.load(str(path / (name + '.npy')), mmap_mode=mmap_mode))
+
+        return index
+
+    @staticmethod
+    def exists(dirname):
+        return (Path(dirname) / META_FILENAME).exists()
+
+
+def _remove_old_versions(path, current):
+    """ Remove all but the newest `KEEP_VERSIONS` versions, and the arrays of an unversioned index """
+    versions = sorted((p.name for p in path.iterdir() if p.is_dir() and p.name.startswith('v-')), reverse=True)
+    for name in [name for name in versions if name != current][KEEP_VERSIONS - 1:]:
+        shutil.rmtree(str(path / name), ignore_errors=True)
+
+    for name in LshIndex.ARRAY_NAMES:
+        if (path / (name + '.npy')).exists():
+            (path / (name + '.npy')).unlink()
+
+
+def _normalize(x):
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return x / norms
@@ -1,64 +1,134 @@
+from argparse import ArgumentParser
 from pathlib import Path
 
-import networkx as nx
+from gensim.models import Word2Vec
+import numpy as np
 
 import settings
 from arango_util import ArangoDb
+from graph_export import export_graph
+from ml.node2vec.ann import LshIndex
 from ml.node2vec.node2vec import Node2vec
+from ml.node2vec.watermark import Watermark
 
 ROOT = Path(__file__).parent.parent.parent.parent
+GRAPH_CACHE_DIR = ROOT / 'models' / 'graph'
+MODEL_FILENAME = ROOT / 'models' / 'node2vec.model'
+WATERMARK_DIR = ROOT / 'models' / 'node2vec-watermark'
+INDEX_DIR = ROOT / 'models' / 'node2vec-index'
 
+# second-order alias table entries (sum of squared degrees) above which full runs sample by rejection
+MAX_ALIAS_ENTRIES = 10000000
 
-class ClusterSearch(object):
-
-    def __init__(self):
-        g = build_local_graph()
-
-        self.node2vec = Node2vec(g, embed_dim=64, walk_length=30, n_walks=200, workers=4)
 
-        # Note: if the graph is too big to fit in memory, pass `temp_folder`, which will
-        # initiate `sharedmem` in `Parallel`. This will be slower on smaller graphs. E.g.
-        # node2vec = Node2vec(g, embed_dim=64, walk_length=30, n_walks=200, workers=4, temp_folder='/tmp/sharedmem')
+class ClusterSearch(object):
 
+    def __init__(self, incremental=False, model_filename=None, watermark_dir=None,
+                 max_alias_entries=MAX_ALIAS_ENTRIES):
+        """
+
+        :param incremental: (bool) continue training the saved model, walking only from nodes added
+               or changed since the last saved run; trains from scratch if there is no saved run
+        :param model_filename: (str) saved model to continue training (default: `models/node2vec.model`)
+        :param watermark_dir: (str) snapshot of the graph last trained on (default: `models/node2vec-watermark`)
+        :param max_alias_entries: (int) a full run precomputes second-order alias tables ('alias'
+               sampling) only while they have at most this many entries, i.e. the sum of squared
+               degrees; larger graphs, whose hubs make those tables grow quadratically, and incremental
+               runs sample by rejection against first-order tables in O(edges) memory
+        """
+        self.watermark_dir = watermark_dir or str(WATERMARK_DIR)
+        model_filename = model_filename or str(MODEL_FILENAME)
+
+        self.graph = build_csr_graph()
         self.model = None
+        self.index = None
+        sources = None
+        if incremental and Watermark.exists(self.watermark_dir) and Path(model_filename).exists():
+            self.model = Word2Vec.load(model_filename)
+            sources = self.graph.ids[Watermark.load(self.watermark_dir).changed_nodes(self.graph)]
+
+        # second-order alias tables are built for the whole graph, so an incremental run samples
+        # by rejection against first-order tables, keeping its cost close to that of the new walks
+        degrees = self.graph.degrees().astype(np.int64)
+        if sources is None and int(np.dot(degrees, degrees)) <= max_alias_entries:
+            sampling = 'alias'
+        else:
+            sampling = 'rejection'
+
+        self.node2vec = Node2vec(self.graph, embed_dim=64, walk_length=30, n_walks=200, workers=4,
+                                 sampling=sampling, sources=sources)
+
+        # Note: in 'alias' and 'rejection' modes the workers memory-map the CSR graph, alias tables and walk
+        # matrix from a work folder under `temp_folder` (default: the system temp folder). Pass
+        # `temp_folder` or `work_dir` to put them on a volume with enough space. E.g.
+        # node2vec = Node2vec(g, embed_dim=64, walk_length=30, n_walks=200, workers=4, sampling='alias',
+        #                     temp_folder='/tmp/sharedmem')
 
     def fit(self):
-        # Any keyword argument accepted by gensim.Word2Vec can be passed
-        # `dimensions` and `workers` are automatically passed from the Node2vec constructor
-        self.model = self.node2vec.fit(window=10, min_count=1, batch_words=4)
-
-    def most_similar_nodes(self):
-        # Look for most similar nodes
-        return self.model.wv.most_similar('2')
+        # `fit` and `update` remove the walk work folder, however training ends
+        with self.node2vec:
+            if self.model is not None:
+                self.model = self.node2vec.update(self.model)
+            else:
+                # Any keyword argument accepted by gensim.Word2Vec can be passed
+                # `dimensions` and `workers` are automatically passed from the Node2vec constructor
+                self.model = self.node2vec.fit(window=10, min_count=1, batch_words=4)
+
+        self.build_index()
+
+    def build_index(self, n_tables=8, n_bits=12):
+        # Approximate nearest-neighbour index, instead of a brute-force scan per query
+        self.index = LshIndex.from_keyed_vectors(self.model.wv, n_tables=n_tables, n_bits=n_bits)
+
+    def most_similar_nodes(self, nodes=('2',), topn=10, n_probes=4):
+        """
+        Look for most similar nodes, for a batch of nodes at once
+
+        :param nodes: (list) node ids
+        :param topn: (int) number of neighbours per node
+        :param n_probes: (int) recall/latency trade-off of the index (see `LshIndex.query`)
+        :return: (list) of lists of (node id, similarity), one per node
+        """
+        if self.index is None:
+            return [self.model.wv.most_similar(node, topn=topn) for node in nodes]
+
+        return self.index.most_similar(nodes, k=topn, n_probes=n_probes)
 
     def save_embeddings(self, embeddings_filename):
         # Save embeddings for later use
         self.model.wv.save_word2vec_format(embeddings_filename)
 
+    def save_index(self, index_dirname):
+        # Save the nearest-neighbour index next to the embeddings
+        self.index.save(index_dirname)
+
     def save(self, model_filename):
         # Save model for later use
         self.model.save(model_filename)
 
+        # Mark the graph as trained only once the model is saved
+        Watermark.from_graph(self.graph).save(self.watermark_dir)
+
 
 # TODO use Foxx to run in Arango
 # Can I use external functions in Foxx, or would I need to implement Node2vec in Foxx?
 # Currently, exporting data from ArangoDB into a local representation using NetworkX
-def build_local_graph():
-    g = nx.Graph()
-    arango = ArangoDb()
-    db = arango.db
-    logs = db.graph('logs')
-    edge_names = [x['edge_collection'] for x in logs.edge_definitions()]
-    for name in logs.vertex_collections():
-        coll = db.collection(name)
-        for node in coll.all():
-            g.add_node(node['_id'], line=node['line'])
-            for edge_name in edge_names:
-                edges = logs.edges(edge_name, node['_id'], direction='out')['edges']
-                for edge in edges:
-                    g.add_edge(edge['_from'], edge['_to'], id=edge['_id'])
+def build_local_graph(cache_dir=None, refresh=True):
+    return build_csr_graph(cache_dir, refresh).to_networkx()
+
 
-    return g
+def build_csr_graph(cache_dir=None, refresh=True):
+    """
+    Export the logs graph to CSR arrays, streaming each edge collection once. The export is
+    saved to `cache_dir`, where the API services load it from.
+
+    :param cache_dir: (str) directory of the memory-mapped `.npy` cache (default: `models/graph`)
+    :param refresh: (bool) re-export from ArangoDB; pass False to reuse an existing cache, which
+           is never invalidated and so does not see data loaded since it was written
+    :return: (CsrGraph)
+    """
+    arango = ArangoDb()
+    return export_graph(arango.db, 'logs', cache_dir=cache_dir or str(GRAPH_CACHE_DIR), refresh=refresh)
 
 
 def print_most_similar(nodes):
@@ -68,13 +138,21 @@ def print_most_similar(nodes):
 
 
 if __name__ == '__main__':
-    model = ClusterSearch()
+    # read args
+    parser = ArgumentParser(description='Train node embeddings')
+    parser.add_argument('--incremental', dest='incremental', help='update the saved model with new nodes',
+                        action='store_true')
+    parser.set_defaults(incremental=False)
+    args = parser.parse_args()
+
+    model = ClusterSearch(incremental=args.incremental)
     model.fit()
 
-    most_similar = model.most_similar_nodes()
-    print_most_similar(most_similar)
+    for most_similar in model.most_similar_nodes():
+        print_most_similar(most_similar)
 
     _embeddings_filename = str(ROOT / 'models' / 'node2vec.embed')
-    _model_filename = str(ROOT / 'models' / 'node2vec.model')
+    _model_filename = str(MODEL_FILENAME)
     model.save_embeddings(_embeddings_filename)
+    model.save_index(str(INDEX_DIR))
     model.save(_model_filename)
@@ -0,0 +1,100 @@
+import time
+from threading import Event
+
+import numpy as np
+
+
+class WalkCorpus(object):
+    """
+    Restartable iterable over a walk matrix (e.g. memory-mapped from disk), yielding each walk
+    as a list of node id tokens. Rows are converted a chunk at a time, so the token lists
+    never exist all at once.
+    """
+
+    def __init__(self, walks, ids, chunk_size=10000):
+        """
+
+        :param walks: (ndarray) int matrix of node indices, padded with -1
+        :param ids: (ndarray) node id per node index
+        :param chunk_size: (int) number of rows converted at a time
+        """
+        self.walks = walks
+        self.ids = ids
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return len(self.walks)
+
+    def __iter__(self):
+        for start in range(0, len(self.walks), self.chunk_size):
+            yield from self._tokens(self.walks[start:start + self.chunk_size])
+
+    def _tokens(self, rows):
+        for walk in np.asarray(rows):
+            yield [str(x) for x in self.ids[walk[walk >= 0]]]
+
+    def save_text(self, path):
+        """
+        Write the walks in gensim's `LineSentence` format, one space-separated walk per line,
+        for training with `corpus_file`
+
+        :param path: (str) output file
+        """
+        with open(path, 'w') as f:
+            for walk in self:
+                f.write(' '.join(walk) + '\n')
+
+
+class StreamingWalkCorpus(WalkCorpus):
+    """
+    Walk corpus that can be iterated while walk workers are still writing the walk matrix.
+    The first pass follows the per-worker progress counters and yields rows as soon as they
+    are written; once the workers are done, later passes read the complete matrix.
+    """
+
+    def __init__(self, walks_path, ids, progress_path, worker_rows, chunk_size=10000, poll_interval=0.05):
+        """
+
+        :param walks_path: (str) `.npy` walk matrix being written by the workers
+        :param ids: (ndarray) node id per node index
+        :param progress_path: (str) `.npy` array of rows written so far by each worker
+        :param worker_rows: (list) (start, end) rows owned by each worker
+        :param chunk_size: (int) maximum number of rows converted at a time
+        :param poll_interval: (float) seconds to wait when no new rows are available
+        """
+        super().__init__(np.load(walks_path, mmap_mode='r'), ids, chunk_size)
+        self.progress = np.load(progress_path, mmap_mode='r')
+        self.worker_rows = worker_rows
+        self.poll_interval = poll_interval
+        self.done = Event()
+        self.error = None
+
+    def __iter__(self):
+        if self.done.is_set():
+            self._raise_error()
+            yield from super().__iter__()
+            return
+
+        consumed = [0] * len(self.worker_rows)
+        while True:
+            # read `done` before the counters, so that a finished run is seen with its final counts
+            finished = self.done.is_set()
+            self._raise_error()
+            progress = np.array(self.progress)
+            new_rows = False
+            for w, (start, _) in enumerate(self.worker_rows):
+                while consumed[w] < progress[w]:
+                    end = min(progress[w], consumed[w] + self.chunk_size)
+                    yield from self._tokens(self.walks[start + consumed[w]:start + end])
+                    consumed[w] = end
+                    new_rows = True
+
+            if finished:
+                return
+
+            if not new_rows:
+                time.sleep(self.poll_interval)
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
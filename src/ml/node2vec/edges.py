@@ -1,6 +1,5 @@
 from abc import ABC, abstractmethod
-from functools import reduce
-from itertools import combinations_with_replacement
+from itertools import combinations_with_replacement, islice
 
 from gensim.models import KeyedVectors
 import numpy as np
@@ -27,6 +26,16 @@ class EdgeEmbedder(ABC):
         """
         pass
 
+    @abstractmethod
+    def _embed_batch(self, u, v):
+        """
+        Abstract vectorized embedding method
+        :param u: (np.ndarray) embeddings of the first nodes, shape [n_edges, dim]
+        :param v: (np.ndarray) embeddings of the second nodes, shape [n_edges, dim]
+        :return: (np.ndarray) Edge embeddings, shape [n_edges, dim]
+        """
+        pass
+
     def __getitem__(self, item):
         if not isinstance(item, tuple) or not len(item) == 2:
             raise ValueError('Edge must be a tuple of two nodes')
@@ -39,33 +48,84 @@ class EdgeEmbedder(ABC):
 
         return self._embed(item)
 
-    def as_keyed_vectors(self):
+    def as_keyed_vectors(self, edges=None, chunk_size=100000):
         """
-        Generate a KeyedVectors instance with all nodes
+        Generate a KeyedVectors instance with the given edges, or with all pairs of nodes
+        :param edges: (list) of (node, node) pairs, e.g. from `graph_edges`; all pairs of nodes
+               (O(V^2)) if not given
+        :param chunk_size: (int) number of edges embedded at a time
         :return:
         """
-        generator = combinations_with_replacement(self.keyed_vectors.index2word, r=2)
-        if not self.quiet:
+        if edges is None:
             vocab_size = len(self.keyed_vectors.vocab)
-            total_size = (reduce(lambda x, y: x * y, range(1, vocab_size + 2)) /
-                          (2 * reduce(lambda x, y: x * y, range(1, vocab_size))))
-            generator = tqdm(generator, desc='Generating edge features', total=total_size)
+            n_edges = vocab_size * (vocab_size + 1) // 2
+            edges = combinations_with_replacement(self.keyed_vectors.index2word, r=2)
+        else:
+            n_edges = len(edges)
+
+        edges = iter(edges)
+        chunks = range(0, n_edges, chunk_size)
+        if not self.quiet:
+            chunks = tqdm(chunks, desc='Generating edge features')
 
-        # Generate features
+        # embedded into one array and added at once, as `KeyedVectors.add` copies all its vectors
         tokens = []
-        features = []
-        for edge in generator:
-            token = str(tuple(sorted(edge)))
-            embedding = self._embed(edge)
-            tokens.append(token)
-            features.append(embedding)
-
-        # Build KeyedVectors instance
-        edge_kv = KeyedVectors(vector_size=self.keyed_vectors.vector_size)
-        edge_kv.add(entities=tokens, weights=features)
+        weights = np.empty((n_edges, self.keyed_vectors.vector_size), dtype=np.float32)
+        for start in chunks:
+            chunk = list(islice(edges, chunk_size))
+            tokens.extend(str(tuple(sorted(str(node) for node in edge))) for edge in chunk)
+            self.embed_edges(chunk, chunk_size, out=weights[start:start + len(chunk)])
 
+        edge_kv = KeyedVectors(vector_size=self.keyed_vectors.vector_size)
+        edge_kv.add(entities=tokens, weights=weights[:len(tokens)])
         return edge_kv
 
+    def embed_edges(self, edges, chunk_size=100000, out=None):
+        """
+        Vectorized embedding of an explicit edge list, a chunk at a time
+        :param edges: (list) of (node, node) pairs
+        :param chunk_size: (int) number of edges embedded at a time
+        :param out: (np.ndarray or str) output array, or path of a `.npy` file to create as a
+               memory map, shape [n_edges, dim]; allocated in memory if not given
+        :return: (np.ndarray) Edge embeddings, in the order of `edges`
+        """
+        vocab = self.keyed_vectors.vocab
+        rows = np.array([[vocab[u].index, vocab[v].index] for u, v in edges], dtype=np.int64).reshape(-1, 2)
+        shape = (len(rows), self.keyed_vectors.vector_size)
+        if out is None:
+            out = np.empty(shape, dtype=np.float32)
+        elif isinstance(out, str):
+            out = np.lib.format.open_memmap(out, mode='w+', dtype=np.float32, shape=shape)
+
+        vectors = self.keyed_vectors.vectors
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            out[start:start + len(chunk)] = self._embed_batch(vectors[chunk[:, 0]], vectors[chunk[:, 1]])
+
+        return out
+
+
+def graph_edges(graph, n_samples=None, random_state=None):
+    """
+    Node pairs of the actual edges of a graph, each undirected edge once
+    :param graph: (CsrGraph) graph the embeddings were trained on
+    :param n_samples: (int) sample this many edges without replacement; all edges if not given
+    :param random_state: (np.random.RandomState) random number generator for sampling
+    :return: (np.ndarray) node id pairs, shape [n_edges, 2]
+    """
+    rows = np.repeat(np.arange(graph.n_nodes), graph.degrees())
+    upper = rows < graph.neighbours
+    src = rows[upper]
+    dst = np.asarray(graph.neighbours)[upper]
+    if n_samples is not None and n_samples < len(src):
+        random_state = random_state or np.random.RandomState()
+        sample = random_state.choice(len(src), n_samples, replace=False)
+        src = src[sample]
+        dst = dst[sample]
+
+    ids = np.asarray(graph.ids)
+    return np.stack([ids[src], ids[dst]], axis=1)
+
 
 class AverageEmbedder(EdgeEmbedder):
     """ Averaged node features """
@@ -73,6 +133,9 @@ class AverageEmbedder(EdgeEmbedder):
     def _embed(self, edge):
         return (self.keyed_vectors[edge[0]] + self.keyed_vectors[edge[1]]) / 2
 
+    def _embed_batch(self, u, v):
+        return (u + v) / 2
+
 
 class HadamardEmbedder(EdgeEmbedder):
     """ Hadamard product of node features """
@@ -80,6 +143,9 @@ class HadamardEmbedder(EdgeEmbedder):
     def _embed(self, edge):
         return self.keyed_vectors[edge[0]] * self.keyed_vectors[edge[1]]
 
+    def _embed_batch(self, u, v):
+        return u * v
+
 
 class WeightedL1Embedder(EdgeEmbedder):
     """ Weighted L1 node features """
@@ -87,9 +153,15 @@ class WeightedL1Embedder(EdgeEmbedder):
     def _embed(self, edge):
         return np.abs(self.keyed_vectors[edge[0]] - self.keyed_vectors[edge[1]])
 
+    def _embed_batch(self, u, v):
+        return np.abs(u - v)
+
 
 class WeightedL2Embedder(EdgeEmbedder):
     """ Weighted L2 node features """
 
     def _embed(self, edge):
         return (self.keyed_vectors[edge[0]] - self.keyed_vectors[edge[1]]) ** 2
+
+    def _embed_batch(self, u, v):
+        return (u - v) ** 2
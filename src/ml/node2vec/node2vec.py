@@ -1,12 +1,20 @@
 import os
 import random
+import shutil
+import tempfile
 from collections import defaultdict
+from pathlib import Path
+from threading import Thread
 
 import numpy as np
 from gensim.models import Word2Vec
 from joblib import delayed, Parallel
 from tqdm import tqdm
 
+from graph_export import CsrGraph
+from ml.node2vec.alias import alias_walks, AliasTables, rejection_walks
+from ml.node2vec.corpus import StreamingWalkCorpus, WalkCorpus
+
 
 class Node2vec(object):
 
@@ -19,8 +27,13 @@ class Node2vec(object):
     P_KEY = 'p'
     Q_KEY = 'q'
 
+    SAMPLING_CHOICE = 'choice'
+    SAMPLING_ALIAS = 'alias'
+    SAMPLING_REJECTION = 'rejection'
+
     def __init__(self, graph, embed_dim=128, walk_length=90, n_walks=10, p=1, q=1, weight_key='weight',
-                 workers=1, sampling_strategy=None, quiet=False, temp_folder=None):
+                 workers=1, sampling_strategy=None, quiet=False, temp_folder=None, sampling='choice',
+                 batch_size=10000, work_dir=None, generate_walks=True, sources=None):
         """
         Initializes the Node2Vec object, precomputing walking probabilities and generating the walks.
         :param graph: input graph
@@ -37,7 +50,23 @@ class Node2vec(object):
         :param quiet: (bool) verbosity of logging
         :param temp_folder: (str) Path to folder with enough space to hold the memory map of
                `self.d_graph` (for big graphs); to be passed to `joblib.Parallel.temp_folder`
+        :param sampling: (str) 'choice' to draw each step with `np.random.choice` over normalized
+               probabilities, or 'alias' to draw in O(1) from precomputed alias tables over a CSR
+               graph, advancing a batch of walks together, or 'rejection' to precompute first-order
+               tables only and sample second-order steps by rejection, using O(edges) memory
+               instead of O(sum of squared degrees) (default: 'choice')
+        :param batch_size: (int) number of walks advanced together in 'alias' and 'rejection' modes
+        :param work_dir: (str) folder for the memory-mapped graph, alias tables and walk matrix
+               shared with the workers in 'alias' and 'rejection' modes (default: a new temporary
+               folder under `temp_folder`, removed by `close`)
+        :param generate_walks: (bool) generate the walks now; otherwise they are generated by `fit`,
+               which can then overlap walk generation with training
+        :param sources: (list) nodes to start walks from, e.g. the nodes added or changed since the
+               last run, for an incremental `update` (default: all nodes; 'alias' and 'rejection' modes)
         """
+        if sampling not in (self.SAMPLING_CHOICE, self.SAMPLING_ALIAS, self.SAMPLING_REJECTION):
+            raise ValueError('Unknown sampling mode: {}'.format(sampling))
+
         self.graph = graph
         self.embed_dim = embed_dim
         self.walk_length = walk_length
@@ -47,8 +76,15 @@ class Node2vec(object):
         self.weight_key = weight_key
         self.workers = workers
         self.sampling_strategy = sampling_strategy or {}
+        self.sources = sources
         self.quiet = quiet
+        self.sampling = sampling
+        self.batch_size = batch_size
         self.d_graph = defaultdict(dict)
+        self.csr = None
+        self.alias_tables = None
+        self.node_p = None
+        self.node_q = None
         self.temp_folder = None
         self.require = None
         if temp_folder:
@@ -58,8 +94,64 @@ class Node2vec(object):
             self.temp_folder = temp_folder
             self.require = 'sharedmem'
 
-        self._precompute_probabilities()
-        self.walks = self._generate_walks()
+        self.work_dir = work_dir
+        self.own_work_dir = False
+        self.walks_path = None
+        self.progress_path = None
+        self.worker_rows = None
+        self.node_n_walks = None
+        self.node_walk_length = None
+        if sampling in (self.SAMPLING_ALIAS, self.SAMPLING_REJECTION):
+            self._precompute_alias_tables()
+        else:
+            self._precompute_probabilities()
+
+        self.walks = self._generate_walks() if generate_walks else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Release the walk matrix and remove the temporary work folder of 'alias' and 'rejection'
+        modes, with the alias tables, graph copy and walks in it. A `work_dir` passed in is kept.
+        Called by `fit` and `update`; walks are generated again if needed afterwards.
+        """
+        if isinstance(self.walks, np.memmap):
+            self.walks = None
+
+        if self.own_work_dir:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+            self.work_dir = None
+            self.own_work_dir = False
+
+    def _node_strategy(self, key, default, dtype):
+        """ Per-node array of a sampling strategy setting, indexed like `self.csr` """
+        values = np.full(self.csr.n_nodes, default, dtype=dtype)
+        for node, strategy in self.sampling_strategy.items():
+            if key in strategy and str(node) in self.csr.index:
+                values[self.csr.index[str(node)]] = strategy[key]
+
+        return values
+
+    def _precompute_alias_tables(self):
+        """ Precomputes alias tables for first-travel and second-order transitions """
+        if isinstance(self.graph, CsrGraph):
+            self.csr = self.graph
+        else:
+            self.csr = CsrGraph.from_networkx(self.graph, self.weight_key)
+
+        self.node_p = self.node_q = None
+        if self.sampling_strategy:
+            self.node_p = self._node_strategy(self.P_KEY, self.p, np.float64)
+            self.node_q = self._node_strategy(self.Q_KEY, self.q, np.float64)
+
+        second_order = self.sampling == self.SAMPLING_ALIAS
+        self.alias_tables = AliasTables.build(self.csr, self.p, self.q, self.node_p, self.node_q,
+                                              second_order, self.quiet)
 
     def _precompute_probabilities(self):
         """ Precomputes transition probabilities for each node """
@@ -73,7 +165,7 @@ class Node2vec(object):
             if self.PROBABILITIES_KEY not in d_graph[source]:
                 d_graph[source][self.PROBABILITIES_KEY] = {}
 
-            for current_node in self.graph.neighbours(source):
+            for current_node in self.graph.neighbors(source):
                 # init probabilities dict
                 if self.PROBABILITIES_KEY not in d_graph[current_node]:
                     d_graph[current_node][self.PROBABILITIES_KEY] = {}
@@ -83,7 +175,7 @@ class Node2vec(object):
                 d_neighbours = []
 
                 # Calculate unnormalized weights
-                for dest in self.graph.neighbours(current_node):
+                for dest in self.graph.neighbors(current_node):
                     if current_node in self.sampling_strategy:
                         p = self.sampling_strategy[current_node].get(self.P_KEY, self.p)
                         q = self.sampling_strategy[current_node].get(self.Q_KEY, self.q)
@@ -123,8 +215,13 @@ class Node2vec(object):
     def _generate_walks(self):
         """
         Generates the random walks that will be used as the skip-gram input.
-        :return: (list) of walks. Each walk is a list of nodes.
+        :return: (list) of walks. Each walk is a list of nodes. In 'alias' and 'rejection'
+                 modes, a memory-mapped int32 matrix of node indices instead (see
+                 `_generate_alias_walks`).
         """
+        if self.sampling in (self.SAMPLING_ALIAS, self.SAMPLING_REJECTION):
+            return self._generate_alias_walks()
+
         def flatten(l):
             return [it for sublist in l for it in sublist]
 
@@ -148,9 +245,107 @@ class Node2vec(object):
 
         return flatten(walk_results)
 
-    def fit(self, **skip_gram_params):
+    def _generate_alias_walks(self):
+        """
+        Generates walks in worker processes that memory-map the CSR graph and alias tables
+        from `self.work_dir`, rather than receiving pickled copies, and write int32 rows into a
+        shared memory-mapped walk file. Each row is a walk of node indices into `self.csr.ids`,
+        padded with -1.
+        :return: (np.memmap) walk matrix, shape [n_walks * n_nodes, walk_length]
+        """
+        jobs = self._prepare_alias_walks()
+        Parallel(n_jobs=self.workers)(jobs)
+        return np.load(self.walks_path, mmap_mode='r')
+
+    def _prepare_alias_walks(self):
+        """
+        Saves the shared arrays, allocates the walk matrix and the per-worker progress counters
+        and returns the worker jobs.
+        :return: (list) of delayed `parallel_generate_alias_walks` calls for `joblib.Parallel`
+        """
+        if self.work_dir is None:
+            self.work_dir = tempfile.mkdtemp(prefix='node2vec-', dir=self.temp_folder)
+            self.own_work_dir = True
+
+        work_dir = Path(self.work_dir)
+        graph_dir = self.csr.path
+        if graph_dir is None:
+            graph_dir = str(work_dir / 'graph')
+            self.csr.save(graph_dir)
+
+        tables_dir = str(work_dir / 'alias_tables')
+        self.alias_tables.save(tables_dir)
+
+        self.node_n_walks = self._node_strategy(self.N_WALKS_KEY, self.n_walks, np.int64)
+        if self.sources is not None:
+            is_source = np.zeros(self.csr.n_nodes, dtype=bool)
+            is_source[[self.csr.index[str(node)] for node in self.sources if str(node) in self.csr.index]] = True
+            self.node_n_walks[~is_source] = 0
+
+        self.node_walk_length = self._node_strategy(self.WALK_LENGTH_KEY, self.walk_length, np.int64)
+        max_walk_length = int(self.node_walk_length.max()) if self.csr.n_nodes else 0
+
+        # rows are laid out by global walk index, so each worker owns a contiguous block
+        n_rows = np.array([np.count_nonzero(self.node_n_walks > i) for i in range(self.n_walks)], dtype=np.int64)
+        row_starts = np.concatenate([[0], np.cumsum(n_rows)])
+        self.walks_path = str(work_dir / 'walks.npy')
+        walks = np.lib.format.open_memmap(self.walks_path, mode='w+', dtype=np.int32,
+                                          shape=(int(row_starts[-1]), max_walk_length))
+        del walks
+
+        n_walks_lists = [x for x in np.array_split(range(self.n_walks), self.workers) if len(x)]
+        self.worker_rows = [(int(row_starts[x[0]]), int(row_starts[x[-1] + 1])) for x in n_walks_lists]
+        self.progress_path = str(work_dir / 'progress.npy')
+        progress = np.lib.format.open_memmap(self.progress_path, mode='w+', dtype=np.int64,
+                                             shape=(len(n_walks_lists),))
+        del progress
+
+        return [
+            delayed(parallel_generate_alias_walks)(
+                graph_dir,
+                tables_dir,
+                self.walks_path,
+                walk_indices,
+                self.worker_rows[i - 1][0],
+                self.node_n_walks,
+                self.node_walk_length,
+                i,
+                self.batch_size,
+                self.sampling == self.SAMPLING_REJECTION,
+                self.p,
+                self.q,
+                self.node_p,
+                self.node_q,
+                self.quiet,
+                self.progress_path
+            ) for i, walk_indices in enumerate(n_walks_lists, 1)]
+
+    def _estimate_word_freq(self):
+        """
+        Estimates token counts of the walks before they exist, to build the Word2Vec vocabulary
+        up front: each node starts its own walks, and the remaining steps visit nodes in
+        proportion to their weighted degree (the stationary distribution of a first-order walk).
+        :return: (dict) token -> estimated count
+        """
+        weights = np.asarray(self.csr.weights, dtype=np.float64)
+        strength = np.zeros(self.csr.n_nodes)
+        if self.csr.n_edges:
+            strength = np.bincount(np.repeat(np.arange(self.csr.n_nodes), self.csr.degrees()), weights=weights,
+                                   minlength=self.csr.n_nodes)
+
+        n_steps = np.sum(self.node_n_walks * (self.node_walk_length - 1) * (strength > 0))
+        freq = self.node_n_walks + n_steps * strength / max(strength.sum(), 1e-12)
+        return {str(_id): max(int(round(f)), 1) for _id, f in zip(self.csr.ids, freq)}
+
+    def fit(self, corpus_file=False, overlap=False, **skip_gram_params):
         """
         Create the embeddings using gensim word2vec
+        :param corpus_file: (bool) write the walks to a text file in `work_dir` and train with
+               gensim's `corpus_file`, which scales across cores without the GIL
+               ('alias' and 'rejection' modes)
+        :param overlap: (bool) generate the walks while training, when the object was created with
+               `generate_walks=False`. The vocabulary is built from estimated counts, and the
+               first epoch streams rows as the workers write them ('alias' and 'rejection' modes)
         :param skip_gram_params: (dict) parameters for `gensim.models.Word2Vec` (do not supply `size`
                as it is taken from the Node2Vec `embed_dim` parameter)
         :return: (gensim.models.Word2Vec)
@@ -161,7 +356,72 @@ class Node2vec(object):
         if 'size' not in skip_gram_params:
             skip_gram_params['size'] = self.embed_dim
 
-        return Word2Vec(self.walks, **skip_gram_params)
+        try:
+            if self.walks is None and overlap and not corpus_file and self.csr is not None:
+                return self._fit_overlapped(**skip_gram_params)
+
+            if self.walks is None:
+                self.walks = self._generate_walks()
+
+            walks = self.walks
+            if isinstance(walks, np.ndarray):
+                # convert to tokens lazily, one chunk of rows at a time
+                walks = WalkCorpus(walks, self.csr.ids)
+                if corpus_file:
+                    path = str(Path(self.work_dir) / 'walks.txt')
+                    walks.save_text(path)
+                    return Word2Vec(corpus_file=path, **skip_gram_params)
+
+            return Word2Vec(walks, **skip_gram_params)
+        finally:
+            self.close()
+
+    def update(self, model, **train_params):
+        """
+        Continue training a saved model on the walks, adding new nodes to its vocabulary. With
+        `sources` set to the nodes added or changed since the model was trained, the cost is
+        proportional to the new data rather than the whole graph.
+        :param model: (gensim.models.Word2Vec) previously trained model
+        :param train_params: (dict) parameters for `gensim.models.Word2Vec.train`
+        :return: (gensim.models.Word2Vec)
+        """
+        try:
+            if self.walks is None:
+                self.walks = self._generate_walks()
+
+            walks = self.walks
+            if isinstance(walks, np.ndarray):
+                walks = WalkCorpus(walks, self.csr.ids)
+
+            if 'epochs' not in train_params:
+                train_params['epochs'] = model.epochs
+
+            model.build_vocab(walks, update=True)
+            model.train(walks, total_examples=len(walks), **train_params)
+            return model
+        finally:
+            self.close()
+
+    def _fit_overlapped(self, **skip_gram_params):
+        """ Trains Word2Vec while the walk workers run in a background thread """
+        jobs = self._prepare_alias_walks()
+        corpus = StreamingWalkCorpus(self.walks_path, self.csr.ids, self.progress_path, self.worker_rows)
+        model = Word2Vec(**skip_gram_params)
+        model.build_vocab_from_freq(self._estimate_word_freq())
+
+        def generate():
+            try:
+                Parallel(n_jobs=self.workers)(jobs)
+            except Exception as e:
+                corpus.error = e
+            finally:
+                corpus.done.set()
+
+        thread = Thread(target=generate, daemon=True)
+        thread.start()
+        model.train(corpus, total_examples=len(corpus), epochs=model.epochs)
+        thread.join()
+        return model
 
 
 def parallel_generate_walks(d_graph, global_walk_length, n_walks, n_cpu, sampling_strategy=None,
@@ -237,3 +497,63 @@ def parallel_generate_walks(d_graph, global_walk_length, n_walks, n_cpu, samplin
         pbar.close()
 
     return walks
+
+
+def parallel_generate_alias_walks(graph_dir, tables_dir, walks_path, walk_indices, row_start, node_n_walks,
+                                  node_walk_length, n_cpu, batch_size=10000, rejection=False, p=1, q=1,
+                                  node_p=None, node_q=None, quiet=False, progress_path=None):
+    """
+    Generates random walks by drawing from alias tables, a batch of walks at a time, and writes
+    them into the shared walk matrix.
+    :param graph_dir: (str) folder of the saved `CsrGraph`, memory-mapped read-only
+    :param tables_dir: (str) folder of the saved `AliasTables`, memory-mapped read-only
+    :param walks_path: (str) `.npy` walk matrix, memory-mapped for writing
+    :param walk_indices: (ndarray) global indices of the walks to generate from every node
+    :param row_start: (int) first row of the walk matrix owned by this worker
+    :param node_n_walks: (ndarray) number of walks per node
+    :param node_walk_length: (ndarray) walk length per node
+    :param n_cpu:
+    :param batch_size: (int) number of walks advanced together
+    :param rejection: (bool) sample second-order steps by rejection against first-order tables
+    :param p: (float) return hyperparameter, used with `rejection`
+    :param q: (float) input hyperparameter, used with `rejection`
+    :param node_p: (ndarray) per-node `p`, used with `rejection`
+    :param node_q: (ndarray) per-node `q`, used with `rejection`
+    :param quiet:
+    :param progress_path: (str) `.npy` array of rows written per worker, updated after each batch
+           so that a reader can consume walks while they are generated
+    :return: (int) number of walks written
+    """
+    graph = CsrGraph.load(graph_dir)
+    tables = AliasTables.load(tables_dir)
+    walks = np.load(walks_path, mmap_mode='r+')
+    progress = np.load(progress_path, mmap_mode='r+') if progress_path else None
+    random_state = np.random.RandomState()
+    max_walk_length = walks.shape[1]
+    steps = np.arange(max_walk_length)
+    row = row_start
+    generator = walk_indices if quiet else \
+        tqdm(walk_indices, desc='Generating walks (n_cpu: {})'.format(n_cpu))
+
+    for i in generator:
+        # Skip nodes with specific n_walks, and shuffle the rest
+        sources = np.flatnonzero(node_n_walks > i)
+        random_state.shuffle(sources)
+        for start in range(0, len(sources), batch_size):
+            batch = sources[start:start + batch_size]
+            if rejection:
+                batch_walks = rejection_walks(graph, tables, batch, max_walk_length, random_state,
+                                              p, q, node_p, node_q)
+            else:
+                batch_walks = alias_walks(graph, tables, batch, max_walk_length, random_state)
+
+            # Truncate walks of nodes with specific walk_length
+            batch_walks[steps >= node_walk_length[batch][:, np.newaxis]] = -1
+            walks[row:row + len(batch)] = batch_walks
+            row += len(batch)
+            if progress is not None:
+                # publish only after the rows are written
+                progress[n_cpu - 1] = row - row_start
+
+    walks.flush()
+    return row - row_start
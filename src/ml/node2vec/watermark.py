@@ -0,0 +1,81 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+class Watermark(object):
+    """
+    Snapshot of the graph that the embeddings were last trained on: a fingerprint of the
+    neighbours and edge weights of every node. Comparing it with a fresh export finds the nodes
+    added or changed since, which are the only ones that need new walks in an incremental update.
+    """
+
+    FILENAME = 'watermark.json'
+
+    def __init__(self, ids, fingerprints):
+        self.ids = ids
+        self.fingerprints = fingerprints
+
+    @classmethod
+    def from_graph(cls, graph):
+        return cls(np.asarray(graph.ids), neighbourhood_fingerprints(graph))
+
+    def changed_nodes(self, graph):
+        """
+        Nodes of `graph` that are new, or whose edges differ from the snapshot (i.e. gained, lost
+        or rewired edges, or edges whose weight changed)
+
+        :param graph: (CsrGraph) current graph
+        :return: (ndarray) node indices into `graph`
+        """
+        ids = np.asarray(graph.ids)
+        fingerprints = neighbourhood_fingerprints(graph)
+        changed = np.ones(len(ids), dtype=bool)
+        if len(self.ids):
+            order = np.argsort(self.ids)
+            sorted_ids = self.ids[order]
+            pos = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+            found = sorted_ids[pos] == ids
+            changed[found] = self.fingerprints[order][pos[found]] != fingerprints[found]
+
+        return np.flatnonzero(changed)
+
+    def save(self, dirname):
+        path = Path(dirname)
+        path.mkdir(parents=True, exist_ok=True)
+        np.save(str(path / 'ids.npy'), self.ids)
+        np.save(str(path / 'fingerprints.npy'), self.fingerprints)
+
+        # written last so that a partially written snapshot is never picked up
+        with (path / self.FILENAME).open('w') as f:
+            json.dump({'n_nodes': len(self.ids)}, f)
+
+    @classmethod
+    def load(cls, dirname):
+        path = Path(dirname)
+        return cls(np.load(str(path / 'ids.npy'), mmap_mode='r'),
+                   np.load(str(path / 'fingerprints.npy'), mmap_mode='r'))
+
+    @classmethod
+    def exists(cls, dirname):
+        # snapshots of degrees only, from before fingerprints, are not used
+        path = Path(dirname)
+        return (path / cls.FILENAME).exists() and (path / 'fingerprints.npy').exists()
+
+
+def neighbourhood_fingerprints(graph):
+    """
+    Order-independent hash of the (neighbour id, edge weight) pairs of every node, as the
+    wrapping sum of the hashes of its edges
+
+    :param graph: (CsrGraph) graph
+    :return: (ndarray) uint64 fingerprint per node
+    """
+    id_hashes = pd.util.hash_array(np.asarray(graph.ids, dtype=object))
+    edge_hashes = id_hashes[np.asarray(graph.neighbours)] ^ pd.util.hash_array(
+        np.asarray(graph.weights, dtype=np.float64))
+    sums = np.concatenate([np.zeros(1, dtype=np.uint64), np.cumsum(edge_hashes, dtype=np.uint64)])
+    offsets = np.asarray(graph.offsets)
+    return sums[offsets[1:]] - sums[offsets[:-1]]
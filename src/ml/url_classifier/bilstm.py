@@ -1,13 +1,16 @@
 from pathlib import PosixPath
-from typing import Dict, Tuple
+from typing import Dict, List, Tuple
 
 import numpy as np
 import pandas as pd
+import tensorflow as tf
 from keras.callbacks import History, ModelCheckpoint
 from keras.layers import Bidirectional, Dense, Embedding, LSTM, SpatialDropout1D
 from keras.models import Model, Sequential
 from sklearn.model_selection import train_test_split
 
+from ml.url_classifier.encoder import UrlEncoder
+
 
 def make_bilstm_model(n_input_tokens: int, max_len: int, embed_dim: int) -> Model:
     model = Sequential()
@@ -30,6 +33,8 @@ class BiLstmPredictor(object):
         self.char2idx = None
         self.max_url_seq_length = None
         self.embed_dim = None
+        self.encoder = None
+        self.graph = None
 
     @staticmethod
     def get_config_path(model_dir_path: PosixPath) -> str:
@@ -55,31 +60,46 @@ class BiLstmPredictor(object):
         self.embed_dim = config['embed_dim']
         self.idx2char = config['idx2char']
         self.char2idx = config['char2idx']
+        self.encoder = UrlEncoder(self.char2idx, self.max_url_seq_length)
         self.model = make_bilstm_model(self.n_input_tokens, self.max_url_seq_length, self.embed_dim)
         self.model.load_weights(weight_file_path)
 
-    def predict(self, url: str) -> np.ndarray:
-        x = np.zeros((1, self.max_url_seq_length))
-        for idx, ch in enumerate(url):
-            if ch in self.char2idx:
-                x[0, idx] = self.char2idx[ch]
+        # build the predict function up front, so that other threads (e.g. `api.coalescer`)
+        # can predict within the graph the model was loaded in
+        self.model._make_predict_function()
+        self.graph = tf.get_default_graph()
 
-        predicted = self.model.predict(x)[0]
-        predicted_label = np.argmax(predicted)
-        return predicted_label
+    def predict(self, url: str) -> np.ndarray:
+        return self.predict_batch([url])[0]
+
+    def predict_batch(self, urls: List[str], batch_size: int = 1024) -> np.ndarray:
+        """
+        Predict labels for many URLs, encoding and running the model one batch at a time
+
+        :param urls: URLs to classify; characters past `max_url_seq_length` are ignored
+        :param batch_size: number of URLs per model call
+        :return: predicted label per URL, 1 for malicious
+        """
+        return np.argmax(self.predict_proba(urls, batch_size), axis=1)
+
+    def predict_proba(self, urls: List[str], batch_size: int = 1024) -> np.ndarray:
+        """
+        :param urls: URLs to classify
+        :param batch_size: number of URLs per model call
+        :return: class probabilities, shape [len(urls), 2]
+        """
+        probas = [np.zeros((0, 2), dtype=np.float32)]
+        with self.graph.as_default():
+            for start in range(0, len(urls), batch_size):
+                x = self.encoder.encode(urls[start:start + batch_size])
+                probas.append(self.model.predict(x, batch_size=batch_size))
+
+        return np.concatenate(probas)
 
     def extract_training_data(self, url_data: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
-        data_size = url_data.shape[0]
-        x = np.zeros((data_size, self.max_url_seq_length))
-        y = np.zeros((data_size, 2))
-        for i in range(data_size):
-            url = url_data['url'][i]
-            label = url_data['label'][i]
-            for idx, ch in enumerate(url):
-                x[i, idx] = self.char2idx[ch]
-
-            y[i, label] = 1
-
+        x = self.encoder.encode(list(url_data['url']))
+        y = np.zeros((url_data.shape[0], 2))
+        y[np.arange(url_data.shape[0]), url_data['label'].values] = 1
         return x, y
 
     def fit(self, model: Dict, url_data: pd.DataFrame, model_dir_path: PosixPath,
@@ -89,6 +109,7 @@ class BiLstmPredictor(object):
         self.idx2char = model['idx2char']
         self.max_url_seq_length = model['max_url_seq_length']
         self.embed_dim = model['embed_dim']
+        self.encoder = UrlEncoder(self.char2idx, self.max_url_seq_length)
 
         np.save(self.get_config_path(model_dir_path), model)
 
@@ -99,6 +120,7 @@ class BiLstmPredictor(object):
         x_train, x_test, y_train, y_test = train_test_split(x, y, test_size=test_size, random_state=random_state)
 
         self.model = make_bilstm_model(self.n_input_tokens, self.max_url_seq_length, self.embed_dim)
+        self.graph = tf.get_default_graph()
 
         with open(self.get_arch_path(model_dir_path), 'wt') as f:
             f.write(self.model.to_json())
@@ -0,0 +1,74 @@
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import List
+import os
+
+import numpy as np
+
+from ml.url_classifier.bilstm import BiLstmPredictor
+from ml.url_classifier.bilstm_numpy import NumpyBiLstmPredictor
+from ml.url_classifier.util import load_url_data
+
+ROOT = Path(__file__).parent.parent.parent
+
+
+def export_weights(predictor: BiLstmPredictor, file_path: str) -> None:
+    """
+    Save the weights of a trained Keras model, in the layer order of `make_bilstm_model`,
+    with the character mapping, for `NumpyBiLstmPredictor`
+
+    :param predictor: loaded or trained Keras predictor
+    :param file_path: `.npz` file to write
+    """
+    (embeddings, forward_kernel, forward_recurrent_kernel, forward_bias, backward_kernel, backward_recurrent_kernel,
+     backward_bias, dense_kernel, dense_bias) = predictor.model.get_weights()
+    chars, char_indices = zip(*sorted(predictor.char2idx.items(), key=lambda item: item[1]))
+    np.savez(file_path,
+             max_url_seq_length=np.int64(predictor.max_url_seq_length),
+             chars=np.array(chars, dtype=str),
+             char_indices=np.array(char_indices, dtype=np.int64),
+             embeddings=embeddings,
+             forward_kernel=forward_kernel,
+             forward_recurrent_kernel=forward_recurrent_kernel,
+             forward_bias=forward_bias,
+             backward_kernel=backward_kernel,
+             backward_recurrent_kernel=backward_recurrent_kernel,
+             backward_bias=backward_bias,
+             dense_kernel=dense_kernel,
+             dense_bias=dense_bias)
+
+
+def verify(predictor: BiLstmPredictor, numpy_predictor: NumpyBiLstmPredictor, urls: List[str]) -> float:
+    """
+    Compare the NumPy forward pass with Keras
+
+    :return: maximum absolute difference of the predicted probabilities
+    """
+    diff = np.abs(predictor.predict_proba(urls) - numpy_predictor.predict_proba(urls)).max()
+    agreement = np.mean(predictor.predict_batch(urls) == numpy_predictor.predict_batch(urls))
+    print('Max probability difference: {:.2e}, label agreement: {:.4f}'.format(diff, agreement))
+    return diff
+
+
+def run(constants):
+    model_path = ROOT / os.getenv('MODELS_DIR')
+    data_path = ROOT / os.getenv('DATA_DIR')
+    predictor = BiLstmPredictor()
+    predictor.load_model(model_path)
+    export_weights(predictor, NumpyBiLstmPredictor.get_weights_path(model_path))
+
+    numpy_predictor = NumpyBiLstmPredictor()
+    numpy_predictor.load_model(model_path)
+    urls = list(load_url_data(data_path, sample=True)['url'][:constants['n_urls']])
+    if verify(predictor, numpy_predictor, urls) > constants['tolerance']:
+        raise ValueError('The NumPy model does not reproduce the Keras model')
+
+
+if __name__ == '__main__':
+    # read args
+    parser = ArgumentParser(description='Export the Malicious URL Classifier for NumPy inference')
+    parser.add_argument('--n-urls', dest='n_urls', type=int, default=1000, help='number of sample URLs to verify')
+    parser.add_argument('--tolerance', dest='tolerance', type=float, default=1e-4,
+                        help='maximum probability difference from Keras')
+    args = parser.parse_args()
+    run(vars(args))
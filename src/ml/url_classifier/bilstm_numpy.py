@@ -0,0 +1,207 @@
+"""
+NumPy-only inference for the BiLSTM URL model. Reproduces the forward pass of
+`make_bilstm_model` (Keras 2.2.4 with its default LSTM activations; dropout is inactive at
+inference) from weights exported by `bilstm_export.py`, so that prediction-only processes
+never import TensorFlow.
+
+Two properties of the trained model make it cheaper to evaluate than running every row over
+`max_url_seq_length` steps in both directions:
+
+* The embedding and the input kernels are folded into one table of input projections per
+  character, so each step is a gather and a single recurrent product.
+* Rows are right-padded with index 0 and the model has no masking. The backward LSTM reads
+  the padding first, starting from a zero state, so all rows share its state until their
+  last character. That trajectory is computed once on load, and each row then only needs as
+  many backward steps as it has characters. The forward LSTM reads the padding last; once
+  every row is in the padding, it stops as soon as the state no longer changes.
+"""
+
+from pathlib import PosixPath
+from typing import List
+
+import numpy as np
+
+from ml.url_classifier.encoder import UrlEncoder
+
+
+def hard_sigmoid(x: np.ndarray) -> np.ndarray:
+    """ Keras 2 `hard_sigmoid`, the default recurrent activation of its LSTM, in place """
+    x *= 0.2
+    x += 0.5
+    return np.clip(x, 0., 1., out=x)
+
+
+def softmax(x: np.ndarray) -> np.ndarray:
+    e = np.exp(x - x.max(axis=1, keepdims=True))
+    return e / e.sum(axis=1, keepdims=True)
+
+
+class NumpyLstm(object):
+    """ One direction of the bidirectional LSTM, with Keras gate order (input, forget, cell, output) """
+
+    def __init__(self, embeddings: np.ndarray, kernel: np.ndarray, recurrent_kernel: np.ndarray, bias: np.ndarray):
+        self.units = recurrent_kernel.shape[0]
+        self.input_table = (embeddings @ kernel + bias).astype(np.float32)  # [n_tokens, 4 * units]
+        self.recurrent_kernel = np.ascontiguousarray(recurrent_kernel, dtype=np.float32)
+
+    def zero_state(self, n: int):
+        return np.zeros((n, self.units), dtype=np.float32), np.zeros((n, self.units), dtype=np.float32)
+
+    def step(self, tokens: np.ndarray, h: np.ndarray, c: np.ndarray):
+        """
+        :param tokens: (ndarray) token index per row, shape [n, ]
+        :param h: (ndarray) hidden state, shape [n, units]
+        :param c: (ndarray) cell state, shape [n, units]
+        :return: (ndarray, ndarray) the next hidden and cell states
+        """
+        u = self.units
+        z = self.input_table[tokens]
+        z += h @ self.recurrent_kernel
+        i = hard_sigmoid(z[:, :u])
+        f = hard_sigmoid(z[:, u:2 * u])
+        g = np.tanh(z[:, 2 * u:3 * u])
+        o = hard_sigmoid(z[:, 3 * u:])
+        c = f * c + i * g
+        return o * np.tanh(c), c
+
+
+class NumpyBiLstmPredictor(object):
+
+    model_name = 'bilstm'
+
+    def __init__(self):
+        self.n_input_tokens = None
+        self.char2idx = None
+        self.max_url_seq_length = None
+        self.embed_dim = None
+        self.encoder = None
+        self.forward = None
+        self.backward = None
+        self.dense_kernel = None
+        self.dense_bias = None
+        self.pad_h = None  # backward state after k padding steps, shape [max_url_seq_length + 1, units]
+        self.pad_c = None
+
+    @staticmethod
+    def get_weights_path(model_dir_path: PosixPath) -> str:
+        weights_filename = NumpyBiLstmPredictor.model_name + '-weights.npz'
+        return str(model_dir_path / weights_filename)
+
+    @staticmethod
+    def exists(model_dir_path: PosixPath) -> bool:
+        return (model_dir_path / (NumpyBiLstmPredictor.model_name + '-weights.npz')).exists()
+
+    def load_model(self, model_dir_path: PosixPath) -> None:
+        with np.load(self.get_weights_path(model_dir_path)) as weights:
+            self.set_weights({name: weights[name] for name in weights.files})
+
+    def set_weights(self, weights: dict) -> None:
+        """
+        :param weights: arrays as written by `bilstm_export.export_weights`
+        """
+        self.max_url_seq_length = int(weights['max_url_seq_length'])
+        self.char2idx = {str(ch): int(idx) for ch, idx in zip(weights['chars'], weights['char_indices'])}
+        embeddings = weights['embeddings']
+        self.n_input_tokens, self.embed_dim = embeddings.shape
+        self.encoder = UrlEncoder(self.char2idx, self.max_url_seq_length)
+        self.forward = NumpyLstm(embeddings, weights['forward_kernel'], weights['forward_recurrent_kernel'],
+                                 weights['forward_bias'])
+        self.backward = NumpyLstm(embeddings, weights['backward_kernel'], weights['backward_recurrent_kernel'],
+                                  weights['backward_bias'])
+        self.dense_kernel = weights['dense_kernel'].astype(np.float32)
+        self.dense_bias = weights['dense_bias'].astype(np.float32)
+
+        # backward states while reading the padding, shared by all rows
+        h, c = self.backward.zero_state(1)
+        pad = np.zeros(1, dtype=np.int64)
+        self.pad_h = np.empty((self.max_url_seq_length + 1, self.backward.units), dtype=np.float32)
+        self.pad_c = np.empty_like(self.pad_h)
+        self.pad_h[0], self.pad_c[0] = h[0], c[0]
+        for k in range(1, self.max_url_seq_length + 1):
+            h, c = self.backward.step(pad, h, c)
+            self.pad_h[k], self.pad_c[k] = h[0], c[0]
+
+    def predict(self, url: str) -> np.ndarray:
+        return self.predict_batch([url])[0]
+
+    def predict_batch(self, urls: List[str], batch_size: int = 1024) -> np.ndarray:
+        """
+        :param urls: URLs to classify; characters past `max_url_seq_length` are ignored
+        :param batch_size: number of URLs evaluated together
+        :return: predicted label per URL, 1 for malicious
+        """
+        return np.argmax(self.predict_proba(urls, batch_size), axis=1)
+
+    def predict_proba(self, urls: List[str], batch_size: int = 1024) -> np.ndarray:
+        """
+        :param urls: URLs to classify
+        :param batch_size: number of URLs evaluated together
+        :return: class probabilities, shape [len(urls), 2]
+        """
+        lengths = np.fromiter((min(len(url), self.max_url_seq_length) for url in urls), dtype=np.int64,
+                              count=len(urls))
+
+        # batches of similar lengths, longest first
+        order = np.argsort(-lengths, kind='stable')
+        probas = np.zeros((len(urls), 2), dtype=np.float32)
+        for start in range(0, len(urls), batch_size):
+            rows = order[start:start + batch_size]
+            x = self.encoder.encode([urls[i] for i in rows])
+            probas[rows] = self._forward_pass(x, lengths[rows])
+
+        return probas
+
+    def _forward_pass(self, x: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+        """
+        :param x: (ndarray) encoded URLs, shape [n, max_url_seq_length]
+        :param lengths: (ndarray) number of characters per row, in descending order
+        :return: (ndarray) class probabilities, shape [n, 2]
+        """
+        max_length = int(lengths[0]) if len(lengths) else 0
+
+        # forward direction: the characters, then the padding until the state stops changing
+        h, c = self.forward.zero_state(len(x))
+        for t in range(max_length):
+            h, c = self.forward.step(x[:, t], h, c)
+
+        pad = np.zeros(len(x), dtype=np.int64)
+        for _ in range(max_length, self.max_url_seq_length):
+            h_next, c_next = self.forward.step(pad, h, c)
+            if np.array_equal(h_next, h) and np.array_equal(c_next, c):
+                break
+
+            h, c = h_next, c_next
+
+        h_forward = h
+
+        # backward direction: each row starts from the shared padding state, then reads its
+        # characters from last to first; rows with `length > t` are active, a growing prefix
+        h = self.pad_h[self.max_url_seq_length - lengths]
+        c = self.pad_c[self.max_url_seq_length - lengths]
+        n_active = 0
+        for t in range(max_length - 1, -1, -1):
+            while n_active < len(lengths) and lengths[n_active] > t:
+                n_active += 1
+
+            h[:n_active], c[:n_active] = self.backward.step(x[:n_active, t], h[:n_active], c[:n_active])
+
+        return softmax(np.hstack([h_forward, h]) @ self.dense_kernel + self.dense_bias)
+
+
+def load_predictor(model_dir_path: PosixPath):
+    """
+    The NumPy predictor when exported weights exist in the model directory, otherwise the
+    Keras one, which imports TensorFlow
+
+    :param model_dir_path: model directory
+    :return: (NumpyBiLstmPredictor or BiLstmPredictor) loaded predictor
+    """
+    if NumpyBiLstmPredictor.exists(model_dir_path):
+        predictor = NumpyBiLstmPredictor()
+    else:
+        from ml.url_classifier.bilstm import BiLstmPredictor
+
+        predictor = BiLstmPredictor()
+
+    predictor.load_model(model_dir_path)
+    return predictor
@@ -0,0 +1,305 @@
+"""
+Cache URL verdicts so that URLs recurring in the logs are classified once. URLs are keyed by a
+normalized form, the least recently used verdicts are evicted beyond `max_size`, and the cache
+can be persisted to a JSON file to survive restarts, which processes can share. It is saved from
+a background thread and at exit, never while answering a request. Domains on the allow or deny lists, or subdomains of
+them, are decided without the model.
+"""
+
+import atexit
+import fcntl
+import json
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+from threading import Event, Lock, Thread
+from typing import Dict, Iterable, List, Optional, Set
+from urllib.parse import urlsplit
+
+import numpy as np
+
+GOOD = 0
+BAD = 1
+
+DEFAULT_PORTS = {'http': '80', 'https': '443', 'ftp': '21'}
+
+# files in the models directory
+VERDICTS_FILENAME = 'url_verdicts.json'
+ALLOW_LIST_FILENAME = 'url_allow_list.txt'
+DENY_LIST_FILENAME = 'url_deny_list.txt'
+
+
+def normalize_url(url: str) -> str:
+    """
+    Key of a URL in the verdict cache: surrounding whitespace and the fragment are removed,
+    and the scheme and host are lowercased, without the default port of the scheme
+    """
+    url = url.strip()
+    try:
+        parts = urlsplit(url if '://' in url else '//' + url)
+    except ValueError:  # e.g. an unbalanced IPv6 bracket
+        return url
+
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.rpartition('@')
+    host, _, port = netloc[2].lower().partition(':')
+    if port and port != DEFAULT_PORTS.get(scheme):
+        host += ':' + port
+
+    netloc = netloc[0] + netloc[1] + host
+    path = parts.path + ('?' + parts.query if parts.query else '')
+    return (scheme + '://' if scheme else '') + netloc + path
+
+
+def url_domain(url: str) -> str:
+    """ Lowercased host name of a URL, which may be given without a scheme """
+    url = url.strip()
+    try:
+        host = urlsplit(url if '://' in url else '//' + url).hostname
+    except ValueError:
+        return ''
+
+    return (host or '').rstrip('.')
+
+
+def load_domains(path) -> Set[str]:
+    """
+    Read a domain list with one domain per line; blank lines and `#` comments are ignored
+
+    :param path: domain list file
+    :return: domains, empty when the file does not exist
+    """
+    path = Path(path)
+    if not path.exists():
+        return set()
+
+    with path.open('r') as f:
+        lines = (line.split('#', 1)[0].strip().lower() for line in f)
+        return {line.lstrip('.') for line in lines if line}
+
+
+class UrlVerdictCache(object):
+
+    def __init__(self, predictor, max_size: int = 100000, path: Optional[str] = None, save_interval: float = 60.,
+                 allow_domains: Iterable[str] = (), deny_domains: Iterable[str] = ()):
+        """
+
+        :param predictor: classifier with `predict_batch(urls)`, e.g. `BiLstmPredictor`
+        :param max_size: number of verdicts to keep
+        :param path: JSON file to load verdicts from and save them to; None keeps them in memory only
+        :param save_interval: seconds between saves of new verdicts to `path`, which is also
+               saved at exit; processes sharing `path` merge their verdicts into it
+        :param allow_domains: domains whose URLs are good without asking the model
+        :param deny_domains: domains whose URLs are bad without asking the model; deny wins
+               over allow
+        """
+        self.predictor = predictor
+        self.max_size = max_size
+        self.path = None if path is None else str(path)
+        self.save_interval = save_interval
+        self.allow_domains = {domain.lower() for domain in allow_domains}
+        self.deny_domains = {domain.lower() for domain in deny_domains}
+        self.cache = OrderedDict()  # normalized URL -> verdict, least recently used first
+        self.lock = Lock()
+        self.save_lock = Lock()
+        self.n_hits = 0
+        self.n_misses = 0
+        self.n_allowed = 0
+        self.n_denied = 0
+        self.n_model_calls = 0
+        self.n_model_urls = 0
+        self.n_unsaved = 0
+        self.closed = Event()
+        self.saver = None
+        if self.path is not None:
+            if os.path.exists(self.path):
+                self.load()
+
+            self.saver = Thread(target=self._run_saver, name='url-verdict-saver', daemon=True)
+            self.saver.start()
+            atexit.register(self.close)
+
+    @classmethod
+    def from_models_dir(cls, predictor, models_dir, **kwargs) -> 'UrlVerdictCache':
+        """
+        Cache persisted in the models directory, with the domain lists found there
+
+        :param predictor: classifier with `predict_batch(urls)`
+        :param models_dir: models directory
+        :param kwargs: other arguments of `UrlVerdictCache`
+        """
+        models_dir = Path(models_dir)
+        return cls(predictor, path=models_dir / VERDICTS_FILENAME,
+                   allow_domains=load_domains(models_dir / ALLOW_LIST_FILENAME),
+                   deny_domains=load_domains(models_dir / DENY_LIST_FILENAME), **kwargs)
+
+    def predict(self, url: str) -> int:
+        return int(self.predict_batch([url])[0])
+
+    def predict_batch(self, urls: List[str]) -> np.ndarray:
+        """
+        Verdicts from the domain lists and the cache, running the model once for the rest
+
+        :param urls: URLs to classify
+        :return: verdict per URL, 1 for malicious
+        """
+        verdicts = np.zeros(len(urls), dtype=np.int64)
+        misses = OrderedDict()  # normalized URL -> positions in `urls`
+        with self.lock:
+            for i, url in enumerate(urls):
+                verdict = self._domain_verdict(url_domain(url))
+                if verdict is not None:
+                    verdicts[i] = verdict
+                    continue
+
+                key = normalize_url(url)
+                verdict = self.cache.get(key)
+                if verdict is None:
+                    if key not in misses:
+                        misses[key] = []
+                        self.n_misses += 1
+                    else:
+                        self.n_hits += 1
+
+                    misses[key].append(i)
+                else:
+                    self.cache.move_to_end(key)
+                    verdicts[i] = verdict
+                    self.n_hits += 1
+
+        if not misses:
+            return verdicts
+
+        # the first URL of each key stands for the others
+        positions = list(misses.values())
+        preds = self.predictor.predict_batch([urls[pos[0]] for pos in positions])
+        with self.lock:
+            self.n_model_calls += 1
+            self.n_model_urls += len(positions)
+            for key, pos, pred in zip(misses, positions, preds):
+                verdicts[pos] = pred
+                self.cache[key] = int(pred)
+                self.cache.move_to_end(key)
+
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+            self.n_unsaved += len(positions)
+
+        return verdicts
+
+    def _domain_verdict(self, domain: str) -> Optional[int]:
+        """ Verdict of the domain lists for a host and its parent domains, if any """
+        if not domain or not (self.allow_domains or self.deny_domains):
+            return None
+
+        labels = domain.split('.')
+        suffixes = ['.'.join(labels[i:]) for i in range(len(labels))]
+        if any(suffix in self.deny_domains for suffix in suffixes):
+            self.n_denied += 1
+            return BAD
+
+        if any(suffix in self.allow_domains for suffix in suffixes):
+            self.n_allowed += 1
+            return GOOD
+
+        return None
+
+    def stats(self) -> Dict:
+        lookups = self.n_hits + self.n_misses
+        return {
+            'cached': len(self.cache),
+            'hits': self.n_hits,
+            'misses': self.n_misses,
+            'hit_rate': self.n_hits / lookups if lookups else 0.,
+            'allowed': self.n_allowed,
+            'denied': self.n_denied,
+            'model_calls': self.n_model_calls,
+            'model_urls': self.n_model_urls
+        }
+
+    def clear(self) -> None:
+        with self.lock:
+            self.cache.clear()
+
+    def load(self) -> None:
+        with open(self.path, 'r') as f:
+            verdicts = json.load(f)
+
+        with self.lock:
+            # saved least recently used first
+            for key, verdict in verdicts:
+                self.cache[key] = verdict
+                self.cache.move_to_end(key)
+
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+    def save(self) -> None:
+        """
+        Merge the verdicts into `path`, holding the cache lock only to copy them. Processes sharing
+        `path` take turns through a lock file, so that none discards the verdicts of the others.
+        """
+        with self.save_lock:
+            with self.lock:
+                verdicts = list(self.cache.items())
+                n_unsaved = self.n_unsaved
+                self.n_unsaved = 0
+
+            try:
+                with open(self.path + '.lock', 'a') as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    self._merge_and_write(verdicts)
+            except OSError:
+                with self.lock:
+                    self.n_unsaved += n_unsaved
+
+                raise
+
+    def _merge_and_write(self, verdicts):
+        """ Write the saved verdicts updated with `verdicts`, which are the most recently used """
+        merged = OrderedDict()
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                merged.update((key, verdict) for key, verdict in json.load(f))
+
+        for key, verdict in verdicts:
+            merged[key] = verdict
+            merged.move_to_end(key)
+
+        while len(merged) > self.max_size:
+            merged.popitem(last=False)
+
+        # written to a temporary file and renamed, so that a crash never leaves a partial file
+        dirname, filename = os.path.split(self.path)
+        with tempfile.NamedTemporaryFile('w', dir=dirname or '.', prefix=filename + '.', suffix='.tmp',
+                                         delete=False) as f:
+            json.dump(list(merged.items()), f)
+
+        try:
+            os.chmod(f.name, 0o644)
+            os.replace(f.name, self.path)
+        except OSError:
+            os.unlink(f.name)
+            raise
+
+    def close(self) -> None:
+        """ Stop the background saves and save the verdicts not yet saved """
+        if self.saver is None or self.closed.is_set():
+            return
+
+        self.closed.set()
+        self.saver.join()
+        atexit.unregister(self.close)
+        if self.n_unsaved:
+            self.save()
+
+    def _run_saver(self):
+        while not self.closed.wait(self.save_interval):
+            if self.n_unsaved:
+                try:
+                    self.save()
+                except OSError:
+                    logging.exception('Could not save URL verdicts to %s', self.path)
@@ -6,6 +6,7 @@ app = faust.App('autoparse', broker='kafka://localhost:9092', value_serializer='
 raw_logs_topic = app.topic('raw_logs', value_type=str)
 parsed_logs_topic = app.topic('parsed_logs', value_type=str)
 log_keys_topic = app.topic('log_keys', value_type=str)
+anomalies_topic = app.topic('anomalies', value_type=str)
 
 greetings_topic = app.topic('greetings')
 
@@ -1,6 +1,3 @@
-from sklearn.metrics import precision_recall_fscore_support
-
-
 def metrics(y_pred, y_true):
     """
     Calculate evaluation metrics for precision, recall, and F1-score
@@ -12,5 +9,7 @@ def metrics(y_pred, y_true):
         recall: (float)
         f1: (float)
     """
+    from sklearn.metrics import precision_recall_fscore_support
+
     precision, recall, f1, _ = precision_recall_fscore_support(y_true, y_pred, average='binary')
     return precision, recall, f1
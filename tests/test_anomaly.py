@@ -0,0 +1,313 @@
+import json
+import shutil
+
+import numpy as np
+
+from anomaly.feature_extractor import CenteredMatrix, FeatureExtractor
+
+
+def make_sequences():
+    return np.array([['E1', 'E2', 'E2'], ['E2', 'E3'], [], ['E1', 'E1', 'E4']], dtype=object)
+
+
+def test_feature_extractor_counts():
+    fe = FeatureExtractor()
+    x = fe.fit_transform(make_sequences())
+    assert fe.events == ['E1', 'E2', 'E3', 'E4']
+    assert np.array_equal(x, [[1, 2, 0, 0], [0, 1, 1, 0], [0, 0, 0, 0], [2, 0, 0, 1]])
+
+    # unseen events go to the OOV column, counted once per sequence
+    fe = FeatureExtractor()
+    fe.fit_transform(make_sequences(), oov=True)
+    x = fe.transform(np.array([['E1', 'E5', 'E5', 'E6']], dtype=object))
+    assert np.array_equal(x, [[1, 0, 0, 0, 2]])
+
+
+def test_feature_extractor_sparse():
+    fe = FeatureExtractor()
+    dense = fe.fit_transform(make_sequences(), term_weighting='tf-idf', normalization='zero-mean')
+    x = fe.fit_transform(make_sequences(), term_weighting='tf-idf', normalization='zero-mean', sparse=True)
+    assert isinstance(x, CenteredMatrix)
+    assert np.allclose(x.toarray(), dense)
+    v = np.arange(4.)
+    assert np.allclose(x @ v, dense @ v)
+    assert np.allclose(x.gram(), dense.T @ dense)
+    assert np.allclose(x[1:3].toarray(), dense[1:3])
+    assert np.allclose(fe.transform(make_sequences()), dense)
+
+
+def test_session_builder():
+    from anomaly.sessions import SessionBuilder
+
+    builder = SessionBuilder(window_secs=10, lateness_secs=5)
+    builder.add(1., ['ip1'], 'E1')
+    builder.add(2., ['ip1', 'ip2'], 'E2')
+    builder.add(9., ['ip1'], 'E1')
+    assert builder.flush() is None
+    builder.add(16., ['ip2'], 'E3')
+    batch = builder.flush()
+    assert batch.keys == ['ip1', 'ip2']
+    assert list(batch.ends) == [10., 10.]
+    assert np.array_equal(batch.x.toarray(), [[2, 1, 0], [0, 1, 0]])
+
+    # the window [0, 10) has closed
+    builder.add(3., ['ip1'], 'E1')
+    assert builder.stats()['late'] == 1
+    batch = builder.flush(final=True)
+    assert batch.keys == ['ip2']
+    assert np.array_equal(batch.x.toarray(), [[0, 0, 1]])
+
+    # sliding windows count each event once per overlapping window
+    builder = SessionBuilder(window_secs=10, slide_secs=5)
+    builder.add(7., ['ip1'], 'E1')
+    batch = builder.flush(final=True)
+    assert list(batch.starts) == [0., 5.]
+
+
+def test_stream_sessions_invalid_time(tmp_path):
+    from anomaly.sessions import SessionBuilder, stream_sessions
+
+    def log(timestamp, event, ip='ip1'):
+        return json.dumps({'event_id': event, 'params': [{'entity': 'ip_address', 'value': ip}],
+                           'metadata': {'timestamp': timestamp}})
+
+    # the unparseable times take the time of the previous log
+    path = tmp_path / 'logs.jsonl'
+    path.write_text('\n'.join([log(1, 'E1'), log('not a time', 'E2'), log('2019-13-45', 'E2', 'ip2'),
+                                log('1970-01-01T00:00:12Z', 'E1')]) + '\n')
+    builder = SessionBuilder(window_secs=10)
+    batch, = stream_sessions([path], n_jobs=1, builder=builder)
+    assert batch.keys == ['ip1', 'ip2', 'ip1']
+    assert list(batch.starts) == [0., 0., 10.]
+    assert np.array_equal(batch.x.toarray(), [[1, 1], [0, 1], [1, 0]])
+    assert builder.stats()['invalid_time'] == 2
+
+
+def test_session_table():
+    from anomaly.sessions import SessionTable
+
+    def log(timestamp, event):
+        return {'event_id': event, 'metadata': {'timestamp': timestamp}}
+
+    table = {}
+    sessions = SessionTable(table, window_secs=10, lateness_secs=2)
+    assert sessions.add(log(1, 'E1'), ['ip1']) == []
+    assert sessions.add(log(3, 'E2'), ['ip1', 'ip2']) == []
+    assert sessions.add(log(11, 'E1'), ['ip1']) == []
+    assert len(table) == 3
+
+    # the watermark passes the end of [0, 10): its sessions are closed once, and removed
+    closed = sessions.add(log(12, 'E2'), ['ip2'])
+    assert closed == [('ip1', 0., {'E1': 1, 'E2': 1}), ('ip2', 0., {'E2': 1})]
+    assert sorted(table) == ['["ip1", 10.0]', '["ip2", 10.0]']
+    assert sessions.add(log(13, 'E1'), ['ip1']) == []
+
+    # a late event does not reopen the window
+    assert sessions.add(log(5, 'E1'), ['ip1']) == []
+    assert sessions.stats() == {'open_windows': 1, 'closed': 2, 'late': 1}
+
+    # after a restart, the open windows are found in the table
+    sessions = SessionTable(table, window_secs=10, lateness_secs=2)
+    closed = sessions.add(log(25, 'E1'), ['ip3'])
+    assert closed == [('ip1', 10., {'E1': 2}), ('ip2', 10., {'E2': 1})]
+    assert list(table) == ['["ip3", 20.0]']
+
+
+def test_score_table_sessions(tmp_path):
+    from anomaly.invariants_miner import InvariantsMiner
+    from anomaly.model_bundle import ModelBundle
+    from anomaly.sessions import SessionTable
+
+    # event IDs from the parser are ints; the table's counts go through JSON
+    fe = FeatureExtractor()
+    fe.fit_transform(np.array([[1, 2], [1, 1, 2, 2], [1, 2, 2]], dtype=object))
+    miner = InvariantsMiner()
+    miner.invariants = {(0, 1): [1, -1]}
+    ModelBundle(fe, miner).save(str(tmp_path))
+    bundle = ModelBundle.load(str(tmp_path))
+
+    sessions = SessionTable({}, window_secs=10)
+    for timestamp, event in [(1, 1), (2, 2), (3, 2)]:
+        sessions.add({'event_id': event, 'metadata': {'timestamp': timestamp}}, ['ip1'])
+
+    [(_, _, counts)] = sessions.add({'event_id': 1, 'metadata': {'timestamp': 10}}, ['ip2'])
+    assert counts == {'1': 1, '2': 2}
+    x = bundle.feature_extractor.transform_counts([counts])
+    assert np.array_equal(x.toarray(), [[1, 2]])
+    assert np.allclose(bundle.model.score(x), [1])
+
+
+def test_invariants_score():
+    from anomaly.invariants_miner import InvariantsMiner
+
+    fe = FeatureExtractor()
+    x = fe.fit_transform(np.array([['E1', 'E2'], ['E1', 'E1', 'E2', 'E2', 'E3'], ['E1', 'E2', 'E2']], dtype=object))
+    miner = InvariantsMiner()
+    miner.invariants = {(0, 1): [1, -1]}
+    assert list(miner.predict(x)) == [0, 0, 1]
+
+    # counts accumulated online go through the same features and a single sparse product
+    counters = [{'E1': 2, 'E2': 2}, {'E1': 1, 'E2': 3, 'E9': 1}]
+    assert np.allclose(miner.score(fe.transform_counts(counters)), [0, 2])
+
+
+def test_model_bundle(tmp_path):
+    from anomaly.decision_tree import DecisionTree
+    from anomaly.invariants_miner import InvariantsMiner
+    from anomaly.model_bundle import ModelBundle
+
+    fe = FeatureExtractor()
+    x_seq = np.array([['E1', 'E2'], ['E1', 'E1', 'E2', 'E2', 'E3'], ['E1', 'E2', 'E2']], dtype=object)
+    x = fe.fit_transform(x_seq, term_weighting='tf-idf', normalization='zero-mean', oov=True)
+    miner = InvariantsMiner()
+    miner.invariants = {(0, 1): [1, -1], (3,): [1]}
+    ModelBundle(fe, miner).save(str(tmp_path / 'invariants'))
+
+    bundle = ModelBundle.load(str(tmp_path / 'invariants'))
+    assert bundle.manifest['model']['type'] == 'InvariantsMiner'
+    assert isinstance(bundle.feature_extractor.mean_vec, np.memmap)
+    assert bundle.model.invariants == miner.invariants
+    counters = [{'E1': 2, 'E2': 2}, {'E1': 1, 'E2': 3, 'E9': 1}]
+    assert np.allclose(bundle.model.score(bundle.feature_extractor.transform_counts(counters)),
+                       miner.score(fe.transform_counts(counters)))
+
+    # decision trees are scored from the tree arrays, without scikit-learn
+    tree = DecisionTree()
+    tree.fit(x, [0, 1, 1])
+    ModelBundle(fe, tree).save(str(tmp_path / 'tree'))
+    bundle = ModelBundle.load(str(tmp_path / 'tree'))
+    assert list(bundle.model.predict(bundle.feature_extractor.transform(x_seq))) == tree.predict(x)
+
+    # saving again writes a new version, leaving the arrays a scorer has mapped untouched
+    path = tmp_path / 'invariants'
+    bundle = ModelBundle.load(str(path))
+    mean_vec = np.array(bundle.feature_extractor.mean_vec)
+    fe.mean_vec = fe.mean_vec + 1
+    for _ in range(3):
+        ModelBundle(fe, miner).save(str(path))
+
+    assert np.array_equal(bundle.feature_extractor.mean_vec, mean_vec)
+    assert np.allclose(ModelBundle.load(str(path)).feature_extractor.mean_vec, mean_vec + 1)
+    versions = sorted(p.name for p in path.iterdir() if p.name.startswith('v-'))
+    assert len(versions) == 2
+    assert (path / 'CURRENT').read_text() == versions[-1]
+    assert sorted(p.name for p in path.iterdir() if not p.name.startswith('v-')) == ['CURRENT']
+
+    # bundles saved before versioning still load
+    legacy = tmp_path / 'legacy'
+    shutil.copytree(str(path / versions[-1]), str(legacy))
+    assert ModelBundle.exists(str(legacy))
+    assert ModelBundle.load(str(legacy)).model.invariants == miner.invariants
+
+
+def test_invariants_search():
+    from anomaly.invariants_miner import InvariantsMiner
+
+    assert InvariantsMiner._join_set([(0, 1), (0, 2), (1, 2), (1, 3)], 3) == [(0, 1, 2), (1, 2, 3)]
+
+    # column 1 is twice column 0, column 3 is always zero
+    random_state = np.random.RandomState(0)
+    a = random_state.poisson(2, 50)
+    x = np.stack([a, 2 * a, random_state.poisson(2, 50), np.zeros(50)], axis=1).astype(float)
+    for n_jobs in (1, 2):
+        miner = InvariantsMiner(n_jobs=n_jobs, batch_size=2)
+        miner._invariants_search(x, 2)
+        assert list(miner.invariants) == [(3,), (0, 1)]
+        assert np.abs(miner.invariants[(0, 1)]).tolist() == [2, 1]
+
+
+def test_invariant_space():
+    import scipy.sparse as sp
+    from anomaly.invariants_miner import InvariantsMiner
+
+    # three independent columns and two that depend on them
+    random_state = np.random.RandomState(0)
+    a = random_state.poisson(2, (200, 3)).astype(float)
+    x = np.hstack([a, 2 * a[:, :1], a[:, 1:2] + a[:, 2:3]])
+    assert InvariantsMiner(block_size=1)._estimate_invariant_space(x) == 2
+    assert InvariantsMiner()._estimate_invariant_space(sp.csr_matrix(x)) == 2
+    assert InvariantsMiner(svd_solver='truncated', n_components=3)._estimate_invariant_space(x) == 2
+
+    validity, theta = InvariantsMiner()._check_invar_validity(x, [0, 3])
+    assert validity
+    assert np.abs(theta).tolist() == [2, 1]
+    assert not InvariantsMiner()._check_invar_validity(x, [0, 1])[0]
+
+
+def test_pca():
+    import scipy.sparse as sp
+    from anomaly.pca import PCA
+
+    random_state = np.random.RandomState(0)
+    a = random_state.poisson(2, (1000, 3)).astype(float)
+    x = np.hstack([a, 2 * a[:, :1]]) + random_state.randn(1000, 4) * 0.01
+    x[::100, 3] += 3
+    model = PCA(n_components=3)
+    model.fit(x)
+    y_pred = model.predict(x)
+    assert y_pred[::100].all()
+    assert y_pred.sum() < 20
+
+    # fitting over sparse chunks gives the same model
+    chunked = PCA(n_components=3)
+    for start in range(0, 1000, 300):
+        chunked.partial_fit(sp.csr_matrix(x[start:start + 300]))
+
+    assert np.allclose(chunked.spe(sp.csr_matrix(x)), model.spe(x))
+    assert np.isclose(chunked.threshold, model.threshold)
+
+
+def test_log_clustering():
+    import scipy.sparse as sp
+    from anomaly.log_clustering import LogClustering
+
+    # two session types, with every 50th session repeating an error event
+    random_state = np.random.RandomState(0)
+    x = np.zeros((1000, 7))
+    x[::2, :3] = random_state.poisson(3, (500, 3)) + 1
+    x[1::2, 3:6] = random_state.poisson(3, (500, 3)) + 1
+    x[::50, 6] = 20
+    model = LogClustering(max_dist=0.3, anomaly_threshold=0.3, num_bootstrap_samples=200)
+    model.fit(np.delete(x, np.s_[::50], axis=0))
+    y_pred = model.predict(x)
+    assert y_pred[::50].all()
+    assert y_pred.sum() == 20
+
+    # strictly sequential online clustering, here of a sparse matrix, flags the same sessions
+    sequential = LogClustering(max_dist=0.3, anomaly_threshold=0.3, num_bootstrap_samples=200, batch_size=1)
+    sequential.fit(sp.csr_matrix(np.delete(x, np.s_[::50], axis=0)))
+    assert sequential.cluster_sizes.sum() == model.cluster_sizes.sum() == 980
+    assert np.array_equal(sequential.predict(sp.csr_matrix(x)), y_pred)
+
+    # refitting starts over, also with other events
+    n_clusters = model.n_clusters
+    model.fit(np.delete(x, np.s_[::50], axis=0))
+    assert model.n_clusters == n_clusters
+    assert model.cluster_sizes.sum() == 980
+    model.fit(x[:100, :3])
+    assert model.representatives.shape == (model.n_clusters, 3)
+    assert model.cluster_sizes.sum() == 100
+
+
+def test_load_hdfs_dataset(tmp_path):
+    import pandas as pd
+    from anomaly.data_util import load_hdfs_dataset
+
+    log_filename = str(tmp_path / 'hdfs.log_structured.csv')
+    pd.DataFrame({
+        'Content': ['Receiving blk_1 and blk_-2', 'Deleting blk_-2', 'Verified blk_1 blk_1', 'Starting'],
+        'EventId': ['E1', 'E2', 'E3', 'E4']
+    }).to_csv(log_filename, index=False)
+    pd.DataFrame({'BlockId': ['blk_1', 'blk_-2'], 'Label': ['Normal', 'Anomaly']}).to_csv(
+        str(tmp_path / 'labels.csv'), index=False)
+
+    (x, _), _ = load_hdfs_dataset(log_filename, cache=True)
+    assert list(x) == [['E1', 'E3'], ['E1', 'E2']]
+
+    # reloaded from the cache
+    assert (tmp_path / 'hdfs.log_structured.csv.seq.npz').exists()
+    (x, _), _ = load_hdfs_dataset(log_filename, cache=True)
+    assert list(x) == [['E1', 'E3'], ['E1', 'E2']]
+
+    (x_train, y_train), (x_test, y_test) = load_hdfs_dataset(log_filename, str(tmp_path / 'labels.csv'), test_ratio=0)
+    assert sorted(zip(map(tuple, x_train), y_train)) == [(('E1', 'E2'), 1), (('E1', 'E3'), 0)]
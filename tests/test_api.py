@@ -0,0 +1,114 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from api.coalescer import BatchCoalescer
+
+
+def test_batch_coalescer():
+    calls = []
+
+    def predict_batch(items):
+        calls.append(len(items))
+        time.sleep(0.01)  # a model call with fixed overhead
+        if 'fail' in items:
+            raise ValueError('bad input')
+
+        return np.array([len(item) for item in items])
+
+    coalescer = BatchCoalescer(predict_batch, max_batch_size=64, max_wait_ms=5)
+    requests = [['a' * i, 'b' * (i + 1)] for i in range(100)]
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        results = list(executor.map(coalescer.predict_batch, requests))
+
+    # each request gets its own results, from far fewer model calls
+    assert [r.tolist() for r in results] == [[i, i + 1] for i in range(100)]
+    assert sum(calls) == 200
+    assert len(calls) < 50
+    assert coalescer.stats()['requests'] == 100
+
+    with pytest.raises(ValueError):
+        coalescer.predict('fail')
+
+    coalescer.close()
+
+
+def test_similar_endpoint(tmp_path):
+    falcon = pytest.importorskip('falcon')
+    from falcon import testing
+
+    from api.similar_endpoint import SimilarResource
+    from ml.node2vec.ann import LshIndex
+
+    index_path = tmp_path / 'node2vec-index'
+    app = falcon.API()
+    app.add_route('/similar', SimilarResource(index_path))
+    client = testing.TestClient(app)
+
+    # the API starts before embeddings are trained
+    result = client.simulate_get('/similar', params={'node': 'a'})
+    assert result.status == falcon.HTTP_503
+    assert result.headers['retry-after'] == '60'
+
+    vectors = np.array([[1., 0.], [0.9, 0.1], [0., 1.]], dtype=np.float32)
+    LshIndex(n_tables=2, n_bits=2).build(vectors, ['a', 'b', 'c']).save(str(index_path))
+    result = client.simulate_get('/similar', query_string='node=a&node=x&k=1&probes=3')
+    assert result.status == falcon.HTTP_200
+    assert [n['node'] for n in result.json['a']] == ['b']
+    assert result.json['x'] is None
+
+    result = client.simulate_post('/similar', json={'nodes': ['c'], 'k': 2})
+    assert result.status == falcon.HTTP_200
+    assert len(result.json['c']) == 2
+
+    # a retrained index is picked up without restarting
+    LshIndex(n_tables=2, n_bits=2).build(vectors, ['a', 'b', 'd']).save(str(index_path))
+    result = client.simulate_get('/similar', query_string='node=d')
+    assert result.status == falcon.HTTP_200
+    assert result.json['d'] is not None
+
+    for params in [{'node': 'a', 'k': '0'}, {'node': 'a', 'k': '-1'}, {'node': 'a', 'k': 'ten'},
+                   {'node': 'a', 'k': '100000'}, {'node': 'a', 'probes': '0'}, {}]:
+        assert client.simulate_get('/similar', params=params).status == falcon.HTTP_400
+
+    for body in [{'nodes': ['a'], 'k': 0}, {'nodes': ['a'], 'k': 1.5}, {'nodes': ['a'], 'k': True},
+                 {'nodes': 'a'}, ['a']]:
+        assert client.simulate_post('/similar', json=body).status == falcon.HTTP_400
+
+
+def test_neighbourhood_endpoint(tmp_path):
+    falcon = pytest.importorskip('falcon')
+    from falcon import testing
+
+    from api.neighbourhood_endpoint import NeighbourhoodResource
+    from graph_export import CsrGraph
+
+    graph_path = tmp_path / 'graph'
+    app = falcon.API()
+    app.add_route('/neighbourhood', NeighbourhoodResource(graph_path))
+    client = testing.TestClient(app)
+
+    # the API starts before the graph is exported
+    assert client.simulate_get('/neighbourhood', params={'node': 'logs/a'}).status == falcon.HTTP_503
+
+    # path a - b - c
+    ids = np.array(['logs/a', 'ip_addrs/b', 'users/c'])
+    CsrGraph.from_edges([0, 1], [1, 2], [1., 1.], [0, 1], ids, ['has_x', 'has_y']).save(str(graph_path))
+    result = client.simulate_get('/neighbourhood', query_string='node=logs/a&hops=1&compact=true')
+    assert result.status == falcon.HTTP_200
+    assert result.json['ids'] == ['logs/a', 'ip_addrs/b']
+
+    result = client.simulate_post('/neighbourhood', json={'nodes': ['logs/a'], 'types': ['has_x']})
+    assert result.status == falcon.HTTP_200
+    assert len(result.json['nodes']) == 2
+
+    for query_string in ['node=logs/a&hops=0', 'node=logs/a&hops=two', 'node=logs/a&hops=11',
+                         'node=logs/a&max_nodes=0', 'node=logs/a&max_degree=-1', 'node=logs/a&type=has_z',
+                         'node=logs/a&compact=maybe', 'hops=1']:
+        assert client.simulate_get('/neighbourhood', query_string=query_string).status == falcon.HTTP_400
+
+    for body in [{'nodes': ['logs/a'], 'hops': 0}, {'nodes': ['logs/a'], 'max_nodes': 'all'},
+                 {'nodes': ['logs/a'], 'types': 'has_x'}, {'nodes': []}, 'logs/a']:
+        assert client.simulate_post('/neighbourhood', json=body).status == falcon.HTTP_400
@@ -0,0 +1,87 @@
+import coalesce
+from coalesce import UPSERT_EDGES_AQL, UPSERT_ENTITIES_AQL, EntityCoalescer
+
+
+class FakeAql(object):
+    """ Applies the coalescer's statements to dicts, rejecting edges to missing vertices like a graph would """
+
+    def __init__(self):
+        self.collections = {}
+        self.calls = []
+
+    def execute(self, query, bind_vars):
+        collection = self.collections.setdefault(bind_vars['@collection'], {})
+        if query == UPSERT_ENTITIES_AQL:
+            self.calls.append(('vertices', bind_vars['@collection']))
+            for e in bind_vars['entities']:
+                old = collection.get(e['_key'])
+                if old is None:
+                    collection[e['_key']] = dict(e)
+                else:
+                    old['count'] += e['count']
+                    old['n_logs'] += e['n_logs']
+                    old['first_seen'] = min(old['first_seen'], e['first_seen'])
+                    old['last_seen'] = max(old['last_seen'], e['last_seen'])
+        else:
+            assert query == UPSERT_EDGES_AQL
+            self.calls.append(('edges', bind_vars['@collection']))
+            for e in bind_vars['edges']:
+                to_collection, to_key = e['_to'].split('/')
+                assert to_key in self.collections.get(to_collection, {}), 'edge to a missing vertex'
+                collection[e['_key']] = dict(e)
+
+
+class FakeDb(object):
+
+    def __init__(self):
+        self.aql = FakeAql()
+
+
+def add(coalescer, log_id, key, timestamp):
+    edge = {'_key': '{}-{}'.format(log_id, key), '_from': 'logs/' + log_id, '_to': 'ip_addrs/' + key}
+    coalescer.add('ip_addrs', key, 'ip-' + key, log_id, timestamp, 'has_ip_addr', edge)
+
+
+def test_entity_coalescer(monkeypatch):
+    now = [1000.]
+    monkeypatch.setattr(coalesce.time, 'time', lambda: now[0])
+    db = FakeDb()
+    coalescer = EntityCoalescer(db, window_secs=5., max_entities=3)
+
+    # occurrences of the same entity are merged into one write
+    add(coalescer, 'log1', 'a', 10.)
+    add(coalescer, 'log2', 'a', 5.)
+    add(coalescer, 'log2', 'a', 7.)
+    add(coalescer, 'log2', 'b', 8.)
+    assert db.aql.calls == []
+    assert coalescer.flush() == 2
+    assert db.aql.collections['ip_addrs']['a'] == {'_key': 'a', 'name': 'ip-a', 'count': 3, 'n_logs': 2,
+                                                   'first_seen': 5., 'last_seen': 10.}
+    assert set(db.aql.collections['has_ip_addr']) == {'log1-a', 'log2-a', 'log2-b'}
+
+    # and with the vertex written in an earlier window
+    add(coalescer, 'log3', 'a', 20.)
+    coalescer.flush()
+    assert db.aql.collections['ip_addrs']['a']['count'] == 4
+    assert db.aql.collections['ip_addrs']['a']['last_seen'] == 20.
+
+    # flush once `max_entities` distinct entities are pending
+    del db.aql.calls[:]
+    add(coalescer, 'log4', 'c', 30.)
+    add(coalescer, 'log4', 'd', 30.)
+    assert db.aql.calls == []
+    add(coalescer, 'log4', 'e', 30.)
+    assert db.aql.calls == [('vertices', 'ip_addrs'), ('edges', 'has_ip_addr')]
+    assert coalescer.stats()['pending'] == 0
+
+    # flush once the window is `window_secs` old
+    del db.aql.calls[:]
+    add(coalescer, 'log5', 'f', 40.)
+    now[0] += 4.
+    assert not coalescer.should_flush()
+    now[0] += 1.
+    assert coalescer.should_flush()
+    add(coalescer, 'log5', 'g', 40.)
+    assert db.aql.calls == [('vertices', 'ip_addrs'), ('edges', 'has_ip_addr')]
+    assert {'f', 'g'} <= set(db.aql.collections['ip_addrs'])
+    assert coalescer.stats() == {'occurrences': 10, 'writes': 8, 'pending': 0}
@@ -0,0 +1,38 @@
+import numpy as np
+
+from analysis.communities import label_propagation, modularity
+from graph_export import CsrGraph
+
+
+def two_cliques():
+    # two 4-cliques joined by a single edge 3 - 4
+    src, dst = [], []
+    for block in (range(0, 4), range(4, 8)):
+        block = list(block)
+        for i in block:
+            for j in block:
+                if i < j:
+                    src.append(i)
+                    dst.append(j)
+
+    src.append(3)
+    dst.append(4)
+    ids = np.array(['logs/{}'.format(i) for i in range(8)])
+    return CsrGraph.from_edges(src, dst, np.ones(len(src)), np.zeros(len(src)), ids, ['edges'])
+
+
+def test_label_propagation():
+    g = two_cliques()
+    labels = label_propagation(g, random_state=np.random.RandomState(0), quiet=True)
+    assert labels.max() == 1
+    assert len(set(labels[:4])) == 1
+    assert len(set(labels[4:])) == 1
+    assert labels[0] != labels[4]
+
+
+def test_modularity():
+    g = two_cliques()
+    labels = np.array([0, 0, 0, 0, 1, 1, 1, 1])
+    # 13 edges; each community has 6 internal edges and total degree 13
+    assert np.isclose(modularity(g, labels), 2 * (6 / 13 - (13 / 26) ** 2))
+    assert np.isclose(modularity(g, np.zeros(8, dtype=np.int64)), 0.)
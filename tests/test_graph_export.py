@@ -0,0 +1,68 @@
+import numpy as np
+
+from graph_export import CsrGraph
+
+
+def make_graph():
+    # a - b - c, a - c, d isolated
+    ids = np.array(['logs/a', 'ip_addrs/b', 'users/c', 'urls/d'])
+    return CsrGraph.from_edges([0, 1, 0], [1, 2, 2], [1., 2., 3.], [0, 1, 0], ids, ['has_x', 'has_y'])
+
+
+def test_csr_from_edges():
+    g = make_graph()
+    assert g.n_nodes == 4
+    assert g.n_edges == 6
+    assert list(g.degrees()) == [2, 2, 2, 0]
+    assert list(g.neighbours_of(0)) == [1, 2]
+    assert list(g.weights_of(2)) == [3., 2.]
+    assert g.has_edge(2, 1)
+    assert not g.has_edge(3, 0)
+    assert g.index['users/c'] == 2
+
+
+def test_csr_parallel_edges():
+    # a - b given twice, once in each direction, and again in another edge collection
+    ids = np.array(['logs/a', 'ip_addrs/b', 'users/c'])
+    g = CsrGraph.from_edges([0, 1, 0, 1], [1, 0, 1, 2], [1., 5., 7., 2.], [0, 0, 1, 0], ids, ['has_x', 'has_y'])
+    assert list(g.degrees()) == [1, 2, 1]
+    assert g.n_edges == 4
+    assert list(g.neighbours_of(1)) == [0, 2]
+    assert list(g.weights_of(0)) == [1.]
+    assert list(g.weights_of(1)) == [1., 2.]
+    assert list(g.edge_types[g.offsets[0]:g.offsets[1]]) == [0]
+
+
+def test_csr_save_load(tmp_path):
+    g = make_graph()
+    g.save(str(tmp_path))
+    assert CsrGraph.exists(str(tmp_path))
+    h = CsrGraph.load(str(tmp_path))
+    assert isinstance(h.neighbours, np.memmap)
+    assert np.array_equal(h.offsets, g.offsets)
+    assert np.array_equal(h.neighbours, g.neighbours)
+    assert h.edge_type_names == ['has_x', 'has_y']
+
+
+def test_neighbourhood():
+    from analysis.neighbourhood import NeighbourhoodService
+
+    # path a - b - c - e plus a - c (has_x) and b - c (has_y)
+    ids = np.array(['logs/a', 'ip_addrs/b', 'users/c', 'urls/d', 'logs/e'])
+    g = CsrGraph.from_edges([0, 1, 0, 2], [1, 2, 2, 4], [1., 2., 3., 1.], [0, 1, 0, 0], ids, ['has_x', 'has_y'])
+    service = NeighbourhoodService(g)
+    sub = service.neighbourhood(['logs/a'], hops=1)
+    assert list(sub.ids) == ['logs/a', 'ip_addrs/b', 'users/c']
+    assert list(sub.hops) == [0, 1, 1]
+    assert sub.n_edges == 3
+    assert service.neighbourhood(['logs/a'], hops=1) is sub
+    assert service.stats()['hits'] == 1
+
+    sub = service.neighbourhood(['logs/a'], hops=2, edge_types=['has_x'])
+    assert list(sub.ids) == ['logs/a', 'ip_addrs/b', 'users/c', 'logs/e']
+    assert sorted(sub.to_dict()['edges'][i]['type'] for i in range(sub.n_edges)) == ['has_x'] * 3
+
+    # the budget keeps the most strongly connected node
+    sub = service.neighbourhood(['logs/a'], hops=2, max_nodes=2)
+    assert list(sub.ids) == ['logs/a', 'users/c']
+    assert sub.truncated
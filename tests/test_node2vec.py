@@ -0,0 +1,272 @@
+from pathlib import Path
+
+import gensim
+import numpy as np
+import pytest
+
+from graph_export import CsrGraph
+from ml.node2vec.alias import alias_draw, alias_setup, alias_walks, AliasTables, rejection_walks
+from ml.node2vec.ann import LshIndex
+from ml.node2vec.watermark import Watermark
+
+
+def make_graph():
+    # square a-b-c-d-a with chord a-c
+    ids = np.array(['a', 'b', 'c', 'd'])
+    return CsrGraph.from_edges([0, 1, 2, 3, 0], [1, 2, 3, 0, 2], [1., 1., 1., 1., 2.], [0] * 5, ids, ['edges'])
+
+
+def second_order_probs(g, p, q):
+    """ Node2vec transition probabilities P[prev, cur, next] = w(cur, next) * alpha / Z, by definition """
+    probs = np.zeros((g.n_nodes,) * 3)
+    for cur in range(g.n_nodes):
+        for prev in g.neighbours_of(cur):
+            for nxt, w in zip(g.neighbours_of(cur), g.weights_of(cur)):
+                if nxt == prev:
+                    alpha = 1. / p
+                elif g.has_edge(prev, nxt):
+                    alpha = 1.
+                else:
+                    alpha = 1. / q
+
+                probs[prev, cur, nxt] = w * alpha
+
+            probs[prev, cur] /= probs[prev, cur].sum()
+
+    return probs
+
+
+def transition_freqs(walks, n_nodes):
+    """ Empirical P[prev, cur, next] over all steps of the walks, and the number of steps from each (prev, cur) """
+    counts = np.zeros((n_nodes,) * 3)
+    np.add.at(counts, (walks[:, :-2].ravel(), walks[:, 1:-1].ravel(), walks[:, 2:].ravel()), 1)
+    totals = counts.sum(axis=2, keepdims=True)
+    return counts / np.maximum(totals, 1), totals[..., 0]
+
+
+def assert_second_order(g, walks, p, q):
+    expected = second_order_probs(g, p, q)
+    freqs, totals = transition_freqs(walks, g.n_nodes)
+    assert (totals[expected.sum(axis=2) > 0] > 1000).all()
+    assert np.abs(freqs - expected).max() < 0.03
+
+    # e.g. from b to c: back to b (return, 1 / p), to a (neighbour of b, 1, weight 2), to d (outward, 1 / q)
+    b, c = 1, 2
+    assert np.allclose(expected[b, c], np.array([2., 1. / p, 0., 1. / q]) / (2. + 1. / p + 1. / q))
+
+
+def test_alias_setup():
+    probs = np.array([1., 2., 3., 4.])
+    alias, accept = alias_setup(probs)
+    random_state = np.random.RandomState(42)
+    u = random_state.random_sample(100000)
+    k = alias_draw(alias, accept, np.zeros(len(u), dtype=np.int64), np.full(len(u), 4), u)
+    freq = np.bincount(k, minlength=4) / len(u)
+    assert np.allclose(freq, probs / probs.sum(), atol=0.01)
+
+
+def test_alias_walks():
+    g = make_graph()
+    tables = AliasTables.build(g, p=0.5, q=2, quiet=True)
+    walks = alias_walks(g, tables, np.arange(g.n_nodes), 10, np.random.RandomState(42))
+    assert walks.shape == (4, 10)
+    assert list(walks[:, 0]) == [0, 1, 2, 3]
+    for walk in walks:
+        for i, j in zip(walk, walk[1:]):
+            assert g.has_edge(i, j)
+
+
+def test_alias_walk_distribution():
+    g = make_graph()
+    tables = AliasTables.build(g, p=0.5, q=2, quiet=True)
+    walks = alias_walks(g, tables, np.tile(np.arange(g.n_nodes), 2000), 20, np.random.RandomState(42))
+    assert_second_order(g, walks, p=0.5, q=2)
+
+
+def test_rejection_walks():
+    g = make_graph()
+    tables = AliasTables.build(g, second_order=False, quiet=True)
+    assert len(tables.second_alias) == 0
+    walks = rejection_walks(g, tables, np.arange(g.n_nodes), 10, np.random.RandomState(42), p=0.5, q=2)
+    assert walks.shape == (4, 10)
+    for walk in walks:
+        for i, j in zip(walk, walk[1:]):
+            assert g.has_edge(i, j)
+
+
+def test_rejection_walk_distribution():
+    g = make_graph()
+    tables = AliasTables.build(g, second_order=False, quiet=True)
+    for p, q in [(0.5, 2), (4, 0.25)]:
+        walks = rejection_walks(g, tables, np.tile(np.arange(g.n_nodes), 2000), 20, np.random.RandomState(42),
+                                p=p, q=q)
+        assert_second_order(g, walks, p, q)
+
+
+def test_has_edges():
+    g = make_graph()
+    mask = g.has_edges([0, 0, 1, 3], [1, 3, 3, 2])
+    assert list(mask) == [True, True, False, True]
+
+
+def test_watermark_changed_nodes(tmp_path):
+    Watermark.from_graph(make_graph()).save(str(tmp_path))
+    watermark = Watermark.load(str(tmp_path))
+
+    # new node 'e' linked to 'b'
+    ids = np.array(['a', 'b', 'c', 'd', 'e'])
+    g = CsrGraph.from_edges([0, 1, 2, 3, 0, 4], [1, 2, 3, 0, 2, 1], [1., 1., 1., 1., 2., 1.], [0] * 6, ids, ['edges'])
+    assert list(watermark.changed_nodes(g)) == [1, 4]
+
+    # cycle a-b-c-d rewired to a-b-d-c: no degree changes
+    ids = np.array(['a', 'b', 'c', 'd'])
+    g2 = CsrGraph.from_edges([0, 1, 2, 3], [1, 2, 3, 0], [1.] * 4, [0] * 4, ids, ['edges'])
+    Watermark.from_graph(g2).save(str(tmp_path))
+    g3 = CsrGraph.from_edges([0, 1, 3, 2], [1, 3, 2, 0], [1.] * 4, [0] * 4, ids, ['edges'])
+    assert list(np.diff(g3.offsets)) == list(np.diff(g2.offsets))
+    assert list(Watermark.load(str(tmp_path)).changed_nodes(g3)) == [0, 1, 2, 3]
+    assert len(Watermark.load(str(tmp_path)).changed_nodes(g2)) == 0
+
+    # and weight changes
+    g4 = CsrGraph.from_edges([0, 1, 2, 3], [1, 2, 3, 0], [1., 1., 2., 1.], [0] * 4, ids, ['edges'])
+    assert list(Watermark.load(str(tmp_path)).changed_nodes(g4)) == [2, 3]
+
+
+def test_lsh_index(tmp_path):
+    random_state = np.random.RandomState(42)
+    vectors = random_state.standard_normal((200, 16)).astype(np.float32)
+    vectors[1] = vectors[0] + 0.01
+    ids = [str(i) for i in range(200)]
+    LshIndex(n_tables=4, n_bits=6).build(vectors, ids).save(str(tmp_path))
+    index = LshIndex.load(str(tmp_path))
+    results = index.most_similar(['0', '1'], k=5, n_probes=4)
+    assert results[0][0][0] == '1'
+    assert results[1][0][0] == '0'
+    assert all(len(r) == 5 for r in results)
+
+    # saving again writes a new version, leaving the arrays a reader has mapped untouched
+    for _ in range(3):
+        LshIndex(n_tables=4, n_bits=6).build(vectors, ['n' + i for i in ids]).save(str(tmp_path))
+
+    assert index.most_similar(['0'], k=1)[0][0][0] == '1'
+    assert sorted(p.name for p in tmp_path.iterdir() if not p.name.startswith('v-')) == ['meta.json']
+    assert len([p for p in tmp_path.iterdir() if p.name.startswith('v-')]) == 2
+    assert LshIndex.load(str(tmp_path)).most_similar(['n0'], k=1)[0][0][0] == 'n1'
+
+
+def test_alias_walk_workers(tmp_path):
+    import os
+    from ml.node2vec.node2vec import Node2vec
+
+    g = make_graph()
+    with Node2vec(g, walk_length=6, n_walks=5, p=0.5, q=2, workers=2, quiet=True, sampling='alias',
+                  temp_folder=str(tmp_path), sampling_strategy={'d': {'n_walks': 2, 'walk_length': 3}}) as node2vec:
+        work_dir = node2vec.work_dir
+        walks = node2vec.walks
+        assert isinstance(walks, np.memmap)
+        assert walks.filename == os.path.join(work_dir, 'walks.npy')
+        assert os.path.dirname(work_dir) == str(tmp_path)
+
+        # each worker wrote its own rows: 5 walks from a, b and c, 2 from d
+        assert walks.shape == (17, 6)
+        assert sorted(np.bincount(walks[:, 0])) == [2, 5, 5, 5]
+        assert (walks[walks[:, 0] == 3, 3:] == -1).all()
+        for walk in walks:
+            walk = walk[walk >= 0]
+            assert all(g.has_edge(i, j) for i, j in zip(walk, walk[1:]))
+
+    assert node2vec.walks is None
+    assert not os.path.exists(work_dir)
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_streaming_walk_corpus():
+    from threading import Thread
+
+    from joblib import Parallel
+
+    from ml.node2vec.corpus import StreamingWalkCorpus, WalkCorpus
+    from ml.node2vec.node2vec import Node2vec
+
+    g = make_graph()
+    with Node2vec(g, walk_length=6, n_walks=50, workers=2, quiet=True, sampling='rejection', batch_size=8,
+                  generate_walks=False) as node2vec:
+        jobs = node2vec._prepare_alias_walks()
+        corpus = StreamingWalkCorpus(node2vec.walks_path, g.ids, node2vec.progress_path, node2vec.worker_rows,
+                                     chunk_size=5, poll_interval=0.001)
+
+        def generate():
+            Parallel(n_jobs=2)(jobs)
+            corpus.done.set()
+
+        thread = Thread(target=generate)
+        thread.start()
+        streamed = list(corpus)
+        thread.join()
+
+        # the first pass follows the workers, later passes read the matrix in order
+        in_memory = list(WalkCorpus(np.array(np.load(node2vec.walks_path)), g.ids))
+        assert len(streamed) == len(corpus) == 200
+        assert sorted(streamed) == sorted(in_memory)
+        assert list(corpus) == in_memory
+
+        path = str(Path(node2vec.work_dir) / 'walks.txt')
+        WalkCorpus(np.load(node2vec.walks_path), g.ids, chunk_size=7).save_text(path)
+        with open(path) as f:
+            assert [line.split() for line in f] == in_memory
+
+
+@pytest.mark.skipif(gensim.__version__ >= '4', reason='Node2vec.fit uses the gensim 3 Word2Vec API')
+@pytest.mark.parametrize('fit_params', [{'corpus_file': True}, {'overlap': True}])
+def test_node2vec_fit(fit_params):
+    from ml.node2vec.node2vec import Node2vec
+
+    g = make_graph()
+    node2vec = Node2vec(g, embed_dim=8, walk_length=6, n_walks=5, workers=2, quiet=True, sampling='rejection',
+                        generate_walks=False)
+    model = node2vec.fit(window=2, min_count=1, **fit_params)
+    assert sorted(model.wv.vocab) == list(g.ids)
+    assert model.wv.vectors.shape == (4, 8)
+    assert node2vec.work_dir is None
+
+
+def make_keyed_vectors():
+    from gensim.models import KeyedVectors
+
+    kv = KeyedVectors(vector_size=3)
+    kv.add(entities=['a', 'b', 'c'], weights=np.array([[1., 2., 3.], [-1., 0., 2.], [0.5, 0.5, 0.5]]))
+    return kv
+
+
+@pytest.mark.skipif(gensim.__version__ >= '4', reason='EdgeEmbedder uses the gensim 3 KeyedVectors API')
+def test_edge_embedders(tmp_path):
+    from ml.node2vec.edges import (AverageEmbedder, HadamardEmbedder, WeightedL1Embedder, WeightedL2Embedder,
+                                   graph_edges)
+
+    kv = make_keyed_vectors()
+    expected = {
+        AverageEmbedder: [0., 1., 2.5],
+        HadamardEmbedder: [-1., 0., 6.],
+        WeightedL1Embedder: [2., 2., 1.],
+        WeightedL2Embedder: [4., 4., 1.]
+    }
+    edges = [('a', 'b'), ('c', 'c'), ('b', 'a')]
+    for cls, a_b in expected.items():
+        embedder = cls(kv, quiet=True)
+        assert np.allclose(embedder[('a', 'b')], a_b)
+        out = embedder.embed_edges(edges, chunk_size=2, out=str(tmp_path / 'edges.npy'))
+        assert isinstance(out, np.memmap)
+        assert np.allclose(out, [embedder[edge] for edge in edges])
+        assert np.allclose(out[0], out[2])
+
+        # an endpoint without an embedding
+        with pytest.raises(KeyError):
+            embedder[('a', 'x')]
+
+        with pytest.raises(KeyError):
+            embedder.embed_edges([('a', 'b'), ('x', 'c')])
+
+    g = CsrGraph.from_edges([0, 1], [1, 2], [1., 1.], [0, 0], np.array(['a', 'b', 'c']), ['edges'])
+    edge_kv = HadamardEmbedder(kv, quiet=True).as_keyed_vectors(graph_edges(g), chunk_size=1)
+    assert sorted(edge_kv.index2word) == ["('a', 'b')", "('b', 'c')"]
+    assert np.allclose(edge_kv["('b', 'c')"], [-0.5, 0., 1.])
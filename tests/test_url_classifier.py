@@ -0,0 +1,122 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from ml.url_classifier.encoder import UrlEncoder
+
+
+def test_url_encoder():
+    encoder = UrlEncoder({'h': 1, 't': 2, 'p': 3, ':': 4, '/': 5, 'é': 6}, max_len=6)
+    x = encoder.encode(['http://', 'hé', '', 'h?'])
+    assert x.dtype == np.int32
+
+    # truncated to `max_len`; unknown characters and padding are 0
+    assert x.tolist() == [[1, 2, 2, 3, 4, 5], [1, 6, 0, 0, 0, 0], [0] * 6, [1, 0, 0, 0, 0, 0]]
+
+
+class CountingPredictor(object):
+    """ Flags URLs containing 'evil', counting the URLs it is asked about """
+
+    def __init__(self):
+        self.n_urls = 0
+
+    def predict_batch(self, urls):
+        self.n_urls += len(urls)
+        return np.array([int('evil' in url) for url in urls])
+
+
+def test_url_verdict_cache(tmp_path):
+    from ml.url_classifier.verdict_cache import normalize_url, UrlVerdictCache
+
+    assert normalize_url(' HTTP://Example.COM:80/a?b=1#top') == 'http://example.com/a?b=1'
+
+    predictor = CountingPredictor()
+    path = str(tmp_path / 'verdicts.json')
+    cache = UrlVerdictCache(predictor, max_size=2, path=path, allow_domains=['good.com'], deny_domains=['bad.com'])
+    urls = ['http://evil.org/x', 'HTTP://EVIL.ORG/x', 'http://a.org', 'http://cdn.bad.com/', 'good.com/evil']
+    assert cache.predict_batch(urls).tolist() == [1, 1, 0, 1, 0]
+    assert predictor.n_urls == 2
+    assert cache.predict('http://a.org#frag') == 0
+    assert predictor.n_urls == 2
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['allowed'], stats['denied']) == (2, 2, 1, 1)
+
+    # requests never wait for a save; the least recently used verdict was evicted, and the rest
+    # are saved on close and survive a restart
+    assert not os.path.exists(path)
+    cache.close()
+    cache = UrlVerdictCache(predictor, max_size=2, path=path)
+    assert list(cache.cache) == ['http://evil.org/x', 'http://a.org']
+
+    # processes sharing the file merge their verdicts into it
+    caches = [UrlVerdictCache(predictor, path=path, save_interval=0.001) for _ in range(4)]
+    for i, other in enumerate(caches):
+        other.predict('http://{}.org'.format(i))
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(lambda c: [c.save() for _ in range(20)], caches))
+
+    for other in caches + [cache]:
+        other.close()
+
+    assert sorted(os.listdir(str(tmp_path))) == ['verdicts.json', 'verdicts.json.lock']
+    assert len(UrlVerdictCache(predictor, path=path).cache) == 6
+
+
+def make_bilstm_weights(random_state, n_tokens=6, embed_dim=4, units=3, max_len=12):
+    def uniform(*shape):
+        return random_state.uniform(-1, 1, shape).astype(np.float32)
+
+    weights = {
+        'max_url_seq_length': np.int64(max_len),
+        'chars': np.array(list('abcdef'[:n_tokens])),
+        'char_indices': np.arange(n_tokens),
+        'embeddings': uniform(n_tokens, embed_dim),
+        'dense_kernel': uniform(2 * units, 2),
+        'dense_bias': uniform(2)
+    }
+    for direction in ('forward', 'backward'):
+        weights[direction + '_kernel'] = uniform(embed_dim, 4 * units)
+        weights[direction + '_recurrent_kernel'] = uniform(units, 4 * units)
+        weights[direction + '_bias'] = uniform(4 * units)
+
+    return weights
+
+
+def keras_bilstm(weights, x):
+    """ The Keras 2 forward pass of `make_bilstm_model`, step by step over the padded sequences """
+    def hard_sigmoid(z):
+        return np.clip(0.2 * z + 0.5, 0, 1)
+
+    def lstm(direction, steps):
+        kernel, recurrent_kernel, bias = (weights[direction + name].astype(np.float64)
+                                          for name in ('_kernel', '_recurrent_kernel', '_bias'))
+        u = recurrent_kernel.shape[0]
+        h = np.zeros((len(x), u))
+        c = np.zeros((len(x), u))
+        for t in steps:
+            z = weights['embeddings'][x[:, t]] @ kernel + bias + h @ recurrent_kernel
+            c = hard_sigmoid(z[:, u:2 * u]) * c + hard_sigmoid(z[:, :u]) * np.tanh(z[:, 2 * u:3 * u])
+            h = hard_sigmoid(z[:, 3 * u:]) * np.tanh(c)
+
+        return h
+
+    max_len = x.shape[1]
+    h = np.hstack([lstm('forward', range(max_len)), lstm('backward', range(max_len - 1, -1, -1))])
+    z = h @ weights['dense_kernel'] + weights['dense_bias']
+    e = np.exp(z - z.max(axis=1, keepdims=True))
+    return e / e.sum(axis=1, keepdims=True)
+
+
+def test_numpy_bilstm():
+    import sys
+    from ml.url_classifier.bilstm_numpy import NumpyBiLstmPredictor
+
+    predictor = NumpyBiLstmPredictor()
+    predictor.set_weights(make_bilstm_weights(np.random.RandomState(0)))
+    urls = ['abc', 'fedcbafedcba', '', 'a', 'abcdefabcdefabcdef', 'azb', 'cab']
+    expected = keras_bilstm(make_bilstm_weights(np.random.RandomState(0)), predictor.encoder.encode(urls))
+    assert np.allclose(predictor.predict_proba(urls, batch_size=3), expected, atol=1e-5)
+    assert predictor.predict_batch(urls).tolist() == np.argmax(expected, axis=1).tolist()
+    assert 'tensorflow' not in sys.modules